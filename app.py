@@ -1,35 +1,177 @@
 # app.py
 import os
 import json
+import math
 import re
 import time
-from typing import List, Dict, Optional, Tuple
+import bisect
+import hashlib
+import shutil
+import contextlib
+import contextvars
+import sqlite3
+import sys
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 from flask import Flask, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Response
 
 # --------- Retrieval (offline study packs) ----------
-import PyPDF2
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+import pdf_extract
 
 # -------------------- OLLAMA CONFIG --------------------
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "gpt-oss:20b")
 
+# Several Ollama servers: OLLAMA_HOSTS is a comma-separated list of base URLs
+# (default: OLLAMA_HOST alone). Each generation goes to the healthy backend with
+# the fewest generations in flight, and a tutor session stays on the backend that
+# served its last turn (whose KV cache still holds its prompt) unless that one is
+# busier than the others. A backend that fails BACKEND_FAILURES times in a row
+# (connection error, timeout, HTTP 5xx) is skipped for BACKEND_COOLDOWN seconds,
+# then gets one trial request; a passing health check brings it back sooner.
+OLLAMA_HOSTS = [h.strip().rstrip("/") for h in os.environ.get("OLLAMA_HOSTS", OLLAMA_HOST).split(",")
+                if h.strip()]
+BACKEND_FAILURES = int(os.environ.get("BACKEND_FAILURES", "3"))
+BACKEND_COOLDOWN = float(os.environ.get("BACKEND_COOLDOWN", "30"))
+
 # Separate connect/read timeouts (seconds)
 CONNECT_TIMEOUT = int(os.environ.get("CONNECT_TIMEOUT", "15"))
 READ_TIMEOUT = int(os.environ.get("READ_TIMEOUT", "300"))   # allow long generations
 
-# How many retries if Ollama is cold/busy
+# How many times a failed request is tried again: straight away on a backend
+# it hasn't tried yet, or, when there is none, after RETRY_BACKOFF * attempt
+# seconds on one it has, as long as that backend's circuit is still closed.
 MAX_RETRIES = int(os.environ.get("MAX_RETRIES", "2"))
 RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", "2.0"))
 
+# Load OLLAMA_MODEL at startup instead of on the first student's request, and
+# keep it loaded: every request asks Ollama to keep the model resident for
+# OLLAMA_KEEP_ALIVE (seconds, or an Ollama duration such as "30m"; negative =
+# forever), and every MODEL_CHECK_INTERVAL seconds each backend's /api/ps is
+# checked (which is also its health check) and the model reloaded if Ollama
+# unloaded it anyway. /health answers 503 while no backend has the model
+# loaded. MODEL_WARMUP=0 leaves loading to the first request.
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "1") != "0"
+MODEL_CHECK_INTERVAL = float(os.environ.get("MODEL_CHECK_INTERVAL", "15"))
+
+# Context window requested on every call. Keep it fixed: a request with another
+# num_ctx makes Ollama reload the model and drop its prompt cache. 0 = Ollama's default.
+OLLAMA_NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", "8192"))
+
+# Keep-alive connections to Ollama shared by all request threads and by both
+# blocking and streaming calls. Requests beyond the pool size still go through
+# on a fresh connection, which is closed afterwards instead of kept.
+OLLAMA_POOL_SIZE = int(os.environ.get("OLLAMA_POOL_SIZE", "16"))
+
+# Admission control in front of Ollama: at most LLM_CONCURRENCY generations run
+# at once (default: two per backend); up to LLM_QUEUE_SIZE more wait, interactive
+# asks first, then lesson and quiz generation, then grading, taking turns between
+# clients (X-Client-Id header, else the remote address). A request that finds the
+# queue full, would be its client's LLM_CLIENT_QUEUE+1-th waiting request, or
+# waits longer than LLM_QUEUE_WAIT seconds gets a 429 with its queue position and
+# an ETA.
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", str(2 * len(OLLAMA_HOSTS))))
+LLM_QUEUE_SIZE = int(os.environ.get("LLM_QUEUE_SIZE", "32"))
+LLM_CLIENT_QUEUE = int(os.environ.get("LLM_CLIENT_QUEUE", "4"))
+LLM_QUEUE_WAIT = float(os.environ.get("LLM_QUEUE_WAIT", "120"))
+
+# Identical requests that arrive while the same generation is already running
+# (a class clicking the same preset) share it instead of each starting one:
+# blocking callers get the leader's answer, streams replay the tokens emitted
+# so far and then follow live. LLM_COALESCE=0 sends every request to Ollama.
+LLM_COALESCE = os.environ.get("LLM_COALESCE", "1") != "0"
+
+# Opt-in on-disk cache of non-streaming chat responses, keyed by model +
+# messages + options, so repeated lesson/quiz requests skip the model.
+# Entries expire after LLM_CACHE_TTL seconds; the least recently used are
+# evicted once the stored responses exceed LLM_CACHE_MAX_MB. A request can
+# bypass it with "no_cache": true.
+LLM_CACHE = os.environ.get("LLM_CACHE", "0") == "1"
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", os.path.join(os.getcwd(), ".llm_cache.sqlite"))
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_MB = float(os.environ.get("LLM_CACHE_MAX_MB", "64"))
+
+# /grade_quiz_bulk sends up to BULK_GRADE_BATCH distinct open-ended answers
+# (across all students) to the model per request.
+BULK_GRADE_BATCH = int(os.environ.get("BULK_GRADE_BATCH", "20"))
+
+# Tutor sessions (/ask and /ask_stream with a "session_id"): the server keeps
+# each conversation's history in memory, at most SESSION_MAX sessions, dropping
+# the least recently used and those idle for SESSION_TTL seconds. Once a
+# session's history is over SESSION_HISTORY_TOKENS (estimated), all but the last
+# SESSION_KEEP_TURNS turns are folded by the model into a rolling summary of at
+# most SESSION_SUMMARY_TOKENS, so prompts stay about the same size however long
+# the chat runs.
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "1000"))
+SESSION_TTL = float(os.environ.get("SESSION_TTL", "3600"))
+SESSION_HISTORY_TOKENS = int(os.environ.get("SESSION_HISTORY_TOKENS", "1200"))
+SESSION_KEEP_TURNS = int(os.environ.get("SESSION_KEEP_TURNS", "2"))
+SESSION_SUMMARY_TOKENS = int(os.environ.get("SESSION_SUMMARY_TOKENS", "200"))
+
 # -------------------- RAG CONFIG -----------------------
 STUDY_PACK_DIR = os.path.join(os.getcwd(), "study_packs")
 TOP_K_CHUNKS = 6
 
+# Chunks are cut on paragraph, then sentence, then word boundaries, up to
+# CHUNK_CHARS characters each; consecutive chunks share up to CHUNK_OVERLAP
+# characters of trailing text so an idea split across a boundary is still found.
+CHUNK_CHARS = int(os.environ.get("CHUNK_CHARS", "1800"))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", "200"))
+
+# Extracted text and per-pack term counts are cached here so restarts only
+# re-parse files that changed. Set INDEX_CACHE_DIR="" to disable the cache.
+INDEX_CACHE_DIR = os.environ.get("INDEX_CACHE_DIR", os.path.join(os.getcwd(), ".index_cache"))
+# Bump whenever extraction, chunking or vectorizer settings change.
+INDEX_CACHE_VERSION = 3
+
+# PDF extraction fans out over a long-lived process pool of this many workers
+# (1 = always in-process). The pool is only used when the PDFs still to be
+# extracted in one pack total at least PDF_POOL_MIN_BYTES; smaller jobs are
+# faster in-process than the hand-off. Large PDFs are split into page ranges
+# of PDF_PAGES_PER_TASK so one file can use several workers.
+INDEX_WORKERS = int(os.environ.get("INDEX_WORKERS", str(os.cpu_count() or 1)))
+PDF_POOL_MIN_BYTES = int(os.environ.get("PDF_POOL_MIN_BYTES", str(2 * 1024 * 1024)))
+PDF_PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", "50"))
+
+# Packs are listed at startup but their TF-IDF state is built on first retrieve(),
+# or earlier by a background warm-up thread (INDEX_WARMUP=1) that goes through
+# WARMUP_ORDER first, then every other pack. LAZY_INDEX=0 builds all packs at import.
+LAZY_INDEX = os.environ.get("LAZY_INDEX", "1") != "0"
+INDEX_WARMUP = os.environ.get("INDEX_WARMUP", "1") != "0"
+WARMUP_ORDER = [n.strip() for n in os.environ.get("WARMUP_ORDER", "Samples,General").split(",") if n.strip()]
+
+# Recent retrieve() results kept in memory, keyed by (packs, query terms, top_k),
+# so the same question asked by a whole class is scored once. 0 disables it.
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", "512"))
+
+# Poll study_packs/ for added/changed/removed files every N seconds (0 = off).
+# POST /reindex triggers the same scan on demand.
+REINDEX_INTERVAL = float(os.environ.get("REINDEX_INTERVAL", "15"))
+# If set, /reindex requires a matching X-Admin-Token header.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Every request records how long each stage took (safety check, retrieval,
+# prompt building, queueing for a model slot, Ollama's load, prompt evaluation,
+# time to first token and generation) into histograms served in the Prometheus
+# text format at GET /metrics. METRICS=0 turns recording off. Responses carry a
+# Server-Timing header with the request's own stages when SERVER_TIMING=1, or
+# when the request sends "X-Server-Timing: 1".
+METRICS = os.environ.get("METRICS", "1") != "0"
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+
 # ---- Simple safety guardrails ----
 BANNED_PATTERNS = [
     r"\b(?:fuck|shit|bitch|asshole)\b",
@@ -41,23 +183,734 @@ DISALLOWED_TOPICS = [
     "illegal drugs",
 ]
 
+# More rules, one per line, added to the lists above: a phrase (matched anywhere,
+# ignoring case), or "re:" and a regular expression. Lines starting with # are
+# comments. Generated /ask_stream (and quiz stream) text is checked too, as it
+# arrives: a match cuts the stream off and stops the generation, unless
+# STREAM_GUARDRAILS=0.
+GUARDRAILS_FILE = os.environ.get("GUARDRAILS_FILE", "")
+STREAM_GUARDRAILS = os.environ.get("STREAM_GUARDRAILS", "1") != "0"
+
+class GuardrailViolation(Exception):
+    """Generated text matched a guardrail; the message is the reason."""
+
+class Guardrails:
+    """
+    Every pattern and phrase compiled into one case-insensitive alternation,
+    each rule a named group, so a text is scanned once however many rules
+    there are and the matching group names the reason. `max_len` is the
+    longest text a rule is expected to match, which bounds how far back a
+    stream scanner looks. Rules added after construction take effect on
+    compile().
+    """
+
+    # Regular expressions are taken to match at most this many characters; a
+    # longer match split across stream chunks can be missed.
+    PATTERN_LEN = 64
+
+    # "\1" or "(?(1)...)": group numbers shift once rules are joined together.
+    _NUMBERED_REF = re.compile(r"(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(\d")
+    _GLOBAL_FLAGS = re.compile(r"\(\?([aiLmsux]+)\)")
+
+    def __init__(self, patterns: List[str] = (), phrases: List[str] = ()):
+        self._reasons: Dict[str, str] = {}
+        self._parts: List[str] = []
+        self._names = set()  # every group name in use, the rules' own and ours
+        self._has_patterns = False
+        self.max_len = 0
+        self.regex = None
+        for pat in patterns:
+            self.add_pattern(pat)
+        for phrase in phrases:
+            self.add_phrase(phrase)
+        self.compile()
+
+    def add_pattern(self, pattern: str, reason: str = "Inappropriate language"):
+        """Add a regular expression; raises re.error if it can't be part of the combined matcher."""
+        flags = self._GLOBAL_FLAGS.match(pattern)
+        if flags:
+            # Global flags are only allowed at the start of the whole expression: scope them to this rule.
+            pattern = f"(?{flags.group(1)}:{pattern[flags.end():]})"
+        if self._NUMBERED_REF.search(pattern):
+            raise re.error("numbered group references are not supported; use a named group and (?P=name)")
+        self._add_part(pattern, reason)
+        self._has_patterns = True
+
+    def add_phrase(self, phrase: str):
+        self._add_part(re.escape(phrase.lower()), f"Disallowed topic: {phrase}")
+        self.max_len = max(self.max_len, len(phrase))
+
+    def _add_part(self, pattern: str, reason: str):
+        n = len(self._parts)
+        while f"r{n}" in self._names:
+            n += 1
+        name = f"r{n}"
+        wrapped = f"(?P<{name}>{pattern})"
+        own = set(re.compile(wrapped).groupindex) - {name}  # validates the rule as it will be joined
+        clash = own & self._names
+        if clash:
+            raise re.error(f"group name {sorted(clash)[0]!r} is already used by another rule")
+        self._names |= own | {name}
+        self._reasons[name] = reason
+        self._parts.append(wrapped)
+
+    def compile(self):
+        self.regex = re.compile("|".join(self._parts), re.IGNORECASE) if self._parts else None
+        if self._has_patterns:
+            self.max_len = max(self.max_len, self.PATTERN_LEN)
+
+    def reason(self, match) -> str:
+        return self._reasons[match.lastgroup]
+
+    def check(self, text: str) -> Optional[str]:
+        match = self.regex.search(text) if self.regex is not None else None
+        return self.reason(match) if match else None
+
+    def scanner(self) -> "GuardrailScanner":
+        return GuardrailScanner(self)
+
+class GuardrailScanner:
+    """
+    Checks generated text chunk by chunk. Each chunk is searched together with
+    as much of the text before it as the longest rule can match, so a match
+    split across chunks is still found and the work per chunk stays constant.
+    Text is handed back for sending once no rule matches it yet; only a
+    trailing partial word and a match that the next chunk could still complete
+    (e.g. a word boundary after "porn") are held back. The start of a banned
+    phrase ("illegal ", "self-") is not recognised as such, so it can be sent
+    before the rest arrives and the stream is cut: this keeps time to first
+    token low, at the cost of a few words that are harmless on their own.
+    """
+
+    # Most text held back at once, so a long run of letters can't stall the stream.
+    MAX_HELD = 256
+
+    def __init__(self, rules: Guardrails):
+        self.rules = rules
+        self._buf = ""     # already-sent context, then held-back text
+        self._held = 0     # length of the held-back tail of _buf
+        self._trimmed = False
+
+    def feed(self, chunk: str) -> Tuple[str, Optional[str]]:
+        """Text now safe to send, and the reason if the stream must stop here."""
+        return self._scan(self._buf + chunk, final=False)
+
+    def finish(self) -> Tuple[str, Optional[str]]:
+        """The held-back text at the end of the stream, and the reason if it must not be sent."""
+        return self._scan(self._buf, final=True)
+
+    def _scan(self, buf: str, final: bool) -> Tuple[str, Optional[str]]:
+        start = len(self._buf) - self._held  # first character not yet sent
+        regex, lookback = self.rules.regex, self.rules.max_len
+        # A new match ends in the new text, so starts at most `lookback` before it. The
+        # character before the search start is kept as left context for \b.
+        pos = max(start - lookback, 1 if self._trimmed else 0)
+        match = regex.search(buf, pos) if regex is not None else None
+        if match and (final or match.end() < len(buf)):
+            return buf[start:max(start, match.start())], self.rules.reason(match)
+        cut = len(buf)
+        if not final:
+            if match:
+                cut = match.start()
+            else:
+                while cut > start and buf[cut - 1].isalnum():
+                    cut -= 1
+            cut = max(cut, start, len(buf) - self.MAX_HELD)
+        safe = buf[start:cut]
+        keep = max(0, cut - lookback - 1)
+        self._trimmed = self._trimmed or keep > 0
+        self._buf, self._held = buf[keep:], len(buf) - cut
+        return safe, None
+
+def load_guardrails(path: str) -> Guardrails:
+    rules = Guardrails(BANNED_PATTERNS, DISALLOWED_TOPICS)
+    if not path:
+        return rules
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = [ln.strip() for ln in f]
+    except OSError as e:
+        print(f"[guardrails] cannot read {path}: {e}; using the built-in rules only")
+        return rules
+    for n, line in enumerate(lines, 1):
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("re:"):
+            try:
+                rules.add_pattern(line[3:])
+            except re.error as e:
+                print(f"[guardrails] {path}:{n}: skipping pattern: {e}")
+        else:
+            rules.add_phrase(line)
+    rules.compile()
+    return rules
+
+guardrails = load_guardrails(GUARDRAILS_FILE)
+
 def violates_safety(text: str) -> Optional[str]:
-    lower = text.lower()
-    for pat in BANNED_PATTERNS:
-        if re.search(pat, lower):
-            return "Inappropriate language"
-    for topic in DISALLOWED_TOPICS:
-        if topic in lower:
-            return f"Disallowed topic: {topic}"
-    return None
+    return guardrails.check(text)
+
+def guard_stream(chunks: Iterator[str]) -> Iterator[str]:
+    """
+    `chunks` passed through guardrails.scanner(); on a match, the text before
+    it is yielded and GuardrailViolation raised, which closes `chunks` (and so
+    the Ollama request).
+    """
+    scanner = guardrails.scanner()
+    try:
+        for chunk in chunks:
+            safe, reason = scanner.feed(chunk)
+            if safe:
+                yield safe
+            if reason:
+                raise GuardrailViolation(reason)
+        safe, reason = scanner.finish()
+        if safe:
+            yield safe
+        if reason:
+            raise GuardrailViolation(reason)
+    finally:
+        chunks.close()
+
+# -------------- Metrics --------------
+# Seconds; from sub-millisecond checks up to a slow generation.
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                 30.0, 60.0, 120.0, 300.0)
+
+def _label_text(names: Tuple[str, ...], values: Tuple) -> str:
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return ",".join(f'{n}="{escape(v)}"' for n, v in zip(names, values))
+
+def _sample_text(value: float) -> str:
+    """A sample value without losing precision (:g keeps 6 digits): integers exactly, else repr."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+class Histogram:
+    """Bucketed observations per label set; buckets are cumulated only when rendered."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...], buckets: Tuple[float, ...] = STAGE_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series: Dict[Tuple, List] = {}  # label values -> [counts per bucket + overflow, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self, out: List[str]):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} histogram")
+        with self._lock:
+            series = [(k, list(v[0]), v[1]) for k, v in sorted(self._series.items())]
+        for labels, counts, total in series:
+            base = _label_text(self.labels, labels)
+            sep = "," if base else ""
+            running = 0
+            for bound, count in zip(self.buckets, counts):
+                running += count
+                out.append(f'{self.name}_bucket{{{base}{sep}le="{bound:g}"}} {running}')
+            running += counts[-1]
+            out.append(f'{self.name}_bucket{{{base}{sep}le="+Inf"}} {running}')
+            out.append(f"{self.name}_sum{{{base}}} {_sample_text(total)}")
+            out.append(f"{self.name}_count{{{base}}} {running}")
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self, out: List[str]):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} counter")
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            base = _label_text(self.labels, labels)
+            out.append(f"{self.name}{{{base}}} {_sample_text(value)}" if base
+                       else f"{self.name} {_sample_text(value)}")
+
+request_seconds = Histogram("studypack_request_seconds", "Request duration, until the last byte of streamed bodies.",
+                            ("route", "status"))
+stage_seconds = Histogram("studypack_stage_seconds", "Time spent per request stage (summed when a request "
+                          "makes several model calls).", ("route", "stage"))
+ollama_tokens = Counter("studypack_ollama_tokens_total", "Tokens Ollama evaluated (prompt) and generated (eval).",
+                        ("route", "kind"))
+metrics_overhead = Counter("studypack_metrics_overhead_seconds_total",
+                           "Time spent recording request metrics, and rendering /metrics.", ("part",))
+
+class RequestTimer:
+    """The stages of one request, filled in as it runs and recorded into the histograms by finish()."""
+    __slots__ = ("route", "t0", "stages", "tokens", "_lock")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.t0 = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.tokens: Dict[str, int] = {}
+        self._lock = threading.Lock()  # /grade_quiz_bulk records from several threads
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_tokens(self, kind: str, count: int):
+        with self._lock:
+            self.tokens[kind] = self.tokens.get(kind, 0) + count
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: the stages so far and the elapsed total, in ms."""
+        with self._lock:
+            stages = list(self.stages.items())
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages]
+        parts.append(f"total;dur={(time.perf_counter() - self.t0) * 1000:.1f}")
+        return ", ".join(parts)
+
+    def finish(self, status: int):
+        if not METRICS:
+            return
+        t = time.perf_counter()
+        request_seconds.observe(t - self.t0, self.route, str(status))
+        with self._lock:
+            stages, tokens = list(self.stages.items()), list(self.tokens.items())
+        for name, seconds in stages:
+            stage_seconds.observe(seconds, self.route, name)
+        for kind, count in tokens:
+            ollama_tokens.inc(count, self.route, kind)
+        metrics_overhead.inc(time.perf_counter() - t, "record")
+
+_request_timer: "contextvars.ContextVar[Optional[RequestTimer]]" = contextvars.ContextVar("request_timer",
+                                                                                          default=None)
+
+def start_request_timer(route: str) -> Optional[RequestTimer]:
+    timer = RequestTimer(route) if METRICS or SERVER_TIMING else None
+    _request_timer.set(timer)
+    return timer
+
+@contextlib.contextmanager
+def timed(stage: str):
+    """Add the time spent in the block to `stage` of the current request, if it is being timed."""
+    timer = _request_timer.get()
+    if timer is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(stage, time.perf_counter() - t0)
+
+def record_ollama(stats: Optional[Dict], wall: Optional[float] = None, ttft: Optional[float] = None,
+                  timer: Optional[RequestTimer] = None):
+    """
+    Ollama's own counters for the current request (or `timer`). A non-streamed
+    call has no first token to see, so its time to first token is the call's
+    wall time minus Ollama's generation time.
+    """
+    timer = timer or _request_timer.get()
+    if timer is None:
+        return
+    stats = stats or {}
+    for key, stage in (("load_duration", "ollama_load"), ("prompt_eval_duration", "ollama_prompt_eval"),
+                       ("eval_duration", "ollama_eval")):
+        if stats.get(key):
+            timer.add(stage, stats[key] / 1e9)
+    if wall is not None:
+        timer.add("ollama", wall)
+        if ttft is None and stats.get("eval_duration"):
+            ttft = max(0.0, wall - stats["eval_duration"] / 1e9)
+    if ttft is not None:
+        timer.add("ollama_ttft", ttft)
+    for key, kind in (("prompt_eval_count", "prompt"), ("eval_count", "eval")):
+        if stats.get(key):
+            timer.add_tokens(kind, int(stats[key]))
+
+def render_metrics(gauges: List[Tuple[str, str, str, float]]) -> str:
+    """Prometheus text exposition of every histogram and counter, plus (name, type, help, value) `gauges`."""
+    t0 = time.perf_counter()
+    out: List[str] = []
+    for family in (request_seconds, stage_seconds, ollama_tokens):
+        family.render(out)
+    for name, kind, help_text, value in gauges:
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        out.append(f"{name} {_sample_text(value)}")
+    metrics_overhead.inc(time.perf_counter() - t0, "render")
+    metrics_overhead.render(out)
+    return "\n".join(out) + "\n"
+
+# -------------- Index cache --------------
+def _atomic_write(path: str, data: bytes):
+    """Write via a temp file + rename so readers never see a partial file."""
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+class IndexCache:
+    """
+    Versioned on-disk cache for StudyPackIndex.
+
+    Layout under <root>/v<version>/:
+      files.json          path -> {size, mtime_ns, sha256}
+      text/<sha256>.txt   extracted text (pages separated by \\f), keyed by content hash
+      packs/<key>/        chunks.json, vocab.json, counts.npz (raw term counts over
+                          the pack's own vocabulary) for one pack, keyed by the
+                          (path, sha256) list of its files
+    """
+
+    def __init__(self, root: str, version: int = INDEX_CACHE_VERSION):
+        self.dir = os.path.join(root, f"v{version}")
+        self.text_dir = os.path.join(self.dir, "text")
+        self.packs_dir = os.path.join(self.dir, "packs")
+        # Raises OSError if the directory can't be created; StudyPackIndex then runs uncached.
+        os.makedirs(self.text_dir, exist_ok=True)
+        os.makedirs(self.packs_dir, exist_ok=True)
+        self._manifest_path = os.path.join(self.dir, "files.json")
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(self._manifest_path, "r", encoding="utf-8") as f:
+                self.files: Dict[str, Dict] = json.load(f)
+        except (OSError, ValueError):
+            self.files = {}
+
+    def file_hash(self, path: str) -> str:
+        """Content hash of a file; only re-read when its size or mtime changed."""
+        st = os.stat(path)
+        entry = self.files.get(path)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["sha256"]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        with self._lock:
+            self.files[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+            self._dirty = True
+        return digest
+
+    def load_text(self, digest: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self.text_dir, f"{digest}.txt"), "r", encoding="utf-8") as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def save_text(self, digest: str, text: str):
+        try:
+            _atomic_write(os.path.join(self.text_dir, f"{digest}.txt"), text.encode("utf-8"))
+        except OSError as e:
+            print(f"[index-cache] could not save text {digest[:12]}: {e}")
+
+    @staticmethod
+    def pack_key(files: List[Tuple[str, str]], params: Dict) -> str:
+        blob = json.dumps({"files": sorted(files), "params": params}, sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def load_pack(self, key: str) -> Optional[Tuple]:
+        """
+        Returns (chunks, files, chunk meta, pack vocabulary terms, term counts),
+        or None on a miss or a damaged entry.
+        """
+        d = os.path.join(self.packs_dir, key)
+        try:
+            with open(os.path.join(d, "chunks.json"), "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            with open(os.path.join(d, "vocab.json"), "r", encoding="utf-8") as f:
+                terms = json.load(f)
+            with np.load(os.path.join(d, "counts.npz")) as z:
+                counts = sparse.csr_matrix((z["data"], z["indices"], z["indptr"]), shape=tuple(z["shape"]))
+                meta = z["meta"]
+            return stored["chunks"], stored["files"], meta, terms, counts
+        except Exception:
+            # Missing, truncated or corrupt entry (BadZipFile, EOFError, ...): rebuild it.
+            return None
+
+    def save_pack(self, key: str, chunks: List[str], files: List[str], meta: np.ndarray,
+                  terms: List[str], counts):
+        d = os.path.join(self.packs_dir, key)
+        counts = sparse.csr_matrix(counts)
+        try:
+            os.makedirs(d, exist_ok=True)
+            # counts.npz is written last: its presence marks a complete entry.
+            _atomic_write(os.path.join(d, "chunks.json"),
+                          json.dumps({"chunks": chunks, "files": files}).encode("utf-8"))
+            _atomic_write(os.path.join(d, "vocab.json"), json.dumps(terms).encode("utf-8"))
+            tmp = os.path.join(d, f"counts.npz.tmp{os.getpid()}")
+            with open(tmp, "wb") as f:
+                np.savez(f, data=counts.data, indices=counts.indices, indptr=counts.indptr,
+                         shape=np.array(counts.shape), meta=meta)
+            os.replace(tmp, os.path.join(d, "counts.npz"))
+        except OSError as e:
+            print(f"[index-cache] could not save pack {key[:12]}: {e}")
+
+    def prune(self, keep_packs: set, keep_texts: set):
+        """Drop every pack entry and extracted text not in the keep sets."""
+        try:
+            for name in os.listdir(self.packs_dir):
+                if name not in keep_packs:
+                    shutil.rmtree(os.path.join(self.packs_dir, name), ignore_errors=True)
+            for name in os.listdir(self.text_dir):
+                if name.endswith(".txt") and name[:-4] not in keep_texts:
+                    try:
+                        os.remove(os.path.join(self.text_dir, name))
+                    except OSError:
+                        pass
+        except OSError as e:
+            print(f"[index-cache] prune failed: {e}")
+        with self._lock:
+            stale = [p for p, e in self.files.items() if e["sha256"] not in keep_texts]
+            for p in stale:
+                del self.files[p]
+            self._dirty = self._dirty or bool(stale)
+
+    def discard(self, pack_keys: set, text_digests: set):
+        """Delete specific superseded entries; safe while other packs are still unbuilt."""
+        for key in pack_keys:
+            shutil.rmtree(os.path.join(self.packs_dir, key), ignore_errors=True)
+        for digest in text_digests:
+            try:
+                os.remove(os.path.join(self.text_dir, f"{digest}.txt"))
+            except OSError:
+                pass
+        with self._lock:
+            stale = [p for p, e in self.files.items() if e["sha256"] in text_digests]
+            for p in stale:
+                del self.files[p]
+            self._dirty = self._dirty or bool(stale)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self.files).encode("utf-8")
+            self._dirty = False
+        try:
+            _atomic_write(self._manifest_path, data)
+        except OSError as e:
+            print(f"[index-cache] could not save manifest: {e}")
 
 # -------------- PDF indexing --------------
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+_PAGE_BREAK = "\f"  # separates pages in cached extracted text
+
+_extraction_pool: Optional[ProcessPoolExecutor] = None
+_extraction_pool_lock = threading.Lock()
+
+def _get_extraction_pool() -> Optional[ProcessPoolExecutor]:
+    """The shared extraction pool, started on first use and kept for every later build/reindex."""
+    global _extraction_pool
+    if INDEX_WORKERS <= 1:
+        return None
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            # spawn, not fork: reindex runs alongside Flask's request threads.
+            _extraction_pool = ProcessPoolExecutor(max_workers=INDEX_WORKERS,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+        return _extraction_pool
+
+def _reset_extraction_pool():
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is not None:
+            _extraction_pool.shutdown(wait=False, cancel_futures=True)
+            _extraction_pool = None
+
+# Columns of PackIndex.meta (one int32 row per chunk). Pages are 1-based and
+# inclusive; char offsets index the file's extracted text (pages joined by "\n").
+META_FILE, META_PAGE_START, META_PAGE_END, META_CHAR_START, META_CHAR_END = range(5)
+
+def _vocab_bytes(vocab) -> int:
+    """Approximate bytes held by a term -> column dict: hash table, keys and values."""
+    if not isinstance(vocab, dict):
+        vocab = {t: i for i, t in enumerate(vocab)}
+    return sys.getsizeof(vocab) + sum(sys.getsizeof(t) + sys.getsizeof(i) for t, i in vocab.items())
+
+class PackIndex:
+    """
+    Read-only chunks and chunk sources for one pack; its term counts live in
+    the shared CorpusIndex matrix. Replaced as a whole, never mutated once published.
+    """
+    __slots__ = ("name", "chunks", "files", "meta", "vocab_bytes", "terms", "counts")
+
+    def __init__(self, name: str, chunks: List[str], files: List[str], meta: np.ndarray,
+                 terms: List[str], counts):
+        self.name = name
+        self.chunks = chunks
+        self.files = files  # file names, indexed by meta[:, META_FILE]
+        self.meta = meta
+        # What a vocabulary dict of this pack's own would take (for memory_report()).
+        self.vocab_bytes = _vocab_bytes(terms)
+        # The pack's own terms and counts over them, until it is merged into the corpus.
+        self.terms = terms
+        self.counts = counts
+
+    def source(self, i: int) -> Dict:
+        row = self.meta[i]
+        return {
+            "pack": self.name,
+            "chunk": int(i),
+            "file": self.files[row[META_FILE]],
+            "pages": [int(row[META_PAGE_START]), int(row[META_PAGE_END])],
+            "chars": [int(row[META_CHAR_START]), int(row[META_CHAR_END])],
+        }
+
+class CorpusIndex:
+    """
+    Read-only retrieval state for every built pack: one vocabulary shared by all
+    packs, one term-count matrix whose rows are all packs' chunks (pack by pack,
+    in listing order), the pack id of each row, and corpus-wide idf and row norms.
+    Rebuilt and swapped as a whole whenever a pack is added, rebuilt or removed.
+
+    Rows hold raw counts; the idf weighting is folded into the query instead,
+    so a rebuild never has to re-weight rows of packs that didn't change.
+    """
+    __slots__ = ("packs", "names", "ranges", "pack_ids", "vocab", "counts", "idf", "inv_norms",
+                 "generation")
+
+    def __init__(self, packs: Dict[str, PackIndex], names: List[str], vocab: Dict[str, int],
+                 counts, idf: np.ndarray, inv_norms: np.ndarray, generation: int = 0):
+        self.generation = generation  # +1 per swap; tags cached retrieval results
+        self.packs = packs
+        self.names = names
+        self.ranges: Dict[str, Tuple[int, int]] = {}
+        start = 0
+        for n in names:
+            self.ranges[n] = (start, start + len(packs[n].chunks))
+            start = self.ranges[n][1]
+        self.pack_ids = np.repeat(np.arange(len(names), dtype=np.int32),
+                                  [len(packs[n].chunks) for n in names])
+        # Append-only and shared with later snapshots until it is compacted;
+        # ids at or past counts.shape[1] belong to a newer snapshot.
+        self.vocab = vocab
+        self.counts = counts
+        self.idf = idf
+        self.inv_norms = inv_norms
+
+    @classmethod
+    def empty(cls) -> "CorpusIndex":
+        return cls({}, [], {}, sparse.csr_matrix((0, 0), dtype=np.float32),
+                   np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32))
+
+    def row_mask(self, names: List[str]) -> np.ndarray:
+        ids = [i for i, n in enumerate(self.names) if n in names]
+        return np.isin(self.pack_ids, ids)
+
+    def hit(self, row: int) -> Tuple[str, Dict]:
+        pack = self.packs[self.names[self.pack_ids[row]]]
+        i = row - self.ranges[pack.name][0]
+        return pack.chunks[i], pack.source(i)
+
+class RetrievalCache:
+    """
+    Thread-safe LRU of retrieval results. Entries belong to one corpus
+    generation: clear() moves the cache to a new one, and results computed
+    against an older snapshot are neither returned nor stored.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._data: "OrderedDict[Tuple, List]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, generation: int, key: Tuple) -> Optional[List]:
+        with self._lock:
+            if generation == self._generation and key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, generation: int, key: Tuple, value: List):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def clear(self, generation: int):
+        with self._lock:
+            self._data.clear()
+            self._generation = generation
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._data), "capacity": self.capacity, "hits": self.hits,
+                    "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else None}
+
 class StudyPackIndex:
-    def __init__(self):
+    MAX_FEATURES = 30000
+    EXTS = (".pdf", ".txt", ".md")
+
+    def __init__(self, cache_dir: Optional[str] = None, retrieval_cache_size: int = RETRIEVAL_CACHE_SIZE):
         self.pack_names: List[str] = []
-        self.docs_by_pack: Dict[str, List[str]] = {}  # pack -> list of chunks
-        self.vectorizers: Dict[str, TfidfVectorizer] = {}
-        self.tfidf_mats = {}  # pack -> tf-idf matrix
+        self.base_dir: Optional[str] = None
+        # All built packs. Swapped as a whole, never edited in place, so a
+        # reader that grabbed it keeps a consistent view.
+        self._corpus = CorpusIndex.empty()
+        # Same tokenization as the build-time CountVectorizer, for queries.
+        self._analyzer = self._new_vectorizer().build_analyzer()
+        self.retrieval_cache: Optional[RetrievalCache] = (
+            RetrievalCache(retrieval_cache_size) if retrieval_cache_size > 0 else None)
+        # pack -> (path, size, mtime_ns) tuples the pack was last built from
+        self._signatures: Dict[str, Tuple] = {}
+        # Lazy state: packs found on disk but not built yet, and their status
+        self.lazy = False
+        self._order: List[str] = []  # listing order from the last scan
+        self._pending: Dict[str, List[str]] = {}  # pack -> files, not built yet
+        self._states: Dict[str, str] = {}  # pack -> pending | building | ready | empty | failed
+        self._building: Dict[str, threading.Event] = {}
+        self._failed: Dict[str, Tuple] = {}  # pack -> signature its failed build used
+        self._lock = threading.RLock()
+        self._reindex_lock = threading.Lock()
+        self.last_reindex: Optional[Dict] = None
+        self.build_report: Dict[str, Dict] = {}  # pack -> timings of its last build
+        self.cache: Optional[IndexCache] = None
+        if cache_dir:
+            try:
+                self.cache = IndexCache(cache_dir)
+            except OSError as e:
+                # The cache only saves time; never let it stop the app from starting.
+                print(f"[index-cache] disabled, cannot use {cache_dir}: {e}")
+        # pack -> (cache pack key, text digests) its current build uses
+        self._cache_refs: Dict[str, Tuple[Optional[str], set]] = {}
+
+    @property
+    def docs_by_pack(self) -> Dict[str, List[str]]:
+        return {n: p.chunks for n, p in self._corpus.packs.items()}
+
+    @property
+    def vocabulary(self) -> Dict[str, int]:
+        return self._corpus.vocab
+
+    @property
+    def count_matrix(self):
+        return self._corpus.counts
 
     @staticmethod
     def _read_text(filepath: str) -> str:
@@ -68,389 +921,2688 @@ class StudyPackIndex:
             return ""
 
     @staticmethod
-    def _read_pdf(filepath: str) -> str:
-        text = []
-        with open(filepath, "rb") as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                try:
-                    text.append(page.extract_text() or "")
-                except Exception:
-                    text.append("")
-        return "\n".join(text)
+    def _split_spans(text: str, start: int, end: int, pattern) -> List[Tuple[int, int]]:
+        """Whitespace-trimmed (start, end) spans of text[start:end] between `pattern` matches."""
+        spans, pos = [], start
+        for m in pattern.finditer(text, start, end):
+            spans.append((pos, m.start()))
+            pos = m.end()
+        spans.append((pos, end))
+        out = []
+        for a, b in spans:
+            while a < b and text[a].isspace():
+                a += 1
+            while b > a and text[b - 1].isspace():
+                b -= 1
+            if b > a:
+                out.append((a, b))
+        return out
+
+    @classmethod
+    def _text_units(cls, text: str, max_chars: int) -> List[Tuple[int, int]]:
+        """
+        Paragraph spans, with paragraphs longer than max_chars broken into
+        sentences and over-long sentences broken at the last space that fits.
+        """
+        units = []
+        for pa, pb in cls._split_spans(text, 0, len(text), _PARAGRAPH_BREAK):
+            if pb - pa <= max_chars:
+                units.append((pa, pb))
+                continue
+            for sa, sb in cls._split_spans(text, pa, pb, _SENTENCE_BREAK):
+                while sb - sa > max_chars:
+                    cut = max(text.rfind(" ", sa, sa + max_chars), text.rfind("\n", sa, sa + max_chars))
+                    if cut <= sa:
+                        cut = sa + max_chars
+                    units.append((sa, cut))
+                    sa = cut
+                    while sa < sb and text[sa].isspace():
+                        sa += 1
+                if sb > sa:
+                    units.append((sa, sb))
+        return units
+
+    @classmethod
+    def _chunk_spans(cls, text: str, max_chars: int = CHUNK_CHARS,
+                     overlap: int = CHUNK_OVERLAP) -> List[Tuple[int, int]]:
+        """
+        Greedily pack units into chunks of at most max_chars. Each chunk after the
+        first starts with the previous chunk's trailing units that fit in
+        `overlap` chars, and always adds at least one new unit.
+        """
+        units = cls._text_units(text, max_chars)
+        chunks: List[Tuple[int, int]] = []
+        i = nxt = 0
+        while nxt < len(units):
+            # Drop overlap that would leave no room for new text.
+            while i < nxt and units[nxt][1] - units[i][0] > max_chars:
+                i += 1
+            j = nxt
+            while j + 1 < len(units) and units[j + 1][1] - units[i][0] <= max_chars:
+                j += 1
+            chunks.append((units[i][0], units[j][1]))
+            start, nxt = i, j + 1
+            i = nxt
+            while i - 1 > start and units[j][1] - units[i - 1][0] <= overlap:
+                i -= 1
+        return chunks
+
+    @classmethod
+    def _chunk_pages(cls, pages: List[str]) -> Tuple[List[str], List[Tuple[int, int, int, int]]]:
+        """Chunks of one file plus (first page, last page, char start, char end) for each."""
+        text = "\n".join(pages)
+        page_starts, pos = [], 0
+        for page in pages:
+            page_starts.append(pos)
+            pos += len(page) + 1
+        chunks, meta = [], []
+        for a, b in cls._chunk_spans(text):
+            chunks.append(text[a:b])
+            meta.append((bisect.bisect_right(page_starts, a), bisect.bisect_right(page_starts, b - 1), a, b))
+        return chunks, meta
 
     @staticmethod
-    def _chunk_text(text: str, max_chars: int = 1800) -> List[str]:
-        chunks, i = [], 0
-        while i < len(text):
-            j = min(len(text), i + max_chars)
-            chunks.append(text[i:j])
-            i = j
-        return [c.strip() for c in chunks if c.strip()]
-
-    def _index_pack(self, pack_name: str, paths: List[str]):
-        all_chunks = []
+    def _new_vectorizer() -> CountVectorizer:
+        return CountVectorizer(stop_words="english", max_features=StudyPackIndex.MAX_FEATURES,
+                               dtype=np.float32)
+
+    @staticmethod
+    def _pdf_pages_pooled(pool: ProcessPoolExecutor, pdfs: List[str]) -> Dict[str, Tuple[List[str], float, int]]:
+        """
+        Extract PDFs on the pool. Each file's first task also reports its page
+        count, and the remaining page ranges are queued as soon as it returns,
+        so no file is parsed up front in this process.
+        """
+        first = {pool.submit(pdf_extract.extract_pages, p, 0, PDF_PAGES_PER_TASK): p for p in pdfs}
+        parts: Dict[str, List] = {p: [] for p in pdfs}
+        for fut in as_completed(first):
+            p = first[fut]
+            pages, n_pages, secs = fut.result()
+            parts[p].append((0, pages, secs))
+            for start in range(PDF_PAGES_PER_TASK, n_pages, PDF_PAGES_PER_TASK):
+                parts[p].append((start, pool.submit(pdf_extract.extract_pages, p, start,
+                                                    start + PDF_PAGES_PER_TASK)))
+        out = {}
+        for p in pdfs:
+            # Merge in page order, whatever order the workers finished in.
+            file_pages, cpu = [], 0.0
+            for part in sorted(parts[p], key=lambda x: x[0]):
+                if len(part) == 3:
+                    pages, secs = part[1], part[2]
+                else:
+                    pages, _, secs = part[1].result()
+                file_pages.extend(pages)
+                cpu += secs
+            out[p] = (file_pages, cpu, len(parts[p]))
+        return out
+
+    def _extract_files(self, paths: List[str], digests: Dict[str, Optional[str]],
+                       report: Dict) -> Dict[str, List[str]]:
+        """Extract every file's pages (one page for .txt/.md), going through the text cache when enabled."""
+        texts: Dict[str, List[str]] = {}
+        todo = []
         for p in paths:
+            if digests[p] is not None:
+                txt = self.cache.load_text(digests[p])
+                if txt is not None:
+                    texts[p] = txt.split(_PAGE_BREAK)
+                    continue
+            todo.append(p)
+
+        t0 = time.perf_counter()
+        pdfs = [p for p in todo if p.lower().endswith(".pdf")]
+        pdf_bytes = sum(os.path.getsize(p) for p in pdfs)
+        pool = _get_extraction_pool() if pdfs and pdf_bytes >= PDF_POOL_MIN_BYTES else None
+        results: Dict[str, Tuple[List[str], float, int]] = {}
+        if pool is not None:
+            try:
+                results = self._pdf_pages_pooled(pool, pdfs)
+            except BrokenProcessPool:
+                print("[index] extraction pool died; extracting in-process")
+                _reset_extraction_pool()
+                pool, results = None, {}
+
+        for p in todo:
             if p.lower().endswith(".pdf"):
-                txt = self._read_pdf(p)
+                if p not in results:
+                    pages, _, secs = pdf_extract.extract_pages(p)
+                    results[p] = (pages, secs, 1)
+                texts[p] = [page.replace(_PAGE_BREAK, " ") for page in results[p][0]]
             else:
-                txt = self._read_text(p)  # .txt or .md
-            chunks = self._chunk_text(txt)
+                texts[p] = self._read_text(p).split(_PAGE_BREAK)  # .txt or .md
+            if digests[p] is not None:
+                self.cache.save_text(digests[p], _PAGE_BREAK.join(texts[p]))
+
+        wall = time.perf_counter() - t0
+        cpu = sum(r[1] for r in results.values())
+        report.update({
+            "extracted_files": len(todo),
+            "pdf_pages": sum(len(r[0]) for r in results.values()),
+            "tasks": sum(r[2] for r in results.values()),
+            "workers": INDEX_WORKERS if pool is not None else 1,
+            "extract_wall_s": round(wall, 3),
+            "extract_cpu_s": round(cpu, 3),
+            # PDF CPU seconds per wall second: ~1.0 in-process, up to `workers` on the pool.
+            # extract_cpu_s is roughly what a serial run would take.
+            "parallelism": round(cpu / wall, 2) if wall > 0 and pdfs else None,
+        })
+        return texts
+
+    def _build_pack(self, pack_name: str, paths: List[str], refs: Dict) -> Optional[PackIndex]:
+        t0 = time.perf_counter()
+        paths = sorted(paths)
+        report = {"files": len(paths), "cached": False}
+        digests: Dict[str, Optional[str]] = {p: None for p in paths}
+        key = None
+        if self.cache is not None:
+            digests = {p: self.cache.file_hash(p) for p in paths}
+            key = self.cache.pack_key(list(digests.items()), {"chunk_chars": CHUNK_CHARS,
+                                                                 "chunk_overlap": CHUNK_OVERLAP,
+                                                                 "max_features": self.MAX_FEATURES})
+            refs["key"] = key
+            refs["texts"] = set(digests.values())
+            cached = self.cache.load_pack(key)
+            if cached is not None:
+                all_chunks, files, meta, terms, counts = cached
+                report.update(cached=True, total_s=round(time.perf_counter() - t0, 3))
+                self.build_report[pack_name] = report
+                return PackIndex(pack_name, all_chunks, files, meta, terms, counts)
+
+        texts = self._extract_files(paths, digests, report)
+        files = [os.path.basename(p) for p in paths]
+        all_chunks, rows = [], []
+        for fi, p in enumerate(paths):
+            chunks, spans = self._chunk_pages(texts[p])
             all_chunks.extend(chunks)
+            rows.extend((fi,) + span for span in spans)
+        meta = np.array(rows, dtype=np.int32).reshape(-1, 5)
 
+        self.build_report[pack_name] = report
         if not all_chunks:
-            return
+            return None
 
-        vec = TfidfVectorizer(stop_words="english", max_features=30000)
-        mat = vec.fit_transform(all_chunks)
+        t_vec = time.perf_counter()
+        vec = self._new_vectorizer()
+        counts = vec.fit_transform(all_chunks)
+        terms = vec.get_feature_names_out().tolist()
+        report["vectorize_s"] = round(time.perf_counter() - t_vec, 3)
+        if key is not None:
+            self.cache.save_pack(key, all_chunks, files, meta, terms, counts)
+        report["total_s"] = round(time.perf_counter() - t0, 3)
+        return PackIndex(pack_name, all_chunks, files, meta, terms, counts)
 
-        self.pack_names.append(pack_name)
-        self.docs_by_pack[pack_name] = all_chunks
-        self.vectorizers[pack_name] = vec
-        self.tfidf_mats[pack_name] = mat
+    def report_lines(self, packs: Optional[List[str]] = None) -> List[str]:
+        """Human-readable per-pack build timings from the last build/reindex."""
+        lines = []
+        for name in packs if packs is not None else list(self.build_report):
+            r = self.build_report.get(name)
+            if not r:
+                continue
+            if r.get("cached"):
+                lines.append(f"  {name}: {r['files']} files from cache in {r['total_s']}s")
+                continue
+            line = (f"  {name}: {r['files']} files ({r['extracted_files']} extracted, "
+                    f"{r['pdf_pages']} PDF pages in {r['tasks']} tasks) "
+                    f"extract {r['extract_wall_s']}s wall / {r['extract_cpu_s']}s cpu")
+            if r.get("parallelism"):
+                line += f" ({r['parallelism']}x parallel on {r['workers']} worker(s))"
+            line += f", vectorize {r.get('vectorize_s', 0)}s, total {r.get('total_s', 0)}s"
+            lines.append(line)
+        return lines
 
-    def build_from_folder(self, base_dir: str):
+    @classmethod
+    def scan_folder(cls, base_dir: str) -> Dict[str, List[str]]:
+        """pack name -> files, in the order packs are listed to clients."""
+        packs: Dict[str, List[str]] = {}
         if not os.path.isdir(base_dir):
-            return
+            return packs
 
         subfolders = [d for d in os.listdir(base_dir)
                       if os.path.isdir(os.path.join(base_dir, d))]
 
-        exts = (".pdf", ".txt", ".md")
-
-        # Index subfolders
+        # Subfolders become packs
         for folder in subfolders:
             folder_path = os.path.join(base_dir, folder)
             files = [os.path.join(folder_path, f)
                      for f in os.listdir(folder_path)
-                     if f.lower().endswith(exts)]
+                     if f.lower().endswith(cls.EXTS)]
             if files:
-                self._index_pack(folder, files)
+                packs[folder] = files
 
         # Root-level files -> "General"
         root_files = [os.path.join(base_dir, f)
                       for f in os.listdir(base_dir)
-                      if f.lower().endswith(exts)]
+                      if f.lower().endswith(cls.EXTS)]
         if root_files:
-            self._index_pack("General", root_files)
-
-    def retrieve(self, pack_name: str, query: str, top_k: int = TOP_K_CHUNKS) -> List[Tuple[str, float]]:
-        if pack_name not in self.vectorizers:
-            return []
-        vec = self.vectorizers[pack_name]
-        mat = self.tfidf_mats[pack_name]
-        qv = vec.transform([query])
-        sims = cosine_similarity(qv, mat).ravel()
-        if sims.size == 0:
-            return []
-        idxs = sims.argsort()[::-1][:top_k]
-        chunks = self.docs_by_pack[pack_name]
-        return [(chunks[i], float(sims[i])) for i in idxs]
-
-index = StudyPackIndex()
-index.build_from_folder(STUDY_PACK_DIR)
+            packs["General"] = root_files
+        return packs
 
-# -------------- Flask --------------
-app = Flask(__name__)
+    @staticmethod
+    def _signature(paths: List[str]) -> Tuple:
+        sig = []
+        for p in sorted(paths):
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            sig.append((p, st.st_size, st.st_mtime_ns))
+        return tuple(sig)
 
-def _ollama_chat_request(payload: Dict) -> Dict:
-    """POST to Ollama with retries and clear errors."""
-    url = f"{OLLAMA_HOST}/api/chat"
-    last_err = None
-    for attempt in range(MAX_RETRIES + 1):
-        try:
-            r = requests.post(
-                url, json=payload,
-                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
-            )
-            r.raise_for_status()
-            data = r.json()
-            # Some Ollama errors come back inside JSON
-            if "error" in data and data["error"]:
-                return {"_error": f"Ollama error: {data['error']}"}
-            return data
-        except requests.RequestException as e:
-            last_err = e
-            if attempt < MAX_RETRIES:
-                time.sleep(RETRY_BACKOFF * (attempt + 1))
-            else:
-                return {"_error": f"Ollama request failed: {e}"}
-    return {"_error": f"Ollama request failed: {last_err}"}
+    def _refresh_names(self):
+        self.pack_names = [n for n in self._order if n in self._corpus.packs or n in self._pending]
 
-def call_ollama_chat(messages: List[Dict], temperature: float, max_tokens: int) -> str:
-    """
-    Use Ollama's /api/chat endpoint to interact with the local gpt-oss model.
-    We keep generations short by default to reduce timeouts.
-    """
-    payload = {
-        "model": OLLAMA_MODEL,
-        "messages": messages,
-        "options": {
-            "num_predict": max_tokens,
-            "temperature": temperature,
-            "top_p": 0.9,
-            "top_k": 40,
-            "repeat_penalty": 1.1,
-            # You can tune num_ctx if needed:
-            # "num_ctx": 4096,
-        },
-        "stream": False
-    }
-    data = _ollama_chat_request(payload)
-    if "_error" in data:
-        raise requests.RequestException(data["_error"])
-    return data.get("message", {}).get("content", "")
-
-def call_ollama_chat_stream(messages, temperature=1.0, max_tokens=512):
-    """Stream tokens from Ollama as they generate. Yields text chunks."""
-    url = f"{OLLAMA_HOST}/api/chat"
-    payload = {
-        "model": OLLAMA_MODEL,
-        "messages": messages,
-        "options": {
-            "num_predict": max_tokens,
-            "temperature": temperature,
-        },
-        "stream": True
-    }
-    with requests.post(url, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True) as r:
-        r.raise_for_status()
-        for line in r.iter_lines(decode_unicode=True):
-            if not line:
+    def _build_changed(self, found: Dict[str, List[str]], only_changed: bool) -> Tuple[Dict, Dict, Dict, Dict]:
+        """
+        Build every pack in `found` (or only those whose signature changed).
+        Returns (built, new_sigs, new_refs, failed). A pack whose build raises is
+        left out of `built`, so it keeps its old index and old signature and is
+        retried on the next scan.
+        """
+        built: Dict[str, Optional[PackIndex]] = {}
+        new_sigs: Dict[str, Tuple] = {}
+        new_refs: Dict[str, Tuple] = {}
+        failed: Dict[str, str] = {}
+        for name, files in found.items():
+            # Signature first: a file changed mid-build is then seen as changed next scan.
+            sig = self._signature(files)
+            if only_changed and self._signatures.get(name) == sig:
                 continue
+            refs: Dict = {}
             try:
-                obj = json.loads(line)
-                chunk = obj.get("message", {}).get("content", "")
-                if chunk:
-                    yield chunk
-            except Exception:
+                built[name] = self._build_pack(name, files, refs)
+            except Exception as e:
+                failed[name] = f"{type(e).__name__}: {e}"
+                print(f"[index] pack {name!r} failed to build, keeping previous index: {failed[name]}")
                 continue
+            new_sigs[name] = sig
+            new_refs[name] = (refs.get("key"), refs.get("texts", set()))
+        return built, new_sigs, new_refs, failed
 
-@app.route("/ask_stream", methods=["POST"])
-def ask_stream():
-    data = request.get_json(force=True)
-    question = data.get("question", "").strip()
-    pack = data.get("pack")
-    reading_level = data.get("reading_level")
-    bilingual_lang = data.get("bilingual_lang")
-    max_tokens = int(data.get("max_tokens") or 300)
+    def _commit(self, built: Dict, new_sigs: Dict, new_refs: Dict, removed: List[str]):
+        """
+        Publish built packs together with their signatures in one corpus swap
+        (a None pack means it produced no chunks), drop removed packs, then
+        delete the cache entries they no longer use.
+        """
+        with self._lock:
+            # A pack removed by a reindex while it was building stays removed.
+            built = {n: p for n, p in built.items() if n in self._pending or n in self._signatures}
+            old_refs = [self._cache_refs[n] for n in list(built) + removed if n in self._cache_refs]
+            packs = dict(self._corpus.packs)
+            for name, pack in built.items():
+                if pack is None:
+                    packs.pop(name, None)
+                else:
+                    packs[name] = pack
+                self._states[name] = "ready" if pack is not None else "empty"
+                self._pending.pop(name, None)
+                self._failed.pop(name, None)
+                self._signatures[name] = new_sigs[name]
+                self._cache_refs[name] = new_refs[name]
+            for name in removed:
+                packs.pop(name, None)
+                for d in (self._signatures, self._cache_refs, self._pending, self._states, self._failed):
+                    d.pop(name, None)
+            self._corpus = self._build_corpus(packs, {n: p for n, p in built.items() if p is not None})
+            # idf is corpus-wide, so any swap can change any cached ranking.
+            if self.retrieval_cache is not None:
+                self.retrieval_cache.clear(self._corpus.generation)
+            self._refresh_names()
+            live_keys, live_texts = self._live_cache_refs()
+        if self.cache is not None:
+            stale_keys = {key for key, _ in old_refs if key and key not in live_keys}
+            stale_texts = set()
+            for _, texts in old_refs:
+                stale_texts |= texts - live_texts
+            self.cache.discard(stale_keys, stale_texts)
+            self.cache.flush()
 
-    reason = violates_safety(question)
-    if reason:
-        return jsonify({"error": f"Blocked by safety guardrails: {reason}"}), 400
+    def _build_corpus(self, packs: Dict[str, PackIndex], new: Dict[str, PackIndex]) -> CorpusIndex:
+        """
+        The next corpus snapshot (called under _lock). Rows of unchanged packs are
+        copied from the current snapshot, `new` packs' counts are moved into shared
+        vocabulary columns, and idf and row norms are recomputed corpus-wide.
+        """
+        old = self._corpus
+        vocab = old.vocab
+        moved = {}
+        for name, pack in new.items():
+            # setdefault appends unseen terms; readers of older snapshots ignore ids past their width.
+            cols = np.fromiter((vocab.setdefault(t, len(vocab)) for t in pack.terms),
+                               dtype=np.int32, count=len(pack.terms))
+            c = sparse.csr_matrix(pack.counts)
+            moved[name] = (c.data, cols[c.indices], c.indptr)
+            pack.terms = pack.counts = None
+        n_terms = len(vocab)
 
-    system_msg = build_system_prompt(reading_level, bilingual_lang)
-    context_chunks = [c for c, _ in index.retrieve(pack, question, top_k=TOP_K_CHUNKS)] if pack else []
-    content_directive = rag_instructions(context_chunks)
+        names = [n for n in self._order if n in packs] + sorted(n for n in packs if n not in self._order)
+        parts = []
+        for name in names:
+            if name in moved:
+                data, indices, indptr = moved[name]
+            else:
+                a, b = old.ranges[name]
+                c = old.counts[a:b]
+                data, indices, indptr = c.data, c.indices, c.indptr
+            parts.append(sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, n_terms)))
+        if parts:
+            counts = sparse.vstack(parts, format="csr")
+            counts.has_sorted_indices = False
+            counts.sort_indices()
+        else:
+            counts = sparse.csr_matrix((0, n_terms), dtype=np.float32)
 
-    messages = [
-        {"role": "system", "content": system_msg},
-        {"role": "user", "content": f"{content_directive}\n\nUser question: {question}"},
-    ]
+        df = np.bincount(counts.indices, minlength=n_terms)
+        live = np.flatnonzero(df)
+        if n_terms - live.size > max(live.size, 10000):
+            # Mostly terms of removed or rebuilt packs: renumber into a fresh dict.
+            remap = np.full(n_terms, -1, dtype=np.int32)
+            remap[live] = np.arange(live.size, dtype=np.int32)
+            vocab = {t: int(remap[i]) for t, i in vocab.items() if remap[i] >= 0}
+            counts = sparse.csr_matrix((counts.data, remap[counts.indices], counts.indptr),
+                                       shape=(counts.shape[0], live.size))
+            df = df[live]
+            print(f"[index] compacted shared vocabulary: {n_terms} -> {live.size} terms")
 
-    def generate():
-        try:
-            for chunk in call_ollama_chat_stream(messages, temperature=0.7, max_tokens=max_tokens):
-                yield chunk
-        except requests.RequestException as e:
-            yield f"\n\n[Error] Ollama request failed: {e}"
-
-    return Response(generate(), mimetype="text/plain")
-
-def build_system_prompt(reading_level: Optional[str], bilingual_lang: Optional[str]) -> str:
-    base = [
-        "You are an offline Educational Tutor.",
-        "Be clear, concise, step-by-step.",
-        "Use safe, age-appropriate language.",
-        "Respond in clean **Markdown** with short sections, headings, and bullet lists.",
-        "Use line breaks; avoid giant single paragraphs.",                                 
-    ]
-    if reading_level:
-        base.append(f"Adjust explanations for a Grade {reading_level} reading level.")
-    if bilingual_lang and bilingual_lang.lower() != "english":
-        base.append(f"Provide bilingual output: first English, then the same content in {bilingual_lang}.")
-    return " ".join(base)
+        # Smoothed idf, as TfidfVectorizer computes it, over all packs' chunks.
+        # Terms no chunk uses any more get 0 so they don't weigh on queries.
+        idf = np.where(df > 0, np.log((1.0 + counts.shape[0]) / (1.0 + df)) + 1.0, 0.0).astype(np.float32)
+        norms = np.sqrt(counts.power(2) @ (idf * idf))
+        inv_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0).astype(np.float32)
+        return CorpusIndex(packs, names, vocab, counts, idf, inv_norms, generation=old.generation + 1)
 
-def rag_instructions(chunks: List[str]) -> str:
-    if not chunks:
-        return "Use general knowledge only."
-    joined = "\n\n".join([f"[Source {i+1}]\n{c}" for i, c in enumerate(chunks)])
-    return (
-        "Use ONLY the following study pack excerpts to answer. "
-        "If the answer is not contained here, say you don’t have that in the study pack.\n\n"
-        f"{joined}\n\n"
-        "Cite the source numbers you used (e.g., [Source 1], [Source 3])."
-    )
+    def memory_report(self) -> Dict:
+        """Sizes of the shared vocabulary and matrix, next to what one vocabulary dict per pack would take."""
+        with self._lock:
+            corpus = self._corpus
+            vocab_bytes = _vocab_bytes(corpus.vocab)
+        m = corpus.counts
+        per_pack = sum(p.vocab_bytes for p in corpus.packs.values())
+        return {
+            "packs": len(corpus.names),
+            "chunks": m.shape[0],
+            "terms": m.shape[1],
+            "nnz": int(m.nnz),
+            "matrix_bytes": int(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes),
+            "vocab_bytes": vocab_bytes,
+            "per_pack_vocab_bytes": per_pack,
+            "vocab_bytes_saved": per_pack - vocab_bytes,
+        }
 
-# -------- Health endpoint (useful for debugging) ----------
-@app.route("/health", methods=["GET"])
-def health():
-    return jsonify({"status": "ok", "packs": index.pack_names, "model": OLLAMA_MODEL})
+    def memory_line(self) -> str:
+        m = self.memory_report()
+        return (f"shared index: {m['packs']} packs, {m['chunks']} chunks, {m['terms']} terms; "
+                f"matrix {m['matrix_bytes'] / 1e6:.1f} MB, vocabulary {m['vocab_bytes'] / 1e6:.1f} MB "
+                f"(one dict per pack: {m['per_pack_vocab_bytes'] / 1e6:.1f} MB)")
 
-@app.route("/packs", methods=["GET"])
-def list_packs():
-    return jsonify({"packs": index.pack_names})
+    def _live_cache_refs(self) -> Tuple[set, set]:
+        keys = {key for key, _ in self._cache_refs.values() if key}
+        texts = set()
+        for _, t in self._cache_refs.values():
+            texts |= t
+        return keys, texts
 
-# ----- Tutor chat -----
-@app.route("/ask", methods=["POST"])
-def ask():
-    data = request.get_json(force=True)
-    question = data.get("question", "").strip()
-    pack = data.get("pack")
-    reading_level = data.get("reading_level")
-    bilingual_lang = data.get("bilingual_lang")
-    # from UI slider; fall back to 300
-    max_tokens = int(data.get("max_tokens") or 300)
+    def discover(self, base_dir: str):
+        """Record which packs exist and what files they hold; build them later, on demand."""
+        self.base_dir = base_dir
+        self.lazy = True
+        found = self.scan_folder(base_dir)
+        with self._lock:
+            self._order = list(found)
+            for name, files in found.items():
+                self._pending[name] = files
+                self._states[name] = "pending"
+            self._refresh_names()
 
-    reason = violates_safety(question)
-    if reason:
-        return jsonify({"error": f"Blocked by safety guardrails: {reason}"}), 400
+    def build_from_folder(self, base_dir: str):
+        self.discover(base_dir)
+        self.lazy = False
+        for name in list(self._order):
+            self.ensure_built(name)
+        self._prune_cache()
 
-    system_msg = build_system_prompt(reading_level, bilingual_lang)
-    context_chunks = []
-    if pack:
-        context_chunks = [c for c, _ in index.retrieve(pack, question, top_k=TOP_K_CHUNKS)]
-    content_directive = rag_instructions(context_chunks)
+    def _prune_cache(self):
+        """Full sweep of unreferenced cache entries; only safe once no pack is pending."""
+        if self.cache is None:
+            return
+        with self._lock:
+            if self._pending:
+                return
+            keep_packs, keep_texts = self._live_cache_refs()
+        self.cache.prune(keep_packs, keep_texts)
+        self.cache.flush()
 
-    messages = [
-        {"role": "system", "content": system_msg},
-        {"role": "user", "content": f"{content_directive}\n\nUser question: {question}"},
-    ]
+    def ensure_built(self, name: str):
+        """
+        Build a pending pack now. Concurrent callers for the same pack wait for
+        the one build in progress instead of starting their own.
+        """
+        with self._lock:
+            files = self._pending.get(name)
+            if files is None or self._states.get(name) == "failed":
+                return
+            event = self._building.get(name)
+            owner = event is None
+            if owner:
+                event = self._building[name] = threading.Event()
+                self._states[name] = "building"
+        if not owner:
+            event.wait()
+            return
+        try:
+            built, new_sigs, new_refs, failed = self._build_changed({name: files}, only_changed=False)
+            if failed:
+                with self._lock:
+                    if name in self._pending:
+                        self._states[name] = "failed"
+                        self._failed[name] = self._signature(files)
+            else:
+                self._commit(built, new_sigs, new_refs, [])
+        finally:
+            with self._lock:
+                self._building.pop(name, None)
+            event.set()
 
-    try:
-        answer = call_ollama_chat(messages, temperature=0.7, max_tokens=max_tokens)
-        return jsonify({"response": answer})
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 502
+    def warm_up(self, priority: List[str]):
+        """Build every pending pack, `priority` names first, then in listing order."""
+        names = [n for n in priority if n in self._order]
+        names += [n for n in self._order if n not in names]
+        for name in names:
+            if name not in self._pending:
+                continue
+            self.ensure_built(name)
+            for line in self.report_lines([name]):
+                print(f"[warm-up]{line}")
+        self._prune_cache()
+        print(f"[warm-up] {self.memory_line()}")
 
-# ----- Lesson generator -----
-@app.route("/generate_lesson", methods=["POST"])
-def generate_lesson():
-    data = request.get_json(force=True)
-    topic = data.get("topic", "").strip()
-    minutes = int(data.get("minutes", 20))
-    pack = data.get("pack")
-    reading_level = data.get("reading_level")
-    bilingual_lang = data.get("bilingual_lang")
-    max_tokens = int(data.get("max_tokens") or 600)
+    def pack_states(self) -> Dict[str, str]:
+        """pack -> pending | building | ready | failed, for every listed pack."""
+        return {n: self._states.get(n, "pending") for n in self.pack_names}
 
-    reason = violates_safety(topic)
-    if reason:
-        return jsonify({"error": f"Blocked by safety guardrails: {reason}"}), 400
+    def reindex(self) -> Dict:
+        """
+        Rebuild only built packs whose files were added, changed or removed since
+        the last build, then swap them in. New packs join as pending when the
+        index is lazy. Safe to call while requests are being served; concurrent
+        calls return immediately with {"busy": True}.
+        """
+        if self.base_dir is None:
+            return {"added": [], "updated": [], "removed": []}
+        if not self._reindex_lock.acquire(blocking=False):
+            return {"busy": True}
+        try:
+            t0 = time.time()
+            found = self.scan_folder(self.base_dir)
+            with self._lock:
+                self._order = list(found)
+                known = set(self._signatures) | set(self._pending)
+                new = [n for n in found if n not in known]
+                removed = [n for n in known if n not in found]
+                for name, files in found.items():
+                    if name in self._pending:
+                        self._pending[name] = files
+                        # A failed pack gets another chance once its files change.
+                        if self._states.get(name) == "failed" and self._failed.get(name) != self._signature(files):
+                            self._states[name] = "pending"
+                            self._failed.pop(name, None)
+                    elif name in new and self.lazy:
+                        self._pending[name] = files
+                        self._states[name] = "pending"
+                self._refresh_names()
+            rebuild = {n: f for n, f in found.items()
+                       if n in self._signatures or (n in new and not self.lazy)}
+            built, new_sigs, new_refs, failed = self._build_changed(rebuild, only_changed=True)
+            summary = {
+                "added": new,
+                "updated": [n for n in built if n not in new],
+                "removed": removed,
+            }
+            if failed:
+                summary["failed"] = failed
+            if built or removed:
+                self._commit(built, new_sigs, new_refs, removed)
+            summary["seconds"] = round(time.time() - t0, 3)
+            summary["timings"] = {n: self.build_report.get(n) for n in built if n in self.build_report}
+            self.last_reindex = dict(summary, finished_at=time.time())
+            return summary
+        finally:
+            self._reindex_lock.release()
 
-    system_msg = build_system_prompt(reading_level, bilingual_lang)
-    chunks = []
-    if pack:
-        chunks = [c for c, _ in index.retrieve(pack, topic, top_k=TOP_K_CHUNKS)]
+    def _ensure_packs(self, packs: Union[str, List[str], None]) -> List[str]:
+        """Pack names from a name or list of names, building any that are still pending."""
+        names = [packs] if isinstance(packs, str) else list(dict.fromkeys(packs or []))
+        for name in names:
+            if name not in self._corpus.packs and name in self._pending:
+                self.ensure_built(name)
+        return names
 
-    directive = rag_instructions(chunks)
-    prompt = (
-        f"{directive}\n\n"
-        f"Create a {minutes}-minute lesson plan on '{topic}'. "
-        "Include: Objectives, Hook, Mini-lesson steps, Guided practice, Independent practice, "
-        "Differentiation ideas, and an Exit Ticket. Keep it practical for a teacher."
-    )
+    @staticmethod
+    def _query_matrix(corpus: CorpusIndex, queries: List[List[str]]):
+        """
+        Queries as L2-normalized tf-idf rows, weighted by idf once more: the
+        product with the raw count rows, times each row's inverse tf-idf norm,
+        is then the cosine similarity with the chunk's tf-idf vector.
+        """
+        n_terms = corpus.counts.shape[1]
+        indptr, indices, data = [0], [], []
+        for tokens in queries:
+            tf: Dict[int, int] = {}
+            for tok in tokens:
+                j = corpus.vocab.get(tok)
+                if j is not None and j < n_terms:
+                    tf[j] = tf.get(j, 0) + 1
+            cols = np.fromiter(tf.keys(), dtype=np.int32, count=len(tf))
+            w = np.fromiter(tf.values(), dtype=np.float32, count=len(tf)) * corpus.idf[cols]
+            norm = np.linalg.norm(w)
+            indices.append(cols)
+            data.append(w * corpus.idf[cols] / norm if norm > 0 else w)
+            indptr.append(indptr[-1] + len(tf))
+        return sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), indptr),
+                                 shape=(len(queries), n_terms))
 
-    messages = [
-        {"role": "system", "content": system_msg},
-        {"role": "user", "content": prompt},
-    ]
-    try:
-        answer = call_ollama_chat(messages, temperature=0.8, max_tokens=max_tokens)
-        return jsonify({"lesson": answer})
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 502
+    @staticmethod
+    def _top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+        """Indices of the top_k scores, best first, via O(n) partial selection instead of a full sort."""
+        if top_k >= scores.size:
+            return np.argsort(-scores, kind="stable")
+        part = np.argpartition(-scores, top_k - 1)[:top_k]
+        return part[np.argsort(-scores[part], kind="stable")]
 
-# ----- Quiz generator -----
-@app.route("/generate_quiz", methods=["POST"])
-def generate_quiz():
-    data = request.get_json(force=True)
-    topic = data.get("topic", "").strip()
-    count = int(data.get("count", 5))
-    pack = data.get("pack")
-    reading_level = data.get("reading_level")
-    bilingual_lang = data.get("bilingual_lang")
-    max_tokens = int(data.get("max_tokens") or 600)
+    def retrieve(self, packs: Union[str, List[str]], query: str,
+                 top_k: int = TOP_K_CHUNKS) -> List[Tuple[str, float, Dict]]:
+        """
+        Top chunks of one pack or several (e.g. ["Biology", "General"]) as
+        (text, score, source), source = {pack, chunk, file, pages, chars}.
+        """
+        return self.retrieve_many(packs, [query], top_k=top_k)[0]
 
-    reason = violates_safety(topic)
-    if reason:
-        return jsonify({"error": f"Blocked by safety guardrails: {reason}"}), 400
+    def retrieve_many(self, packs: Union[str, List[str]], queries: List[str],
+                      top_k: int = TOP_K_CHUNKS) -> List[List[Tuple[str, float, Dict]]]:
+        """
+        retrieve() for several queries at once: one sparse product scores the
+        whole batch against the rows of the requested packs only. Queries with
+        the same terms (case, punctuation, word order and stop words aside) are
+        answered from the retrieval cache until the next swap.
+        """
+        with timed("retrieve"):
+            names = self._ensure_packs(packs)
+            corpus = self._corpus
+            if not queries or top_k <= 0:
+                return [[] for _ in queries]
+            tokens = [self._analyzer(q) for q in queries]
+            out: List[Optional[List]] = [None] * len(queries)
+            keys = [(tuple(sorted(set(names))), tuple(sorted(t)), top_k) for t in tokens]
+            if self.retrieval_cache is not None:
+                for i, key in enumerate(keys):
+                    hits = self.retrieval_cache.get(corpus.generation, key)
+                    out[i] = list(hits) if hits is not None else None
+            todo = [i for i, hits in enumerate(out) if hits is None]
+            if not todo:
+                return out
 
-    system_msg = build_system_prompt(reading_level, bilingual_lang)
-    chunks = []
-    if pack:
-        chunks = [c for c, _ in index.retrieve(pack, topic, top_k=TOP_K_CHUNKS)]
+            rows = np.flatnonzero(corpus.row_mask(names))
+            if rows.size == 0:
+                return [[] for _ in queries]
+            qm = self._query_matrix(corpus, [tokens[i] for i in todo])
+            scores = (qm @ corpus.counts[rows].T).toarray() * corpus.inv_norms[rows]
+            for i, row in zip(todo, scores):
+                hits = []
+                for j in self._top_k(row, top_k):
+                    text, source = corpus.hit(rows[j])
+                    hits.append((text, float(row[j]), source))
+                out[i] = hits
+                if self.retrieval_cache is not None:
+                    self.retrieval_cache.put(corpus.generation, keys[i], list(hits))
+            return out
 
-    directive = rag_instructions(chunks)
-    prompt = (
-        f"{directive}\n\n"
-        f"Generate a {count}-question quiz on '{topic}'. "
-        "Return strict JSON with fields: "
-        "questions:[{number:int, question:str, choices:[str] (optional), answer:str}], "
-        "and explanations:[str]. Limit explanations to 1-2 sentences each."
-    )
+index = StudyPackIndex(cache_dir=INDEX_CACHE_DIR or None)
+# Spawned extraction workers re-import the main module; only the parent builds the index.
+if multiprocessing.current_process().name == "MainProcess":
+    if LAZY_INDEX:
+        index.discover(STUDY_PACK_DIR)
+    else:
+        index.build_from_folder(STUDY_PACK_DIR)
 
-    messages = [
-        {"role": "system", "content": system_msg},
-        {"role": "user", "content": prompt},
-    ]
+def start_index_warmup():
+    if LAZY_INDEX and INDEX_WARMUP:
+        threading.Thread(target=index.warm_up, args=(WARMUP_ORDER,),
+                         name="index-warmup", daemon=True).start()
+
+def _reindex_watcher(interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            summary = index.reindex()
+        except Exception as e:
+            print(f"[reindex] failed: {e}")
+            continue
+        if summary.get("added") or summary.get("updated") or summary.get("removed"):
+            print(f"[reindex] added={summary['added']} updated={summary['updated']} "
+                  f"removed={summary['removed']} in {summary['seconds']}s")
+            for line in index.report_lines(list(summary.get("timings", {}))):
+                print(line)
+
+def start_reindex_watcher():
+    if REINDEX_INTERVAL > 0:
+        threading.Thread(target=_reindex_watcher, args=(REINDEX_INTERVAL,),
+                         name="reindex-watcher", daemon=True).start()
+
+# -------------- LLM response cache --------------
+def payload_key(payload: Dict) -> str:
+    """Hash of what determines a chat response: model, messages, options and format."""
+    blob = json.dumps({k: payload.get(k) for k in ("model", "messages", "options", "format")},
+                      sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+class LLMResponseCache:
+    """
+    SQLite store of chat responses with TTL and size-bounded LRU eviction.
+    Best-effort like IndexCache: any database error is logged and treated as a miss.
+    """
+
+    def __init__(self, path: str, ttl: float = LLM_CACHE_TTL, max_bytes: int = int(LLM_CACHE_MAX_MB * 1024 * 1024)):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # One connection shared by all request threads, serialized by _lock.
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, created REAL, last_used REAL, size INTEGER, content TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+
+    key = staticmethod(payload_key)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._db.execute("SELECT created, content FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[0] > self.ttl:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return row[1]
+            except sqlite3.Error as e:
+                print(f"[llm-cache] lookup failed: {e}")
+                self.misses += 1
+                return None
+
+    def put(self, key: str, content: str):
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            try:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                 (key, now, now, size, content))
+                self._evict(now)
+            except sqlite3.Error as e:
+                print(f"[llm-cache] could not save response: {e}")
+
+    def _evict(self, now: float):
+        """Drop expired entries, then least recently used ones until under max_bytes (under _lock)."""
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        doomed = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            try:
+                entries, size = self._db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            except sqlite3.Error:
+                entries = size = None
+            return {"entries": entries, "bytes": size, "hits": self.hits, "misses": self.misses}
+
+llm_cache: Optional[LLMResponseCache] = None
+if LLM_CACHE and multiprocessing.current_process().name == "MainProcess":
     try:
-        raw = call_ollama_chat(messages, temperature=0.7, max_tokens=max_tokens)
+        llm_cache = LLMResponseCache(LLM_CACHE_PATH)
+    except sqlite3.Error as e:
+        print(f"[llm-cache] disabled, cannot open {LLM_CACHE_PATH}: {e}")
+
+# -------------- LLM admission control --------------
+PRIORITY_INTERACTIVE, PRIORITY_GENERATE, PRIORITY_GRADE = range(3)
+
+class Busy(Exception):
+    """Raised instead of queueing: the request's would-be queue position and a retry estimate."""
+
+    def __init__(self, reason: str, position: int, eta_s: Optional[float]):
+        super().__init__(reason)
+        self.position = position
+        self.eta_s = eta_s
+
+class _Ticket:
+    __slots__ = ("priority", "client", "tag", "seq", "granted_at", "released")
+
+    def __init__(self, priority: int, client: str, tag: float, seq: int):
+        self.priority = priority
+        self.client = client
+        self.tag = tag
+        self.seq = seq
+        self.granted_at: Optional[float] = None
+        self.released = False
+
+class LLMScheduler:
+    """
+    Bounded priority queue with a concurrency limit, shared by every request
+    thread. Waiters are served by (priority, fair-queuing tag, arrival): each
+    client's successive requests get increasing tags, so within one priority
+    clients take turns instead of one client's burst going first.
+    """
+
+    def __init__(self, concurrency: int = LLM_CONCURRENCY, queue_size: int = LLM_QUEUE_SIZE,
+                 per_client: int = LLM_CLIENT_QUEUE, max_wait: float = LLM_QUEUE_WAIT):
+        self.concurrency = max(1, concurrency)
+        self.queue_size = queue_size
+        self.per_client = per_client
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting: List[_Ticket] = []
+        self._seq = 0
+        self._virtual_now = 0.0  # tag of the last ticket granted
+        self._last_tag: Dict[str, float] = {}
+        self._avg_hold: Optional[float] = None  # EWMA of seconds a slot is held
+        self.admitted = 0
+        self.rejected = 0
+
+    def _key(self, t: _Ticket) -> Tuple:
+        return (t.priority, t.tag, t.seq)
+
+    def _eta(self, position: int) -> Optional[float]:
+        """Seconds until the request at `position` (1-based) would start, assuming average hold times."""
+        if self._avg_hold is None:
+            return None
+        return round(math.ceil(position / self.concurrency) * self._avg_hold, 1)
+
+    def _busy(self, reason: str, position: int) -> Busy:
+        self.rejected += 1
+        return Busy(reason, position, self._eta(position))
+
+    def acquire(self, priority: int, client: str) -> _Ticket:
+        """Block until a slot is free and this ticket is next; raise Busy rather than queue past the limits."""
+        with timed("queue"):
+            with self._cond:
+                tag = max(self._virtual_now, self._last_tag.get(client, 0.0)) + 1
+                ticket = _Ticket(priority, client, tag, self._seq)
+                self._seq += 1
+                if self._active < self.concurrency and not self._waiting:
+                    return self._grant(ticket)
+                if len(self._waiting) >= self.queue_size:
+                    raise self._busy("queue full", len(self._waiting) + 1)
+                if sum(1 for t in self._waiting if t.client == client) >= self.per_client:
+                    raise self._busy("too many queued requests from this client", len(self._waiting) + 1)
+                self._last_tag[client] = tag
+                self._waiting.append(ticket)
+                deadline = time.monotonic() + self.max_wait
+                while True:
+                    if self._active < self.concurrency and min(self._waiting, key=self._key) is ticket:
+                        self._waiting.remove(ticket)
+                        self._cond.notify_all()
+                        return self._grant(ticket)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        position = 1 + sum(1 for t in self._waiting if self._key(t) < self._key(ticket))
+                        self._waiting.remove(ticket)
+                        self._cond.notify_all()
+                        raise self._busy("timed out waiting in the queue", position)
+                    self._cond.wait(remaining)
+
+    def _grant(self, ticket: _Ticket) -> _Ticket:
+        self._active += 1
+        self._virtual_now = max(self._virtual_now, ticket.tag)
+        self._last_tag[ticket.client] = max(self._last_tag.get(ticket.client, 0.0), ticket.tag)
+        if len(self._last_tag) > 4 * (self.queue_size + self.concurrency):
+            # Tags at or below virtual_now carry no information; forget those clients.
+            self._last_tag = {c: t for c, t in self._last_tag.items() if t > self._virtual_now}
+        ticket.granted_at = time.monotonic()
+        self.admitted += 1
+        return ticket
+
+    def release(self, ticket: Optional[_Ticket]):
+        """Free the ticket's slot; safe to call more than once."""
+        if ticket is None:
+            return
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._active -= 1
+            held = time.monotonic() - ticket.granted_at
+            self._avg_hold = held if self._avg_hold is None else 0.8 * self._avg_hold + 0.2 * held
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority: int, client: str):
+        ticket = self.acquire(priority, client)
         try:
-            data_out = json.loads(raw)
-        except Exception:
-            data_out = {"questions": [], "explanations": [], "raw": raw}
-        return jsonify(data_out)
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 502
+            yield ticket
+        finally:
+            self.release(ticket)
 
-# ----- Auto-grader -----
-@app.route("/grade_quiz", methods=["POST"])
-def grade_quiz():
-    data = request.get_json(force=True)
+    def stats(self) -> Dict:
+        with self._cond:
+            return {"concurrency": self.concurrency, "active": self._active, "queued": len(self._waiting),
+                    "queue_size": self.queue_size, "admitted": self.admitted, "rejected": self.rejected,
+                    "avg_hold_s": round(self._avg_hold, 2) if self._avg_hold is not None else None}
+
+scheduler = LLMScheduler()
+
+# -------------- In-flight request coalescing --------------
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+class SingleFlight:
+    """
+    Runs one call per key at a time: callers arriving with the same key while
+    it runs wait for it and get its result, or its exception, instead of
+    running their own.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self.leaders = 0
+        self.joined = 0
+
+    def do(self, key: str, fn: Callable):
+        if not self.enabled:
+            return fn()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.joined += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"in_flight": len(self._calls), "leaders": self.leaders, "joined": self.joined}
+
+class _StreamFlight:
+    """One upstream token stream: the chunks emitted so far and how it ended."""
+    __slots__ = ("cond", "chunks", "live", "done", "error", "busy", "subscribers", "meta")
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks: List[str] = []
+        self.live = False        # the leader got a scheduler slot
+        self.done = False
+        self.error = ""          # text appended to every reader's stream when it failed
+        self.busy: Optional[Busy] = None
+        self.subscribers = 0
+        self.meta: Dict = {}     # Ollama's counters from the final frame
+
+class StreamSubscription:
+    """One reader of a shared stream; follow() replays what was already emitted, then follows live."""
+
+    def __init__(self, fanout: "StreamFanout", key: str, flight: _StreamFlight, leader: bool):
+        self._fanout = fanout
+        self.key = key
+        self.flight = flight
+        self.leader = leader
+        self._closed = False
+
+    def wait_live(self):
+        """Block until the leader has a slot; raise its Busy if it could not get one."""
+        flight = self.flight
+        with flight.cond:
+            while not (flight.live or flight.done):
+                flight.cond.wait()
+            if flight.busy is not None:
+                raise flight.busy
+
+    def follow(self, error_text: bool = True) -> Iterator[str]:
+        """The stream's text; a failed stream ends with an "[Error] ..." line unless error_text is off."""
+        flight = self.flight
+        i = 0
+        try:
+            while True:
+                with flight.cond:
+                    while i == len(flight.chunks) and not flight.done:
+                        flight.cond.wait()
+                    new = flight.chunks[i:]
+                    done = flight.done
+                i += len(new)
+                yield from new
+                if done:
+                    if flight.error and error_text:
+                        yield flight.error
+                    return
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop reading; safe to call more than once."""
+        if not self._closed:
+            self._closed = True
+            self._fanout._unsubscribe(self)
+
+class StreamFanout:
+    """
+    Shares one Ollama token stream between identical /ask_stream requests.
+    The first subscriber to a key leads: it takes the scheduler slot and hands
+    the upstream stream to start(), which pumps it on a producer thread for
+    every subscriber. The producer stops early once all of them have gone.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _StreamFlight] = {}
+        self.leaders = 0
+        self.joined = 0
+
+    def subscribe(self, key: str) -> StreamSubscription:
+        with self._lock:
+            flight = self._flights.get(key) if self.enabled else None
+            leader = flight is None
+            if leader:
+                flight = _StreamFlight()
+                if self.enabled:
+                    self._flights[key] = flight
+                self.leaders += 1
+            else:
+                self.joined += 1
+            flight.subscribers += 1
+        return StreamSubscription(self, key, flight, leader)
+
+    def _unsubscribe(self, sub: StreamSubscription):
+        with self._lock:
+            sub.flight.subscribers -= 1
+            if sub.flight.subscribers == 0:
+                # Nobody is listening: new requests start afresh, the producer stops at its next chunk.
+                self._forget(sub.key, sub.flight)
+
+    def _forget(self, key: str, flight: _StreamFlight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def _finish(self, key: str, flight: _StreamFlight, error: str = "", busy: Optional[Busy] = None):
+        with self._lock:
+            self._forget(key, flight)
+        with flight.cond:
+            flight.done = True
+            flight.error = error
+            flight.busy = busy
+            flight.cond.notify_all()
+
+    def fail(self, sub: StreamSubscription, busy: Busy):
+        """The leader could not get a slot: everyone waiting on this stream gets the same Busy."""
+        self._finish(sub.key, sub.flight, busy=busy)
+
+    def start(self, sub: StreamSubscription, chunks: Iterator[str], on_done: Callable[[], None]):
+        """Pump `chunks` (an upstream stream generator) to every subscriber, then call on_done()."""
+        flight = sub.flight
+        with flight.cond:
+            flight.live = True
+            flight.cond.notify_all()
+        threading.Thread(target=self._produce, args=(sub.key, flight, chunks, on_done),
+                         name="stream-producer", daemon=True).start()
+
+    def _produce(self, key: str, flight: _StreamFlight, chunks, on_done: Callable[[], None]):
+        error = ""
+        try:
+            for chunk in chunks:
+                with flight.cond:
+                    flight.chunks.append(chunk)
+                    flight.cond.notify_all()
+                if flight.subscribers == 0:
+                    break
+        except requests.RequestException as e:
+            error = f"\n\n[Error] Ollama request failed: {e}"
+        except GuardrailViolation as e:
+            error = f"\n\n[Stopped by safety guardrails: {e}]"
+        finally:
+            chunks.close()  # hands the upstream connection back
+            on_done()
+            self._finish(key, flight, error=error)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"in_flight": len(self._flights), "leaders": self.leaders, "joined": self.joined}
+
+inflight_calls = SingleFlight(LLM_COALESCE)
+stream_fanout = StreamFanout(LLM_COALESCE)
+
+# -------------- Flask --------------
+app = Flask(__name__)
+
+def _new_ollama_session() -> requests.Session:
+    session = requests.Session()
+    # Retries stay in _ollama_chat_request; the adapter only pools connections,
+    # one pool per host (pool_connections), so no backend's pool gets evicted.
+    adapter = HTTPAdapter(pool_connections=max(4, len(OLLAMA_HOSTS)), pool_maxsize=OLLAMA_POOL_SIZE,
+                          max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# One Session for every Ollama call: urllib3's pool is thread-safe, and we
+# never rely on the session's cookies or per-request state.
+ollama_session = _new_ollama_session()
+
+def ollama_pool_stats() -> Dict:
+    """Connections opened vs. requests sent per Ollama host, and idle connections waiting for reuse."""
+    stats = {"pool_size": OLLAMA_POOL_SIZE, "hosts": {}}
+    for adapter in dict.fromkeys(ollama_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["hosts"][f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "requests": pool.num_requests,
+                "connections_opened": pool.num_connections,
+                "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+            }
+    return stats
+
+def _requests_fault(e: requests.RequestException) -> bool:
+    response = getattr(e, "response", None)
+    return backend_fault(response.status_code if response is not None else None)
+
+def _next_backend(affinity: Optional[str], tried: List["OllamaBackend"], attempt: int) -> Optional["OllamaBackend"]:
+    """A backend not tried yet, else (after the backoff) a tried one that is still usable."""
+    backend = ollama_backends.acquire(affinity, exclude=tried)
+    if backend is None and tried:
+        time.sleep(RETRY_BACKOFF * attempt)
+        backend = ollama_backends.acquire(affinity)
+    return backend
+
+def _ollama_chat_request(payload: Dict, affinity: Optional[str] = None) -> Dict:
+    """POST to the least busy healthy backend, retrying (see MAX_RETRIES) if it fails; clear errors."""
+    tried: List[OllamaBackend] = []
+    last_err = "no Ollama backend available"
+    for attempt in range(MAX_RETRIES + 1):
+        backend = _next_backend(affinity, tried, attempt)
+        if backend is None:
+            break
+        tried.append(backend)
+        fault, error = False, ""
+        try:
+            r = ollama_session.post(
+                f"{backend.url}/api/chat", json=payload,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+            )
+            r.raise_for_status()
+            data = r.json()
+        except requests.RequestException as e:
+            fault, error = _requests_fault(e), str(e)
+            if not fault:
+                return {"_error": f"Ollama request failed: {e}"}
+            last_err = f"{backend.url}: {e}"
+            continue
+        finally:
+            ollama_backends.release(backend, fault, error)
+        # Some Ollama errors come back inside JSON
+        if "error" in data and data["error"]:
+            return {"_error": f"Ollama error: {data['error']}"}
+        return data
+    return {"_error": f"Ollama request failed: {last_err}"}
+
+def _keep_alive_value() -> Union[str, float]:
+    """OLLAMA_KEEP_ALIVE as Ollama expects it: plain numbers are seconds, anything else a duration string."""
+    try:
+        return float(OLLAMA_KEEP_ALIVE)
+    except ValueError:
+        return OLLAMA_KEEP_ALIVE
+
+class PromptCacheStats:
+    """
+    Estimated prompt evaluation saved by Ollama's KV cache. Ollama reports only
+    the prompt tokens it evaluated; the whole prompt's token count is estimated
+    from its length, using the highest tokens-per-character ratio seen on a
+    long prompt (one evaluated cold), and the tokens it didn't evaluate are
+    priced at the average prompt-eval speed.
+    """
+
+    CALIBRATION_CHARS = 1000  # shorter prompts are dominated by chat-template tokens
+    MIN_TOKENS_PER_CHAR = 0.2  # below common tokenizers on prose, so savings are never overstated
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.evaluated = 0
+        self.reused = 0
+        self.eval_ms = 0.0
+        self.saved_ms = 0.0
+        self._tokens_per_char = self.MIN_TOKENS_PER_CHAR
+
+    def record(self, messages: List[Dict], stats: Dict) -> Dict:
+        """Account one response's counters; returns its own estimate (empty if Ollama gave no counters)."""
+        count, duration = stats.get("prompt_eval_count"), stats.get("prompt_eval_duration")
+        if not count or not duration:
+            return {}
+        chars = sum(len(m.get("content") or "") for m in messages)
+        with self._lock:
+            if chars >= self.CALIBRATION_CHARS:
+                self._tokens_per_char = max(self._tokens_per_char, count / chars)
+            self.requests += 1
+            self.evaluated += count
+            self.eval_ms += duration / 1e6
+            estimate = round(chars * self._tokens_per_char)
+            reused = max(0, estimate - count)
+            saved = reused * self.eval_ms / self.evaluated
+            self.reused += reused
+            self.saved_ms += saved
+        return {"prompt_tokens_est": estimate, "reused_tokens_est": reused, "saved_ms_est": round(saved)}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"requests": self.requests, "prompt_tokens_evaluated": self.evaluated,
+                    "prompt_eval_ms": round(self.eval_ms), "reused_tokens_est": self.reused,
+                    "saved_ms_est": round(self.saved_ms),
+                    "tokens_per_char": round(self._tokens_per_char, 3)}
+
+prompt_stats = PromptCacheStats()
+
+def _ctx_options() -> Dict:
+    return {"num_ctx": OLLAMA_NUM_CTX} if OLLAMA_NUM_CTX > 0 else {}
+
+def chat_payload(messages: List[Dict], temperature: float, max_tokens: int, stream: bool = False,
+                 fmt: Optional[Dict] = None) -> Dict:
+    """Body of an Ollama /api/chat request (shared with app_async.py); `fmt` is a JSON schema for structured output."""
+    if stream:
+        options = {
+            "num_predict": max_tokens,
+            "temperature": temperature,
+        }
+    else:
+        options = {
+            "num_predict": max_tokens,
+            "temperature": temperature,
+            "top_p": 0.9,
+            "top_k": 40,
+            "repeat_penalty": 1.1,
+        }
+    options.update(_ctx_options())
+    payload = {"model": OLLAMA_MODEL, "messages": messages, "options": options, "stream": stream,
+               "keep_alive": _keep_alive_value()}
+    if fmt is not None:
+        payload["format"] = fmt
+    return payload
+
+# Counters and timings (ns) on the last frame of a streaming /api/chat response.
+OLLAMA_STREAM_STATS = ("total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+                       "eval_count", "eval_duration")
+
+def stream_line(line: str) -> Tuple[str, Optional[Dict]]:
+    """
+    Token text carried by one NDJSON line of a streaming /api/chat response
+    ("" if none), and Ollama's counters if it is the final frame.
+    """
+    try:
+        frame = json.loads(line)
+    except Exception:
+        return "", None
+    text = frame.get("message", {}).get("content", "")
+    if not frame.get("done"):
+        return text, None
+    return text, {k: frame[k] for k in OLLAMA_STREAM_STATS if k in frame}
+
+def call_ollama_chat(messages: List[Dict], temperature: float, max_tokens: int,
+                     use_cache: bool = True, priority: int = PRIORITY_GRADE, client: str = "",
+                     fmt: Optional[Dict] = None, affinity: Optional[str] = None) -> str:
+    """
+    Use Ollama's /api/chat endpoint to interact with the local gpt-oss model.
+    We keep generations short by default to reduce timeouts.
+    Goes through the LLM response cache when it is enabled and use_cache is set;
+    a miss joins an identical call already in flight, or else waits for a
+    scheduler slot (raises Busy when it can't get one). Calls with the same
+    `affinity` (a tutor session id) prefer the same backend.
+    """
+    payload = chat_payload(messages, temperature, max_tokens, fmt=fmt)
+    key = payload_key(payload)
+    cache = llm_cache if use_cache else None
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    def generate() -> str:
+        with scheduler.slot(priority, client):
+            t0 = time.perf_counter()
+            data = _ollama_chat_request(payload, affinity)
+            wall = time.perf_counter() - t0
+        if "_error" in data:
+            raise requests.RequestException(data["_error"])
+        record_ollama(data, wall)
+        prompt_stats.record(messages, data)
+        content = data.get("message", {}).get("content", "")
+        if cache is not None and content:
+            cache.put(key, content)
+        return content
+
+    return inflight_calls.do(key, generate)
+
+def call_ollama_chat_stream(messages, temperature=1.0, max_tokens=512, fmt=None, meta=None, affinity=None):
+    """
+    Stream tokens from Ollama as they generate. Yields text chunks; Ollama's
+    final counters go into `meta`. A failure before the first chunk is retried
+    like a blocking call; after that the error ends the stream.
+    """
+    payload = chat_payload(messages, temperature, max_tokens, stream=True, fmt=fmt)
+    tried: List[OllamaBackend] = []
+    for attempt in range(MAX_RETRIES + 1):
+        backend = _next_backend(affinity, tried, attempt)
+        if backend is None:
+            raise requests.ConnectionError("No Ollama backend available")
+        tried.append(backend)
+        started = fault = False
+        error = ""
+        try:
+            # Leaving the with-block (finished, or the client went away) hands the connection back.
+            with ollama_session.post(f"{backend.url}/api/chat", json=payload,
+                                     timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True) as r:
+                r.raise_for_status()
+                for line in r.iter_lines(decode_unicode=True):
+                    if not line:
+                        continue
+                    chunk, stats = stream_line(line)
+                    if stats is not None:
+                        stats.update(prompt_stats.record(messages, stats))
+                        if meta is not None:
+                            meta.update(stats)
+                    if chunk:
+                        started = True
+                        yield chunk
+            return
+        except requests.RequestException as e:
+            fault, error = _requests_fault(e), str(e)
+            if started or not fault or attempt == MAX_RETRIES:
+                raise
+            print(f"[ollama] {backend.url} failed ({error}); retrying")
+        finally:
+            ollama_backends.release(backend, fault, error)
+
+# -------------- Model warm-up --------------
+class ModelWarmer:
+    """
+    Loads OLLAMA_MODEL on one backend before traffic arrives and reloads it
+    whenever Ollama has unloaded it, so no student waits for (or times out on)
+    a cold load.
+    """
+
+    def __init__(self, host: str, model: str = OLLAMA_MODEL):
+        self.host = host
+        self.model = model
+        self._lock = threading.Lock()
+        self.state = "cold"  # cold / loading / ready / failed
+        self.loads = 0
+        self.last_load_s: Optional[float] = None
+        self.loaded_at: Optional[float] = None
+        self.expires_at: Optional[str] = None
+        self.error = ""
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def _set(self, **fields):
+        with self._lock:
+            for k, v in fields.items():
+                setattr(self, k, v)
+
+    def load(self) -> bool:
+        """Ask Ollama to load the model (a chat with no messages only loads it)."""
+        self._set(state="loading")
+        t0 = time.perf_counter()
+        try:
+            r = ollama_session.post(
+                f"{self.host}/api/chat",
+                # Same num_ctx as real requests, or the first one would reload the model.
+                json={"model": self.model, "messages": [], "stream": False, "keep_alive": _keep_alive_value(),
+                      "options": _ctx_options()},
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            r.raise_for_status()
+            data = r.json()
+            if data.get("error"):
+                raise requests.RequestException(f"Ollama error: {data['error']}")
+        except (requests.RequestException, ValueError) as e:
+            self._set(state="failed", error=str(e))
+            print(f"[model] could not load {self.model} on {self.host}: {e}")
+            return False
+        seconds = round(time.perf_counter() - t0, 2)
+        self._set(state="ready", error="", loads=self.loads + 1, last_load_s=seconds, loaded_at=time.time())
+        print(f"[model] {self.model} loaded on {self.host} in {seconds}s (keep_alive={OLLAMA_KEEP_ALIVE})")
+        return True
+
+    def resident(self) -> Optional[bool]:
+        """Whether Ollama currently has the model loaded (None if Ollama can't be asked)."""
+        try:
+            r = ollama_session.get(f"{self.host}/api/ps", timeout=(CONNECT_TIMEOUT, 10))
+            r.raise_for_status()
+            models = r.json().get("models") or []
+        except (requests.RequestException, ValueError) as e:
+            self._set(state="failed", error=str(e))
+            return None
+        wanted = {self.model, f"{self.model}:latest"}
+        for m in models:
+            if m.get("name") in wanted or m.get("model") in wanted:
+                # Loaded, whoever loaded it (an earlier failed load may since have gone through).
+                self._set(state="ready", error="", expires_at=m.get("expires_at"))
+                return True
+        return False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"state": self.state, "loads": self.loads, "last_load_s": self.last_load_s,
+                    "loaded_at": self.loaded_at, "expires_at": self.expires_at,
+                    "keep_alive": OLLAMA_KEEP_ALIVE, "error": self.error or None}
+
+# -------------- Ollama backends --------------
+def backend_fault(status: Optional[int]) -> bool:
+    """
+    Whether a failed call says the backend is unwell (no response, HTTP 5xx, or
+    404: a backend without the model) rather than the request being wrong.
+    """
+    return status is None or status >= 500 or status == 404
+
+class OllamaBackend:
+    """One Ollama server: its generations in flight, circuit breaker state and model warmer."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.warmer = ModelWarmer(url)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.streak = 0          # consecutive failures
+        self.circuit = "closed"  # closed / open (skipped) / half_open (one trial request out)
+        self.opened_at = 0.0
+        self.last_error = ""
+
+    def stats(self) -> Dict:
+        return {"url": self.url, "circuit": self.circuit, "outstanding": self.outstanding,
+                "requests": self.requests, "failures": self.failures, "consecutive_failures": self.streak,
+                "last_error": self.last_error or None, "model": self.warmer.state}
+
+class OllamaPool:
+    """
+    Routes each generation to the usable backend with the fewest in flight
+    (among those with the model loaded, when warm-up is on). A caller's
+    `affinity` key keeps it on its previous backend while that one is at most
+    STICKY_SLACK generations busier than the least busy. Every outcome, of a
+    request or a health check, feeds the backend's circuit breaker.
+    """
+
+    STICKY_SLACK = 2
+
+    def __init__(self, urls: List[str], failures: int = BACKEND_FAILURES, cooldown: float = BACKEND_COOLDOWN,
+                 sticky_max: int = SESSION_MAX):
+        self.backends = [OllamaBackend(u) for u in urls]
+        self.failures = max(1, failures)
+        self.cooldown = cooldown
+        self.sticky_max = sticky_max
+        self._sticky: "OrderedDict[str, OllamaBackend]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.sticky_hits = 0
+        self.sticky_moves = 0
+
+    def _usable(self, backend: OllamaBackend, now: float) -> bool:
+        if backend.circuit == "open":
+            return now - backend.opened_at >= self.cooldown
+        return backend.circuit == "closed"
+
+    def acquire(self, affinity: Optional[str] = None, exclude=()) -> Optional[OllamaBackend]:
+        """Pick a backend and count a generation against it; None when every one is out (or excluded)."""
+        with self._lock:
+            now = time.monotonic()
+            usable = [b for b in self.backends if b not in exclude and self._usable(b, now)]
+            if MODEL_WARMUP:
+                usable = [b for b in usable if b.warmer.ready] or usable
+            if not usable:
+                return None
+            backend = min(usable, key=lambda b: (b.outstanding, b.requests))
+            if affinity:
+                pinned = self._sticky.get(affinity)
+                if pinned in usable and pinned.outstanding <= backend.outstanding + self.STICKY_SLACK:
+                    backend = pinned
+                    self.sticky_hits += 1
+                elif pinned is not None:
+                    self.sticky_moves += 1
+                self._sticky[affinity] = backend
+                self._sticky.move_to_end(affinity)
+                while len(self._sticky) > self.sticky_max:
+                    self._sticky.popitem(last=False)
+            if backend.circuit == "open":
+                backend.circuit = "half_open"  # this request is the trial
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend: OllamaBackend, fault: bool, error: str = ""):
+        with self._lock:
+            backend.outstanding -= 1
+            self._record(backend, not fault, error)
+
+    def probed(self, backend: OllamaBackend, ok: bool, error: str = ""):
+        with self._lock:
+            self._record(backend, ok, error)
+
+    def _record(self, backend: OllamaBackend, ok: bool, error: str):
+        if ok:
+            if backend.circuit != "closed":
+                print(f"[ollama] {backend.url} is back in rotation")
+            backend.circuit, backend.streak = "closed", 0
+            return
+        backend.failures += 1
+        backend.streak += 1
+        backend.last_error = error
+        if backend.circuit == "half_open" or backend.streak >= self.failures:
+            if backend.circuit != "open":
+                print(f"[ollama] {backend.url} taken out of rotation for {self.cooldown:g}s: {error}")
+            backend.circuit, backend.opened_at = "open", time.monotonic()
+
+    def watch(self, backend: OllamaBackend, interval: float):
+        """
+        Load the model on `backend` (MODEL_WARMUP), then check it every
+        `interval` seconds: the check counts as a health probe, and the model
+        is reloaded whenever Ollama has unloaded it.
+        """
+        warmer = backend.warmer
+        if MODEL_WARMUP:
+            self.probed(backend, warmer.load(), warmer.error)
+        while interval > 0:
+            time.sleep(interval)
+            resident = warmer.resident()
+            self.probed(backend, resident is not None, warmer.error)
+            if MODEL_WARMUP and resident is not True:
+                if warmer.ready:
+                    print(f"[model] {warmer.model} was unloaded by Ollama on {backend.url}; reloading")
+                self.probed(backend, warmer.load(), warmer.error)
+
+    def model_ready(self) -> bool:
+        return any(b.warmer.ready for b in self.backends)
+
+    def model_status(self) -> Dict:
+        """The warm-up state of the furthest-along backend, with how many are ready."""
+        order = {"ready": 0, "loading": 1, "cold": 2, "failed": 3}
+        stats = [b.warmer.stats() for b in self.backends]
+        best = min(stats, key=lambda st: order.get(st["state"], len(order)))
+        return dict(best, ready_backends=sum(st["state"] == "ready" for st in stats), backends=len(stats))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"backends": [b.stats() for b in self.backends], "sticky_keys": len(self._sticky),
+                    "sticky_hits": self.sticky_hits, "sticky_moves": self.sticky_moves}
+
+ollama_backends = OllamaPool(OLLAMA_HOSTS)
+
+def model_ready() -> bool:
+    return ollama_backends.model_ready() or not MODEL_WARMUP
+
+def start_backend_probes():
+    """One thread per backend: warm-up (MODEL_WARMUP), then health and model checks every MODEL_CHECK_INTERVAL."""
+    if not MODEL_WARMUP and MODEL_CHECK_INTERVAL <= 0:
+        return
+    for backend in ollama_backends.backends:
+        threading.Thread(target=ollama_backends.watch, args=(backend, MODEL_CHECK_INTERVAL),
+                         name=f"ollama-probe-{backend.url}", daemon=True).start()
+
+# -------- Prompt building --------
+# Prompts are laid out for the longest prefix shared between requests, which
+# Ollama can serve from its KV cache instead of re-evaluating: the fixed system
+# prompt, then the study pack excerpts in canonical (pack, chunk) order, and only
+# then what changes per request (reading level, language, the question or task).
+SYSTEM_PROMPT = " ".join([
+    "You are an offline Educational Tutor.",
+    "Be clear, concise, step-by-step.",
+    "Use safe, age-appropriate language.",
+    "Respond in clean **Markdown** with short sections, headings, and bullet lists.",
+    "Use line breaks; avoid giant single paragraphs.",
+])
+
+def style_instructions(reading_level: Optional[str], bilingual_lang: Optional[str]) -> str:
+    parts = []
+    if reading_level:
+        parts.append(f"Adjust explanations for a Grade {reading_level} reading level.")
+    if bilingual_lang and bilingual_lang.lower() != "english":
+        parts.append(f"Provide bilingual output: first English, then the same content in {bilingual_lang}.")
+    return " ".join(parts)
+
+def build_messages(hits: List[Tuple[str, float, Dict]], task: str, data: Dict,
+                   history: Optional[List[Dict]] = None) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Chat messages for `task` grounded in `hits`, and the sources in the order
+    they are numbered. A session's `history` goes between the system prompt
+    and the new request: it only grows between turns, so it stays in the prefix.
+    """
+    with timed("prompt"):
+        hits = sorted(hits, key=lambda h: (h[2]["pack"], h[2]["chunk"]))
+        sources = [src for _, _, src in hits]
+        sections = [rag_instructions([c for c, _, _ in hits], sources),
+                    style_instructions(data.get("reading_level"), data.get("bilingual_lang")), task]
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        messages += history or []
+        messages.append({"role": "user", "content": "\n\n".join(p for p in sections if p)})
+    return messages, sources
+
+def _source_label(src: Dict) -> str:
+    first, last = src["pages"]
+    pages = f"p. {first}" if first == last else f"pp. {first}-{last}"
+    return f"{src['file']}, {pages}"
+
+def rag_instructions(chunks: List[str], sources: Optional[List[Dict]] = None) -> str:
+    if not chunks:
+        return "Use general knowledge only."
+    labels = [f" ({_source_label(s)})" for s in sources] if sources else [""] * len(chunks)
+    joined = "\n\n".join([f"[Source {i+1}]{labels[i]}\n{c}" for i, c in enumerate(chunks)])
+    return (
+        "Use ONLY the following study pack excerpts to answer. "
+        "If the answer is not contained here, say you don’t have that in the study pack.\n\n"
+        f"{joined}\n\n"
+        "Cite the source numbers you used (e.g., [Source 1], [Source 3])."
+    )
+
+def _subtopics(data: Dict) -> List[str]:
+    """Optional "subtopics": [str] from a lesson/quiz payload."""
+    raw = data.get("subtopics") or []
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    return [str(t).strip() for t in raw if str(t).strip()]
+
+def _subtopics_line(subtopics: List[str]) -> str:
+    return f" Cover these sub-topics: {', '.join(subtopics)}." if subtopics else ""
+
+def retrieve_for_topics(pack: Union[str, List[str], None], topics: List[str],
+                        top_k: int = TOP_K_CHUNKS) -> List[Tuple[str, float, Dict]]:
+    """
+    Best top_k chunks across a topic and its sub-topics, scored in one
+    retrieve_many() batch. A chunk matched by several topics appears once.
+    """
+    if not pack or not topics:
+        return []
+    best: Dict[Tuple[str, int], Tuple[str, float, Dict]] = {}
+    for hits in index.retrieve_many(pack, topics, top_k=top_k):
+        for hit in hits:
+            chunk_id = (hit[2]["pack"], hit[2]["chunk"])
+            if chunk_id not in best or hit[1] > best[chunk_id][1]:
+                best[chunk_id] = hit
+    return sorted(best.values(), key=lambda h: -h[1])[:top_k]
+
+# -------- Quiz grading --------
+# Closed questions (multiple choice, numbers, yes/no, answers that match once
+# case, punctuation and articles are ignored) are graded here; only the rest
+# go to the model, all in one request.
+_CHOICE_LABEL = re.compile(r"^\(?([a-z])[).:](?:\s+|$)", re.I)
+_LEADING_ARTICLE = re.compile(r"^(?:the|a|an) ")
+_YES_NO = {"yes": True, "true": True, "no": False, "false": False}
+
+def _normalize_answer(text) -> str:
+    t = re.sub(r"[\W_]+", " ", str(text).casefold()).strip()
+    return _LEADING_ARTICLE.sub("", t)
+
+def _as_number(text) -> Optional[float]:
+    t = str(text).strip().replace(",", "").rstrip("%").strip()
+    try:
+        return float(t)
+    except ValueError:
+        return None
+
+def _choice_index(text, choices: List[str]) -> Optional[int]:
+    """Which choice `text` names: its text (with or without an "A)" label) or its letter."""
+    raw = str(text).strip()
+    if not raw:
+        return None
+    norm = _normalize_answer(_CHOICE_LABEL.sub("", raw))
+    for i, choice in enumerate(choices):
+        if norm == _normalize_answer(_CHOICE_LABEL.sub("", str(choice))):
+            return i
+    m = _CHOICE_LABEL.match(raw)
+    letter = raw if len(raw) == 1 and raw.isalpha() else (m.group(1) if m else None)
+    if letter:
+        i = ord(letter.lower()) - ord("a")
+        if 0 <= i < len(choices):
+            return i
+    return None
+
+def grade_locally(question: Dict, student) -> Optional[bool]:
+    """True/False when the answer can be checked without the model, else None."""
+    expected = question.get("answer")
+    if expected is None:
+        return None
+    if not str(student or "").strip():
+        return False
+    choices = question.get("choices")
+    if isinstance(choices, list) and choices:
+        want, got = _choice_index(expected, choices), _choice_index(student, choices)
+        if want is not None and got is not None:
+            return want == got
+    want_n, got_n = _as_number(expected), _as_number(student)
+    if want_n is not None and got_n is not None:
+        return math.isclose(want_n, got_n, rel_tol=1e-9, abs_tol=1e-9)
+    want, got = _normalize_answer(expected), _normalize_answer(student)
+    if want == got:
+        return True
+    if want in _YES_NO and got in _YES_NO:
+        return _YES_NO[want] == _YES_NO[got]  # "yes" answers "true?" and vice versa
+    return None
+
+def _local_explanation(correct: bool, expected, explanation: str) -> str:
+    head = "Correct." if correct else f"The expected answer is: {expected}."
+    return f"{head} {explanation}".strip()
+
+def _feedback_summary(rows: List[Dict]) -> str:
+    score = sum(1 for r in rows if r["correct"])
+    if score == len(rows):
+        return f"All {len(rows)} answers are correct. Great work!"
+    missed = ", ".join(str(r["number"]) for r in rows if not r["correct"])
+    return f"{score} of {len(rows)} correct. Review question(s) {missed}."
+
+def grade_answers(quiz_json: Dict, student_answers: Dict,
+                  memo: Optional[Dict] = None) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Per-question rows in quiz order, and the open-ended items left for the
+    model; their rows have "correct": None until merge_model_grades() fills them.
+    `memo` caches verdicts by (question, answer) across calls for one quiz.
+    """
+    rows, open_items = [], []
+    explanations = quiz_json.get("explanations") or []
+    for i, q in enumerate(quiz_json.get("questions") or []):
+        if not isinstance(q, dict):
+            continue
+        number = q.get("number", i + 1)
+        student = student_answers.get(str(number), student_answers.get(number, ""))
+        student = "" if student is None else str(student)
+        if memo is None:
+            correct = grade_locally(q, student)
+        else:
+            if (i, student) not in memo:
+                memo[(i, student)] = grade_locally(q, student)
+            correct = memo[(i, student)]
+        explanation = str(explanations[i]) if i < len(explanations) and explanations[i] else ""
+        if correct is None:
+            open_items.append({"number": number, "question": q.get("question", ""),
+                               "answer": q.get("answer"), "student": student})
+            explanation = ""
+        else:
+            explanation = _local_explanation(correct, q.get("answer"), explanation)
+        rows.append({"number": number, "student": student, "correct": correct, "explanation": explanation})
+    return rows, open_items
+
+def merge_model_grades(rows: List[Dict], raw: str) -> Dict:
+    """Fill the open rows from the model's JSON and build the /grade_quiz response."""
+    try:
+        graded = json.loads(raw)
+        by_number = {str(r.get("number")): r for r in graded.get("per_question", []) if isinstance(r, dict)}
+        summary = graded.get("feedback_summary")
+    except Exception:
+        graded, by_number, summary = None, {}, None
+    for row in rows:
+        if row["correct"] is not None:
+            continue
+        verdict = by_number.get(str(row["number"]), {})
+        row["correct"] = verdict.get("correct") is True
+        row["explanation"] = str(verdict.get("explanation") or "Could not be graded automatically.")
+    out = graded_result(rows, summary)
+    if graded is None and raw:
+        out["raw"] = raw
+    return out
+
+def graded_result(rows: List[Dict], summary: Optional[str] = None) -> Dict:
+    return {"score": sum(1 for r in rows if r["correct"]), "total": len(rows), "per_question": rows,
+            "feedback_summary": summary or _feedback_summary(rows)}
+
+# -------- Tutor sessions --------
+def approx_tokens(text: str) -> int:
+    return len(text) // 4
+
+class TutorSession:
+    """
+    One conversation: a rolling summary of its older turns, the recent
+    (question, answer) turns verbatim, and the excerpts the last turn used.
+    """
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.summary = ""
+        self.turns: List[Tuple[str, str]] = []
+        self.hits: List[Tuple[str, float, Dict]] = []
+        self.last_used = time.time()
+        self.compacting = False
+        self.lock = threading.Lock()
+
+    def history(self) -> List[Dict]:
+        """The conversation so far as chat messages."""
+        with self.lock:
+            messages = []
+            if self.summary:
+                messages.append({"role": "system", "content": f"Summary of the conversation so far: {self.summary}"})
+            for question, answer in self.turns:
+                messages.append({"role": "user", "content": question})
+                messages.append({"role": "assistant", "content": answer})
+            return messages
+
+    def carried_hits(self, pack: Union[str, List[str], None]) -> List[Tuple[str, float, Dict]]:
+        """
+        Last turn's excerpts from `pack` (one name, several, or None for any),
+        scored at half weight: a follow-up ("why?", "give an example")
+        retrieves little on its own.
+        """
+        packs = None if pack is None else {pack} if isinstance(pack, str) else set(pack)
+        with self.lock:
+            return [(c, score / 2, src) for c, score, src in self.hits if packs is None or src["pack"] in packs]
+
+    def history_tokens(self) -> int:
+        return approx_tokens(self.summary) + sum(approx_tokens(q) + approx_tokens(a) for q, a in self.turns)
+
+    def record(self, question: str, answer: str, hits: List[Tuple[str, float, Dict]]):
+        if not answer.strip():
+            return
+        with self.lock:
+            self.turns.append((question, answer))
+            self.hits = hits
+            self.last_used = time.time()
+            if (self.compacting or len(self.turns) <= SESSION_KEEP_TURNS
+                    or self.history_tokens() <= SESSION_HISTORY_TOKENS):
+                return
+            self.compacting = True
+            old = self.turns[:len(self.turns) - SESSION_KEEP_TURNS]
+            summary = self.summary
+        threading.Thread(target=self._compact, args=(summary, old), name="session-compact", daemon=True).start()
+
+    def _compact(self, summary: str, old: List[Tuple[str, str]]):
+        """Fold `old` (the oldest turns) into the summary; turns recorded meanwhile are kept."""
+        try:
+            new_summary = summarize_turns(summary, old)
+        except (requests.RequestException, Busy) as e:
+            print(f"[session] {self.id}: summary failed ({e}); keeping the questions only")
+            new_summary = " ".join([summary] + [f"Student asked: {q}" for q, _ in old]).strip()
+        limit = SESSION_SUMMARY_TOKENS * 4
+        if len(new_summary) > limit:
+            new_summary = "..." + new_summary[-limit:]
+        with self.lock:
+            self.summary = new_summary
+            del self.turns[:len(old)]
+            self.compacting = False
+
+    def info(self) -> Dict:
+        with self.lock:
+            return {"session_id": self.id, "summary": self.summary,
+                    "turns": [{"question": q, "answer": a} for q, a in self.turns],
+                    "history_tokens": self.history_tokens(), "compacting": self.compacting}
+
+def summarize_turns(summary: str, turns: List[Tuple[str, str]]) -> str:
+    lines = [f"Student: {q}\nTutor: {a}" for q, a in turns]
+    prompt = (
+        "Update the summary of a tutoring conversation with the new exchanges below. "
+        "Keep the topics covered, what the student understood or struggled with, and open questions, "
+        f"in at most {SESSION_SUMMARY_TOKENS * 3 // 4} words. Reply with the summary only."
+        f"\n\nSUMMARY SO FAR:\n{summary or '(none)'}\n\nNEW EXCHANGES:\n" + "\n\n".join(lines)
+    )
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": prompt}]
+    return call_ollama_chat(messages, temperature=0.2, max_tokens=SESSION_SUMMARY_TOKENS,
+                            priority=PRIORITY_GRADE).strip()
+
+class SessionStore:
+    """LRU of TutorSessions; sessions idle for longer than `ttl` are dropped on the next lookup."""
+
+    MAX_ID_LENGTH = 64
+
+    def __init__(self, capacity: int, ttl: float):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._data: "OrderedDict[str, TutorSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def _expire(self, now: float):
+        while self._data:
+            oldest = next(iter(self._data.values()))
+            if now - oldest.last_used <= self.ttl:
+                break
+            self._data.popitem(last=False)
+            self.expired += 1
+
+    def get(self, session_id: str, create: bool = True) -> Optional[TutorSession]:
+        if not isinstance(session_id, str) or not 0 < len(session_id) <= self.MAX_ID_LENGTH:
+            raise BadRequest(f"session_id must be a string of 1-{self.MAX_ID_LENGTH} characters")
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._data.get(session_id)
+            if session is None:
+                if not create:
+                    return None
+                session = self._data[session_id] = TutorSession(session_id)
+                self.created += 1
+                while len(self._data) > self.capacity:
+                    self._data.popitem(last=False)
+                    self.evicted += 1
+            session.last_used = now
+            self._data.move_to_end(session_id)
+            return session
+
+    def drop(self, session_id: str) -> bool:
+        with self._lock:
+            return self._data.pop(session_id, None) is not None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"active": len(self._data), "capacity": self.capacity, "created": self.created,
+                    "evicted": self.evicted, "expired": self.expired}
+
+sessions = SessionStore(SESSION_MAX, SESSION_TTL)
+
+# -------- Request handling shared by the Flask app and app_async.py --------
+class BadRequest(Exception):
+    """A request the routes answer with {"error": message} and `status`."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+class ChatJob:
+    """
+    One model call built from a request body: the messages and sampling
+    settings sent to Ollama, the sources they cite, and how to turn the
+    model's text into the route's JSON response. A job whose messages are
+    None was answered without the model; the routes call response("").
+    Streaming routes, which don't build a response, call answered() with the
+    full text once the model finished.
+    """
+    __slots__ = ("messages", "temperature", "max_tokens", "sources", "use_cache", "priority", "fmt", "affinity",
+                 "_shape", "_on_answer")
+
+    def __init__(self, messages: Optional[List[Dict]], temperature: float, max_tokens: int,
+                 sources: List[Dict], use_cache: bool, shape, priority: int, fmt: Optional[Dict] = None,
+                 on_answer: Optional[Callable[[str], None]] = None, affinity: Optional[str] = None):
+        self.messages = messages
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.sources = sources
+        self.use_cache = use_cache
+        self.priority = priority  # scheduler queue priority
+        self.fmt = fmt            # JSON schema for Ollama's structured output
+        self.affinity = affinity  # backend routing key (a tutor session id)
+        self._shape = shape
+        self._on_answer = on_answer  # e.g. records the turn in a tutor session
+
+    @property
+    def needs_model(self) -> bool:
+        return self.messages is not None
+
+    def answered(self, content: str):
+        if self._on_answer is not None:
+            self._on_answer(content)
+
+    def response(self, content: str) -> Dict:
+        self.answered(content)
+        return self._shape(content, self.sources)
+
+def _quiz_response(raw: str, sources: List[Dict]) -> Dict:
+    try:
+        return json.loads(raw)
+    except Exception:
+        return {"questions": [], "explanations": [], "raw": raw}
+
+def _check_safety(text: str):
+    with timed("safety"):
+        reason = violates_safety(text)
+    if reason:
+        raise BadRequest(f"Blocked by safety guardrails: {reason}")
+
+def ask_job(data: Dict) -> ChatJob:
+    """/ask and /ask_stream."""
+    question = data.get("question", "").strip()
+    pack = data.get("pack")
+    # from UI slider; fall back to 300
+    max_tokens = int(data.get("max_tokens") or 300)
+    _check_safety(question)
+
+    hits = index.retrieve(pack, question, top_k=TOP_K_CHUNKS) if pack else []
+    session_id = data.get("session_id")
+    if session_id is None:
+        messages, sources = build_messages(hits, f"User question: {question}", data)
+        return ChatJob(messages, 0.7, max_tokens, sources, not data.get("no_cache"),
+                       lambda answer, srcs: {"response": answer, "sources": srcs}, PRIORITY_INTERACTIVE)
+
+    session = sessions.get(session_id)
+    merged: Dict[Tuple[str, int], Tuple[str, float, Dict]] = {}
+    for hit in session.carried_hits(pack) + hits:
+        key = (hit[2]["pack"], hit[2]["chunk"])
+        if key not in merged or hit[1] > merged[key][1]:
+            merged[key] = hit
+    hits = sorted(merged.values(), key=lambda h: -h[1])[:TOP_K_CHUNKS]
+    messages, sources = build_messages(hits, f"User question: {question}", data, session.history())
+    return ChatJob(messages, 0.7, max_tokens, sources, not data.get("no_cache"),
+                   lambda answer, srcs: {"response": answer, "sources": srcs, "session_id": session.id},
+                   PRIORITY_INTERACTIVE, on_answer=lambda answer: session.record(question, answer, hits),
+                   affinity=session.id)
+
+def lesson_job(data: Dict) -> ChatJob:
+    topic = data.get("topic", "").strip()
+    minutes = int(data.get("minutes", 20))
+    max_tokens = int(data.get("max_tokens") or 600)
+    subtopics = _subtopics(data)
+    _check_safety(" ".join([topic] + subtopics))
+
+    hits = retrieve_for_topics(data.get("pack"), [topic] + subtopics)
+    prompt = (
+        f"Create a {minutes}-minute lesson plan on '{topic}'. "
+        "Include: Objectives, Hook, Mini-lesson steps, Guided practice, Independent practice, "
+        "Differentiation ideas, and an Exit Ticket. Keep it practical for a teacher."
+        + _subtopics_line(subtopics)
+    )
+    messages, sources = build_messages(hits, prompt, data)
+    return ChatJob(messages, 0.8, max_tokens, sources, not data.get("no_cache"),
+                   lambda lesson, srcs: {"lesson": lesson, "sources": srcs}, PRIORITY_GENERATE)
+
+def quiz_job(data: Dict, streaming: bool = False) -> ChatJob:
+    """/generate_quiz, or with `streaming` the schema-constrained quiz that /generate_quiz_stream parses as it arrives."""
+    topic = data.get("topic", "").strip()
+    count = int(data.get("count", 5))
+    max_tokens = int(data.get("max_tokens") or 600)
+    subtopics = _subtopics(data)
+    _check_safety(" ".join([topic] + subtopics))
+
+    hits = retrieve_for_topics(data.get("pack"), [topic] + subtopics)
+    if streaming:
+        fields = ("questions:[{number:int, question:str, choices:[str] (optional), answer:str, "
+                  "explanation:str}]. Limit each explanation to 1-2 sentences.")
+    else:
+        fields = ("questions:[{number:int, question:str, choices:[str] (optional), answer:str}], "
+                  "and explanations:[str]. Limit explanations to 1-2 sentences each.")
+    prompt = (
+        f"Generate a {count}-question quiz on '{topic}'. "
+        f"Return strict JSON with fields: {fields}"
+        + _subtopics_line(subtopics)
+    )
+    messages, sources = build_messages(hits, prompt, data)
+    if streaming:
+        return ChatJob(messages, 0.7, max_tokens, sources, not data.get("no_cache"), finish_quiz,
+                       PRIORITY_GENERATE, fmt=QUIZ_SCHEMA)
+    return ChatJob(messages, 0.7, max_tokens, sources, not data.get("no_cache"), _quiz_response,
+                   PRIORITY_GENERATE)
+
+def grade_job(data: Dict) -> ChatJob:
     quiz_json = data.get("quiz_json")
     student_answers = data.get("student_answers", {})
     pack = data.get("pack")
-    reading_level = data.get("reading_level")
-    bilingual_lang = data.get("bilingual_lang")
     max_tokens = int(data.get("max_tokens") or 600)
 
     if not isinstance(quiz_json, dict) or "questions" not in quiz_json:
-        return jsonify({"error": "Invalid quiz_json"}), 400
+        raise BadRequest("Invalid quiz_json")
+    if not isinstance(student_answers, dict):
+        raise BadRequest("student_answers must be an object keyed by question number")
 
-    system_msg = build_system_prompt(reading_level, bilingual_lang)
-    chunks = []
-    if pack:
-        chunks = [c for c, _ in index.retrieve(pack, "grading rubric", top_k=TOP_K_CHUNKS)]
+    rows, open_items = grade_answers(quiz_json, student_answers)
+    shape = lambda raw, srcs: merge_model_grades(rows, raw)
+    if not open_items:
+        return ChatJob(None, 0.6, max_tokens, [], False, shape, PRIORITY_GRADE)
 
-    directive = rag_instructions(chunks)
+    hits = []
+    if pack:
+        hits = index.retrieve(pack, "grading rubric", top_k=TOP_K_CHUNKS)
+    already = [{"number": r["number"], "correct": r["correct"]} for r in rows if r["correct"] is not None]
     prompt = (
-        f"{directive}\n\n"
-        "You are an auto-grader. Compare 'student_answers' against the quiz 'answer' fields. "
+        "You are an auto-grader. For each item in ITEMS, decide whether 'student' gives the expected "
+        "'answer' to 'question' (accept equivalent wording and minor spelling mistakes). "
         "Return strict JSON: {"
-        "'score': int, 'total': int, "
-        "'per_question': [{'number': int, 'student': str, 'correct': bool, 'explanation': str}], "
-        "'feedback_summary': str}"
-        f"\nQUIZ_JSON:\n{json.dumps(quiz_json, ensure_ascii=False)}\n"
-        f"STUDENT_ANSWERS:\n{json.dumps(student_answers, ensure_ascii=False)}"
+        "'per_question': [{'number': int, 'correct': bool, 'explanation': str}], "
+        "'feedback_summary': str}. The feedback summary covers the whole quiz, "
+        "including the questions in ALREADY_GRADED."
+        f"\nITEMS:\n{json.dumps(open_items, ensure_ascii=False)}\n"
+        f"ALREADY_GRADED:\n{json.dumps(already)}"
     )
+    messages, sources = build_messages(hits, prompt, data)
+    return ChatJob(messages, 0.6, max_tokens, sources, not data.get("no_cache"), shape, PRIORITY_GRADE)
 
-    messages = [
-        {"role": "system", "content": system_msg},
-        {"role": "user", "content": prompt},
-    ]
-    try:
-        raw = call_ollama_chat(messages, temperature=0.6, max_tokens=max_tokens)
+class BulkGrading:
+    """
+    One quiz graded for a whole class (/grade_quiz_bulk). Closed answers are
+    graded once per distinct answer; open-ended ones are deduplicated across
+    students and sent to the model in shared batches (`jobs`). The route runs
+    the jobs and feeds each outcome to apply() or fail(), which return the
+    students whose grading that completed.
+    """
+
+    def __init__(self, data: Dict):
+        quiz_json = data.get("quiz_json")
+        submissions = data.get("submissions")
+        if not isinstance(quiz_json, dict) or "questions" not in quiz_json:
+            raise BadRequest("Invalid quiz_json")
+        if not isinstance(submissions, list) or not all(
+                isinstance(s, dict) and isinstance(s.get("student_answers"), dict) for s in submissions):
+            raise BadRequest("submissions must be a list of {student, student_answers} objects")
+
+        self.t0 = time.perf_counter()
+        memo: Dict = {}
+        self.students: List[str] = []
+        self.rows: List[List[Dict]] = []
+        self.outstanding: List[int] = []  # open rows per student still waiting for the model
+        # (question number, normalized answer) -> rows of every student who gave that answer
+        pending: Dict[Tuple, List[Tuple[int, Dict]]] = {}
+        items: List[Dict] = []
+        for n, sub in enumerate(submissions):
+            rows, open_items = grade_answers(quiz_json, sub["student_answers"], memo)
+            self.students.append(str(sub.get("student", n + 1)))
+            self.rows.append(rows)
+            self.outstanding.append(len(open_items))
+            open_rows = [r for r in rows if r["correct"] is None]
+            for item, row in zip(open_items, open_rows):
+                key = (str(item["number"]), _normalize_answer(item["student"]))
+                if key not in pending:
+                    pending[key] = []
+                    items.append({"id": len(items), **item})
+                pending[key].append((n, row))
+        self._pending = [pending[(str(it["number"]), _normalize_answer(it["student"]))] for it in items]
+        self.graded_locally = sum(len(rows) for rows in self.rows) - sum(self.outstanding)
+        self.distinct_open = len(items)
+        self._emitted = [False] * len(self.students)
+
+        self.jobs: List[ChatJob] = []
+        if not items:
+            return
+        pack = data.get("pack")
+        hits = index.retrieve(pack, "grading rubric", top_k=TOP_K_CHUNKS) if pack else []
+        max_tokens = int(data.get("max_tokens") or 600)
+        self._batches = [items[i:i + BULK_GRADE_BATCH] for i in range(0, len(items), max(1, BULK_GRADE_BATCH))]
+        for batch in self._batches:
+            prompt = (
+                "You are an auto-grader. For each item in ITEMS, decide whether 'student' gives the expected "
+                "'answer' to 'question' (accept equivalent wording and minor spelling mistakes). "
+                "Return strict JSON: {'results': [{'id': int, 'correct': bool, 'explanation': str}]}. "
+                "Keep each explanation to one sentence."
+                f"\nITEMS:\n{json.dumps(batch, ensure_ascii=False)}"
+            )
+            messages, sources = build_messages(hits, prompt, data)
+            self.jobs.append(ChatJob(messages, 0.6, max(max_tokens, 80 * len(batch)), sources,
+                                     not data.get("no_cache"), self._verdicts, PRIORITY_GRADE))
+
+    @staticmethod
+    def _verdicts(raw: str, sources: List[Dict]) -> Dict[int, Dict]:
         try:
-            graded = json.loads(raw)
+            results = json.loads(raw).get("results", [])
+            return {int(r["id"]): r for r in results if isinstance(r, dict) and "id" in r}
         except Exception:
-            graded = {"raw": raw}
-        return jsonify(graded)
+            return {}
+
+    def _result(self, n: int) -> Dict:
+        self._emitted[n] = True
+        return {"student": self.students[n], **graded_result(self.rows[n])}
+
+    def ready(self) -> List[Dict]:
+        """Students graded entirely without the model."""
+        return [self._result(n) for n in range(len(self.students)) if not self.outstanding[n]]
+
+    def _settle(self, i: int, verdicts: Dict[int, Dict], error: str = "") -> List[Dict]:
+        done = []
+        for item in self._batches[i]:
+            verdict = verdicts.get(item["id"], {})
+            explanation = verdict.get("explanation") or (
+                f"Could not be graded automatically: {error}" if error else "Could not be graded automatically.")
+            for n, row in self._pending[item["id"]]:
+                row["correct"] = verdict.get("correct") is True
+                row["explanation"] = str(explanation)
+                self.outstanding[n] -= 1
+                if not self.outstanding[n] and not self._emitted[n]:
+                    done.append(n)
+        return [self._result(n) for n in done]
+
+    def apply(self, i: int, raw: str) -> List[Dict]:
+        """Record the model's answer to jobs[i]."""
+        return self._settle(i, self.jobs[i].response(raw))
+
+    def fail(self, i: int, error: str) -> List[Dict]:
+        """jobs[i] could not be run; its answers are marked ungraded."""
+        return self._settle(i, {}, error)
+
+    def summary(self) -> Dict:
+        return {"done": True, "students": len(self.students), "graded_locally": self.graded_locally,
+                "distinct_open_answers": self.distinct_open, "model_calls": len(self.jobs),
+                "seconds": round(time.perf_counter() - self.t0, 3)}
+
+# -------- Streaming quiz --------
+# /generate_quiz_stream asks Ollama for JSON matching QUIZ_SCHEMA and hands each
+# question to the client as soon as its closing brace arrives. A question that
+# doesn't parse is repaired locally if it can be, else re-requested on its own.
+QUESTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "number": {"type": "integer"},
+        "question": {"type": "string"},
+        "choices": {"type": "array", "items": {"type": "string"}},
+        "answer": {"type": "string"},
+        "explanation": {"type": "string"},
+    },
+    "required": ["number", "question", "answer", "explanation"],
+}
+QUIZ_SCHEMA = {
+    "type": "object",
+    "properties": {"questions": {"type": "array", "items": QUESTION_SCHEMA}},
+    "required": ["questions"],
+}
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_SMART_QUOTES = str.maketrans({"\u201c": '"', "\u201d": '"', "\u2018": "'", "\u2019": "'"})
+
+class QuizStreamParser:
+    """
+    Incremental scanner for {"questions": [{...}, {...}], ...} as the model
+    streams it: feed() text chunks and get back the raw text of each question
+    object once it is complete. Only brackets outside strings are counted, so
+    braces inside question text don't confuse it; text before the first "{"
+    (such as a code fence) is skipped.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_key = ""         # last string seen at depth 1
+        self._in_questions = False
+        self._start: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[str]:
+        self.text += chunk
+        done = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_key = text[self._string_start:i]
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i + 1
+            elif c in "{[":
+                if c == "[" and self._depth == 1:
+                    self._in_questions = self._last_key == "questions"
+                elif c == "{" and self._depth == 2 and self._in_questions:
+                    self._start = i
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if c == "}" and self._depth == 2 and self._start is not None:
+                    done.append(text[self._start:i + 1])
+                    self._start = None
+                elif c == "]" and self._depth == 1:
+                    self._in_questions = False
+        self._pos = len(text)
+        return done
+
+    def flush(self) -> Optional[str]:
+        """At the end of the stream: the text of a question that never closed (cut off, or broken quoting)."""
+        if self._start is None:
+            return None
+        tail, self._start = self.text[self._start:], None
+        return tail
+
+def parse_question(fragment: str, number: int) -> Optional[Dict]:
+    """One streamed question object, repaired if it is only slightly off; None if unusable."""
+    repaired = _TRAILING_COMMA.sub(r"\1", fragment.translate(_SMART_QUOTES)).replace("\\'", "'")
+    for attempt in (fragment, repaired):
+        try:
+            q = json.loads(attempt)
+        except ValueError:
+            continue
+        if isinstance(q, dict) and str(q.get("question") or "").strip() and q.get("answer") is not None:
+            q["number"] = number
+            q["answer"] = str(q["answer"])
+            if not isinstance(q.get("choices"), list) or not q["choices"]:
+                q.pop("choices", None)
+            return q
+    return None
+
+def question_repair_job(job: ChatJob, fragment: str, number: int) -> ChatJob:
+    """Re-request one question that didn't parse, from the quiz prompt and the broken text."""
+    prompt = (
+        f"Question {number} of the quiz below came out as invalid JSON:\n{fragment}\n\n"
+        "Return only that question as one valid JSON object with fields "
+        "number:int, question:str, choices:[str] (optional), answer:str, explanation:str."
+    )
+    messages = job.messages + [{"role": "user", "content": prompt}]
+    return ChatJob(messages, 0.2, 300, job.sources, job.use_cache,
+                   lambda raw, srcs: parse_question(raw, number), job.priority, fmt=QUESTION_SCHEMA)
+
+def finish_quiz(questions: List[Dict], sources: List[Dict]) -> Dict:
+    """The /generate_quiz-shaped quiz from the streamed questions (explanations pulled out into a list)."""
+    quiz = {"questions": [{k: v for k, v in q.items() if k != "explanation"} for q in questions],
+            "explanations": [str(q.get("explanation", "")) for q in questions]}
+    return {"quiz": quiz, "sources": sources}
+
+def busy_body(e: Busy) -> Tuple[Dict, Dict]:
+    """JSON body and headers of the 429 answer to a Busy."""
+    where = f"you would be #{e.position} in the queue"
+    if e.eta_s is not None:
+        where += f", about {e.eta_s:g}s"
+    body = {"error": f"Server busy ({e}): {where}. Please try again shortly.",
+            "queue_position": e.position, "eta_s": e.eta_s}
+    return body, {"Retry-After": str(max(1, math.ceil(e.eta_s or 5)))}
+
+def health_info() -> Dict:
+    """Backend state; "status" is "ok" once the model is loaded (or MODEL_WARMUP is off), else "warming"."""
+    return {"status": "ok" if model_ready() else "warming",
+            "model_status": ollama_backends.model_status() if MODEL_WARMUP else None,
+            "packs": index.pack_names, "pack_states": index.pack_states(),
+            "retrieval_cache": index.retrieval_cache.stats() if index.retrieval_cache else None,
+            "llm_cache": llm_cache.stats() if llm_cache else None,
+            "ollama_pool": ollama_pool_stats(),
+            "ollama_backends": ollama_backends.stats(),
+            "scheduler": scheduler.stats(),
+            "coalescing": {"calls": inflight_calls.stats(), "streams": stream_fanout.stats()},
+            "prompt_cache": prompt_stats.stats(),
+            "sessions": sessions.stats(),
+            "model": OLLAMA_MODEL}
+
+def metrics_gauges() -> List[Tuple[str, str, str, float]]:
+    """Point-in-time values for /metrics, read from the same stats() as /health."""
+    sched = scheduler.stats()
+    gauges = [("studypack_llm_active", "gauge", "Generations holding a scheduler slot.", sched["active"]),
+              ("studypack_llm_queued", "gauge", "Requests waiting for a scheduler slot.", sched["queued"]),
+              ("studypack_llm_admitted_total", "counter", "Requests the scheduler admitted.", sched["admitted"]),
+              ("studypack_llm_rejected_total", "counter", "Requests the scheduler turned away (429).",
+               sched["rejected"]),
+              ("studypack_sessions_active", "gauge", "Live tutor sessions.", sessions.stats()["active"])]
+    for name, cache in (("retrieval", index.retrieval_cache), ("llm", llm_cache)):
+        if cache is not None:
+            stats = cache.stats()
+            gauges.append((f"studypack_{name}_cache_hits_total", "counter", f"{name.title()} cache hits.",
+                           stats["hits"]))
+            gauges.append((f"studypack_{name}_cache_misses_total", "counter", f"{name.title()} cache misses.",
+                           stats["misses"]))
+    return gauges
+
+def packs_info() -> Dict:
+    return {"packs": index.pack_names, "states": index.pack_states()}
+
+# -------- Structured streams --------
+# /ask_stream answers text/plain by default. With ?format=ndjson or sse (or an
+# Accept header asking for either) it sends JSON events instead: "sources"
+# first, a "delta" per chunk of text, "error" if the model failed mid-way and
+# a final "done" with timings and Ollama's counters.
+STREAM_MIMETYPES = {"text": "text/plain", "ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+def stream_protocol(fmt: Optional[str], accept: str) -> str:
+    fmt = (fmt or "").lower()
+    if fmt in STREAM_MIMETYPES:
+        return fmt
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    if "text/event-stream" in accept:
+        return "sse"
+    return "text"
+
+def stream_event(kind: str, data: Dict, protocol: str) -> str:
+    body = json.dumps({"type": kind, **data}, ensure_ascii=False)
+    if protocol == "sse":
+        return f"event: {kind}\ndata: {body}\n\n"
+    return body + "\n"
+
+def stream_headers(protocol: str) -> Dict:
+    # Keep proxies from buffering the events.
+    return {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} if protocol == "sse" else {}
+
+class StreamTimer:
+    """Time to first token and throughput of one reader's stream, for the final "done" event."""
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.first: Optional[float] = None
+        self.chunks = 0
+        self.chars = 0
+
+    def tick(self, chunk: str):
+        if self.first is None:
+            self.first = time.perf_counter()
+        self.chunks += 1
+        self.chars += len(chunk)
+
+    def summary(self, meta: Dict, sources: List[Dict], joined: bool) -> Dict:
+        """Timings measured here (ms) plus Ollama's counters; durations converted from ns to ms."""
+        now = time.perf_counter()
+        out = {"ttft_ms": round((self.first - self.t0) * 1000) if self.first is not None else None,
+               "total_ms": round((now - self.t0) * 1000), "chunks": self.chunks, "chars": self.chars,
+               "joined": joined, "sources": sources}
+        for k in ("prompt_eval_count", "eval_count"):
+            if k in meta:
+                out[k] = meta[k]
+        for k, name in (("total_duration", "model_total_ms"), ("load_duration", "load_ms"),
+                        ("prompt_eval_duration", "prompt_eval_ms"), ("eval_duration", "eval_ms")):
+            if k in meta:
+                out[name] = round(meta[k] / 1e6)
+        for k in ("reused_tokens_est", "saved_ms_est"):
+            if k in meta:
+                out[k] = meta[k]
+        if meta.get("eval_count") and meta.get("eval_duration"):
+            out["tokens_per_s"] = round(meta["eval_count"] / (meta["eval_duration"] / 1e9), 1)
+        return out
+
+# -------- Request metrics --------
+@app.before_request
+def _start_timer():
+    start_request_timer(request.url_rule.rule if request.url_rule else "other")
+
+@app.after_request
+def _finish_timer(response):
+    timer = _request_timer.get()
+    if timer is None:
+        return response
+    if SERVER_TIMING or request.headers.get("X-Server-Timing") == "1":
+        response.headers["Server-Timing"] = timer.server_timing()
+    if response.is_streamed:
+        # Streams are timed until the body has been sent (or the client has gone).
+        status = response.status_code
+        response.call_on_close(lambda: timer.finish(status))
+    else:
+        timer.finish(response.status_code)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(render_metrics(metrics_gauges()), mimetype="text/plain; version=0.0.4")
+
+def _follow_timed(sub: StreamSubscription, error_text: bool = True) -> Iterator[str]:
+    """sub.follow(), adding time to first chunk and (for the leader) Ollama's counters to this request."""
+    timer, t0 = _request_timer.get(), time.perf_counter()
+
+    def chunks():
+        ttft = None
+        for chunk in sub.follow(error_text=error_text):
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            yield chunk
+        record_ollama(sub.flight.meta if sub.leader else None, time.perf_counter() - t0, ttft, timer)
+    return chunks()
+
+# -------- Health endpoint (useful for debugging) ----------
+@app.route("/health", methods=["GET"])
+def health():
+    info = health_info()
+    # 503 until the model is loaded, so load balancers hold traffic back.
+    return jsonify(info), 200 if info["status"] == "ok" else 503
+
+@app.route("/packs", methods=["GET"])
+def list_packs():
+    return jsonify(packs_info())
+
+@app.route("/reindex", methods=["POST"])
+def reindex():
+    """Pick up added/changed/removed study pack files without a restart."""
+    if ADMIN_TOKEN and request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return jsonify({"error": "Forbidden"}), 403
+    if request.args.get("wait", "").lower() in ("1", "true", "yes"):
+        return jsonify(index.reindex())
+    threading.Thread(target=index.reindex, name="reindex", daemon=True).start()
+    return jsonify({"status": "started", "last": index.last_reindex}), 202
+
+def _client_id() -> str:
+    return request.headers.get("X-Client-Id") or request.remote_addr or ""
+
+def _busy_response(e: Busy):
+    body, headers = busy_body(e)
+    return jsonify(body), 429, headers
+
+def _run_chat_job(make_job):
+    """Build a ChatJob from the request body, run it and return the route's JSON response."""
+    try:
+        job = make_job(request.get_json(force=True))
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), e.status
+    if not job.needs_model:
+        return jsonify(job.response(""))
+    try:
+        answer = call_ollama_chat(job.messages, temperature=job.temperature, max_tokens=job.max_tokens,
+                                  use_cache=job.use_cache, priority=job.priority, client=_client_id(),
+                                  affinity=job.affinity)
+        return jsonify(job.response(answer))
+    except Busy as e:
+        return _busy_response(e)
     except requests.RequestException as e:
         return jsonify({"error": str(e)}), 502
 
+def _open_stream(job: ChatJob) -> StreamSubscription:
+    """Join the identical stream in flight, or start one; raises Busy when no slot is to be had."""
+    key = payload_key(chat_payload(job.messages, job.temperature, job.max_tokens, stream=True, fmt=job.fmt))
+    sub = stream_fanout.subscribe(key)
+    try:
+        if sub.leader:
+            # The slot is held until the upstream stream ends or every reader has gone.
+            try:
+                ticket = scheduler.acquire(job.priority, _client_id())
+            except Busy as e:
+                stream_fanout.fail(sub, e)
+                raise
+            upstream = call_ollama_chat_stream(job.messages, temperature=job.temperature,
+                                               max_tokens=job.max_tokens, fmt=job.fmt, meta=sub.flight.meta,
+                                               affinity=job.affinity)
+            if STREAM_GUARDRAILS:
+                upstream = guard_stream(upstream)
+            stream_fanout.start(sub, upstream, lambda: scheduler.release(ticket))
+        else:
+            sub.wait_live()
+    except Busy:
+        sub.close()
+        raise
+    return sub
+
+# ----- Tutor chat -----
+@app.route("/ask_stream", methods=["POST"])
+def ask_stream():
+    timer = StreamTimer()
+    try:
+        job = ask_job(request.get_json(force=True))
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), e.status
+
+    protocol = stream_protocol(request.args.get("format"), request.headers.get("Accept", ""))
+    try:
+        sub = _open_stream(job)
+    except Busy as e:
+        return _busy_response(e)
+
+    def follow(error_text: bool = True) -> Iterator[str]:
+        parts = []
+        for chunk in _follow_timed(sub, error_text=error_text):
+            parts.append(chunk)
+            yield chunk
+        if not sub.flight.error:
+            job.answered("".join(parts))
+
+    def events():
+        yield stream_event("sources", {"sources": job.sources}, protocol)
+        for chunk in follow(error_text=False):
+            timer.tick(chunk)
+            yield stream_event("delta", {"delta": chunk}, protocol)
+        if sub.flight.error:
+            yield stream_event("error", {"error": sub.flight.error.strip()}, protocol)
+        yield stream_event("done", timer.summary(sub.flight.meta, job.sources, not sub.leader), protocol)
+
+    body = follow() if protocol == "text" else events()
+    response = Response(body, mimetype=STREAM_MIMETYPES[protocol], headers=stream_headers(protocol))
+    # Also covers a client that disconnects before the first chunk is pulled.
+    response.call_on_close(sub.close)
+    return response
+
+@app.route("/ask", methods=["POST"])
+def ask():
+    return _run_chat_job(ask_job)
+
+@app.route("/sessions/<session_id>", methods=["GET", "DELETE"])
+def tutor_session(session_id: str):
+    """A session's summary and recent turns; DELETE ends it."""
+    if request.method == "DELETE":
+        return jsonify({"deleted": sessions.drop(session_id)})
+    try:
+        session = sessions.get(session_id, create=False)
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), e.status
+    if session is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+    return jsonify(session.info())
+
+# ----- Lesson generator -----
+@app.route("/generate_lesson", methods=["POST"])
+def generate_lesson():
+    return _run_chat_job(lesson_job)
+
+# ----- Quiz generator -----
+@app.route("/generate_quiz", methods=["POST"])
+def generate_quiz():
+    return _run_chat_job(quiz_job)
+
+@app.route("/generate_quiz_stream", methods=["POST"])
+def generate_quiz_stream():
+    """NDJSON: {"question": {...}} per question as it completes, then {"done": true, "quiz": ..., ...}."""
+    try:
+        job = quiz_job(request.get_json(force=True), streaming=True)
+        sub = _open_stream(job)
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), e.status
+    except Busy as e:
+        return _busy_response(e)
+    client = _client_id()
+
+    def line(obj: Dict) -> str:
+        return json.dumps(obj, ensure_ascii=False) + "\n"
+
+    parser = QuizStreamParser()
+
+    def fragments():
+        for chunk in _follow_timed(sub, error_text=False):
+            yield from parser.feed(chunk)
+        tail = parser.flush()
+        if tail:
+            yield tail
+
+    def generate():
+        questions, repaired, failed = [], 0, 0
+        for fragment in fragments():
+            number = len(questions) + 1
+            q = parse_question(fragment, number)
+            if q is None:
+                fix = question_repair_job(job, fragment, number)
+                try:
+                    q = fix.response(call_ollama_chat(fix.messages, temperature=fix.temperature,
+                                                      max_tokens=fix.max_tokens, use_cache=fix.use_cache,
+                                                      priority=fix.priority, client=client, fmt=fix.fmt))
+                except (Busy, requests.RequestException) as e:
+                    print(f"[quiz] could not re-request question {number}: {e}")
+                repaired += q is not None
+            if q is None:
+                failed += 1
+                continue
+            questions.append(q)
+            yield line({"question": q})
+        if sub.flight.error:
+            yield line({"error": sub.flight.error.strip()})
+        done = {"done": True, **job.response(questions), "repaired": repaired, "failed": failed}
+        if not questions:
+            done["raw"] = parser.text
+        yield line(done)
+
+    response = Response(generate(), mimetype="application/x-ndjson")
+    response.call_on_close(sub.close)
+    return response
+
+# ----- Auto-grader -----
+@app.route("/grade_quiz", methods=["POST"])
+def grade_quiz():
+    return _run_chat_job(grade_job)
+
+@app.route("/grade_quiz_bulk", methods=["POST"])
+def grade_quiz_bulk():
+    """One quiz, many students: NDJSON, one line per student as their grading completes, then a summary."""
+    try:
+        bulk = BulkGrading(request.get_json(force=True))
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), e.status
+    client = _client_id()
+
+    def run(job: ChatJob) -> str:
+        return call_ollama_chat(job.messages, temperature=job.temperature, max_tokens=job.max_tokens,
+                                use_cache=job.use_cache, priority=job.priority, client=client)
+
+    def generate():
+        for result in bulk.ready():
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        # Stay within this client's share of the scheduler queue.
+        pool = ThreadPoolExecutor(max_workers=max(1, min(scheduler.concurrency, LLM_CLIENT_QUEUE)),
+                                  thread_name_prefix="bulk-grade")
+        try:
+            # Each worker gets a copy of the request's context, so its calls are timed too.
+            futures = {pool.submit(contextvars.copy_context().run, run, job): i
+                       for i, job in enumerate(bulk.jobs)}
+            for fut in as_completed(futures):
+                i = futures[fut]
+                try:
+                    results = bulk.apply(i, fut.result())
+                except (Busy, requests.RequestException) as e:
+                    results = bulk.fail(i, str(e))
+                for result in results:
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+            yield json.dumps(bulk.summary()) + "\n"
+        finally:
+            # A client that went away doesn't keep batches queued.
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
 
 if __name__ == "__main__":
     print(f"Loaded study packs: {index.pack_names}")
+    for line in index.report_lines():
+        print(line)
+    if not index.lazy:
+        print(index.memory_line())
+    start_index_warmup()
+    start_reindex_watcher()
+    start_backend_probes()
     # Turn OFF debug/reloader to prevent stream disconnects on Windows.
     app.run(host="127.0.0.1", port=5000, debug=False, threaded=True, use_reloader=False)
\ No newline at end of file
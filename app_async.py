@@ -0,0 +1,611 @@
+# app_async.py
+"""
+Async (ASGI) serving mode: the routes of app.py on one event loop.
+
+Ollama calls go through httpx's async client, so an open /ask_stream costs a
+coroutine instead of an OS thread and one process can relay hundreds of
+token streams. Request parsing, retrieval and prompt building are the same
+functions the Flask app uses (app.ask_job and friends); they block, so they
+run on a worker thread pool, as do the SQLite response-cache lookups.
+Identical requests in flight share one generation, as in app.py (LLM_COALESCE).
+
+Needs the optional packages in requirements-async.txt:
+    pip install -r requirements-async.txt
+    python app_async.py          # or: uvicorn app_async:app --port 5000
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Optional
+
+try:
+    import httpx
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.background import BackgroundTask
+    from starlette.datastructures import Headers
+    from starlette.middleware import Middleware
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+    from starlette.routing import Match, Route
+except ImportError as e:
+    raise SystemExit(f"Async mode needs starlette, uvicorn and httpx ({e}). "
+                     "Install them with: pip install -r requirements-async.txt")
+
+import app as core
+
+# Threads for blocking work (retrieval, prompt building, cache lookups).
+ASYNC_WORKERS = int(os.environ.get("ASYNC_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
+
+_workers = ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix="async-worker")
+# Threads parked in app.scheduler.acquire(); the scheduler never lets more than
+# this many wait or run, so queued requests can't starve the retrieval workers.
+_admission = ThreadPoolExecutor(max_workers=core.LLM_QUEUE_SIZE + core.scheduler.concurrency,
+                                thread_name_prefix="async-admission")
+_client: Optional[httpx.AsyncClient] = None
+# In-flight generations by app.payload_key(), joined by identical requests.
+_calls: Dict[str, "asyncio.Future"] = {}
+_streams: Dict[str, "_StreamFlight"] = {}
+
+class OllamaError(Exception):
+    pass
+
+async def _blocking(fn, *args):
+    # Run in a copy of this request's context, so app.timed() stages land on its timer.
+    return await asyncio.get_running_loop().run_in_executor(_workers, contextvars.copy_context().run, fn, *args)
+
+def _release_if_granted(fut):
+    if not fut.cancelled() and fut.exception() is None:
+        core.scheduler.release(fut.result())
+
+async def _admit(priority: int, client: str):
+    """Wait for a scheduler slot without blocking the loop; raises app.Busy like acquire()."""
+    fut = asyncio.get_running_loop().run_in_executor(_admission, contextvars.copy_context().run,
+                                                     core.scheduler.acquire, priority, client)
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        # The caller went away while queued: free the slot once it is granted.
+        fut.add_done_callback(_release_if_granted)
+        raise
+
+def _client_id(request: Request) -> str:
+    return request.headers.get("X-Client-Id") or (request.client.host if request.client else "")
+
+def _busy_response(e: core.Busy) -> JSONResponse:
+    body, headers = core.busy_body(e)
+    return JSONResponse(body, status_code=429, headers=headers)
+
+async def _json_body(request: Request) -> Dict:
+    try:
+        data = await request.json()
+    except ValueError:
+        raise core.BadRequest("Request body must be JSON")
+    if not isinstance(data, dict):
+        raise core.BadRequest("Request body must be a JSON object")
+    return data
+
+# -------------- Ollama client --------------
+def _httpx_fault(e: httpx.HTTPError) -> bool:
+    response = e.response if isinstance(e, httpx.HTTPStatusError) else None
+    return core.backend_fault(response.status_code if response is not None else None)
+
+async def _next_backend(affinity: Optional[str], tried: list, attempt: int):
+    """Async twin of app._next_backend."""
+    backend = core.ollama_backends.acquire(affinity, exclude=tried)
+    if backend is None and tried:
+        await asyncio.sleep(core.RETRY_BACKOFF * attempt)
+        backend = core.ollama_backends.acquire(affinity)
+    return backend
+
+async def _ollama_chat_request(payload: Dict, affinity: Optional[str] = None) -> Dict:
+    """POST to the least busy healthy backend, retrying if it fails (async twin of app._ollama_chat_request)."""
+    tried = []
+    last_err = "no Ollama backend available"
+    for attempt in range(core.MAX_RETRIES + 1):
+        backend = await _next_backend(affinity, tried, attempt)
+        if backend is None:
+            break
+        tried.append(backend)
+        fault, error = False, ""
+        try:
+            r = await _client.post(f"{backend.url}/api/chat", json=payload)
+            r.raise_for_status()
+            data = r.json()
+        except httpx.HTTPError as e:
+            fault, error = _httpx_fault(e), str(e) or type(e).__name__
+            if not fault:
+                return {"_error": f"Ollama request failed: {error}"}
+            last_err = f"{backend.url}: {error}"
+            continue
+        except ValueError as e:
+            fault, error = True, f"invalid JSON ({e})"
+            last_err = f"{backend.url}: {error}"
+            continue
+        finally:
+            core.ollama_backends.release(backend, fault, error)
+        # Some Ollama errors come back inside JSON
+        if "error" in data and data["error"]:
+            return {"_error": f"Ollama error: {data['error']}"}
+        return data
+    return {"_error": f"Ollama request failed: {last_err}"}
+
+async def _generate(payload: Dict, key: str, cache, priority: int, client: str,
+                    affinity: Optional[str] = None) -> str:
+    ticket = await _admit(priority, client)
+    try:
+        t0 = time.perf_counter()
+        data = await _ollama_chat_request(payload, affinity)
+        wall = time.perf_counter() - t0
+    finally:
+        core.scheduler.release(ticket)
+    if "_error" in data:
+        raise OllamaError(data["_error"])
+    core.record_ollama(data, wall)
+    core.prompt_stats.record(payload["messages"], data)
+    content = data.get("message", {}).get("content", "")
+    if cache is not None and content:
+        await _blocking(cache.put, key, content)
+    return content
+
+def _forget_call(key: str, fut: "asyncio.Future"):
+    if _calls.get(key) is fut:
+        del _calls[key]
+    if not fut.cancelled():
+        fut.exception()  # retrieved, even if every caller went away
+
+async def call_ollama_chat(job: core.ChatJob, client: str) -> str:
+    payload = core.chat_payload(job.messages, job.temperature, job.max_tokens, fmt=job.fmt)
+    key = core.payload_key(payload)
+    cache = core.llm_cache if job.use_cache else None
+    if cache is not None:
+        cached = await _blocking(cache.get, key)
+        if cached is not None:
+            return cached
+    fut = _calls.get(key) if core.LLM_COALESCE else None
+    if fut is None:
+        # A task, so the generation outlives the caller that started it.
+        fut = asyncio.ensure_future(_generate(payload, key, cache, job.priority, client, job.affinity))
+        fut.add_done_callback(lambda f: _forget_call(key, f))
+        if core.LLM_COALESCE:
+            _calls[key] = fut
+    return await asyncio.shield(fut)
+
+async def call_ollama_chat_stream(job: core.ChatJob, meta: Optional[Dict] = None) -> AsyncIterator[str]:
+    """
+    Yield text chunks as Ollama generates them; Ollama's final counters go into
+    `meta`. A failure before the first chunk is retried like a blocking call.
+    """
+    payload = core.chat_payload(job.messages, job.temperature, job.max_tokens, stream=True, fmt=job.fmt)
+    tried = []
+    for attempt in range(core.MAX_RETRIES + 1):
+        backend = await _next_backend(job.affinity, tried, attempt)
+        if backend is None:
+            raise OllamaError("No Ollama backend available")
+        tried.append(backend)
+        started = fault = False
+        error = ""
+        try:
+            # Leaving the block (finished, or the client went away) releases the connection.
+            async with _client.stream("POST", f"{backend.url}/api/chat", json=payload) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if not line:
+                        continue
+                    chunk, stats = core.stream_line(line)
+                    if stats is not None:
+                        stats.update(core.prompt_stats.record(job.messages, stats))
+                        if meta is not None:
+                            meta.update(stats)
+                    if chunk:
+                        started = True
+                        yield chunk
+            return
+        except httpx.HTTPError as e:
+            fault, error = _httpx_fault(e), str(e) or type(e).__name__
+            if started or not fault or attempt == core.MAX_RETRIES:
+                raise
+            print(f"[ollama] {backend.url} failed ({error}); retrying")
+        finally:
+            core.ollama_backends.release(backend, fault, error)
+
+async def _guard_stream(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Async twin of app.guard_stream."""
+    scanner = core.guardrails.scanner()
+    try:
+        async for chunk in chunks:
+            safe, reason = scanner.feed(chunk)
+            if safe:
+                yield safe
+            if reason:
+                raise core.GuardrailViolation(reason)
+        safe, reason = scanner.finish()
+        if safe:
+            yield safe
+        if reason:
+            raise core.GuardrailViolation(reason)
+    finally:
+        await chunks.aclose()
+
+class _StreamFlight:
+    """One upstream token stream shared by identical /ask_stream requests (async twin of app.StreamFanout)."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = ""
+        self.subscribers = 0
+        self.meta: Dict = {}  # Ollama's counters from the final frame
+        self.changed = asyncio.Event()
+        self.started = asyncio.get_running_loop().create_future()  # the leader's slot, or its Busy
+        self.task: Optional[asyncio.Task] = None
+
+    def _wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def produce(self, job: core.ChatJob, client: str):
+        ticket = None
+        try:
+            ticket = await _admit(job.priority, client)
+            self.started.set_result(None)
+            upstream = call_ollama_chat_stream(job, self.meta)
+            if core.STREAM_GUARDRAILS:
+                upstream = _guard_stream(upstream)
+            try:
+                async for chunk in upstream:
+                    self.chunks.append(chunk)
+                    self._wake()
+            finally:
+                await upstream.aclose()
+        except core.Busy as e:
+            self.started.set_exception(e)
+            self.started.exception()  # readers that went away never look at it
+        except (httpx.HTTPError, OllamaError) as e:
+            self.error = f"\n\n[Error] Ollama request failed: {str(e) or type(e).__name__}"
+        except core.GuardrailViolation as e:
+            self.error = f"\n\n[Stopped by safety guardrails: {e}]"
+        finally:
+            core.scheduler.release(ticket)
+            self._forget()
+            self.done = True
+            self._wake()
+
+    def _forget(self):
+        if _streams.get(self.key) is self:
+            del _streams[self.key]
+
+    def subscribe(self, leader: bool = False) -> "_Subscription":
+        self.subscribers += 1
+        return _Subscription(self, leader)
+
+class _Subscription:
+    """One reader: replays the chunks emitted so far, then follows live."""
+
+    def __init__(self, flight: _StreamFlight, leader: bool):
+        self.flight = flight
+        self.leader = leader  # this request started the upstream stream
+        self._closed = False
+
+    async def follow(self, error_text: bool = True) -> AsyncIterator[str]:
+        flight = self.flight
+        i = 0
+        try:
+            while True:
+                while i < len(flight.chunks):
+                    yield flight.chunks[i]
+                    i += 1
+                if flight.done:
+                    if flight.error and error_text:
+                        yield flight.error
+                    return
+                await flight.changed.wait()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop reading; the last reader to leave cancels the upstream stream. Safe to call twice."""
+        if self._closed:
+            return
+        self._closed = True
+        flight = self.flight
+        flight.subscribers -= 1
+        if flight.subscribers == 0:
+            flight._forget()
+            if not flight.done:
+                flight.task.cancel()
+
+async def _follow_timed(sub: _Subscription, error_text: bool = True) -> AsyncIterator[str]:
+    """Async twin of app._follow_timed."""
+    timer, t0 = core._request_timer.get(), time.perf_counter()
+    ttft = None
+    async for chunk in sub.follow(error_text=error_text):
+        if ttft is None:
+            ttft = time.perf_counter() - t0
+        yield chunk
+    core.record_ollama(sub.flight.meta if sub.leader else None, time.perf_counter() - t0, ttft, timer)
+
+def _pool_stats() -> Dict:
+    pool = getattr(getattr(_client, "_transport", None), "_pool", None)
+    conns = list(getattr(pool, "connections", []))
+    return {"pool_size": core.OLLAMA_POOL_SIZE, "open": len(conns),
+            "idle": sum(1 for c in conns if c.is_idle())}
+
+# -------------- Routes --------------
+async def health(request: Request) -> JSONResponse:
+    info = await _blocking(core.health_info)
+    info["ollama_pool"] = _pool_stats()
+    info["coalescing"] = {"calls": {"in_flight": len(_calls)}, "streams": {"in_flight": len(_streams)}}
+    info["server"] = "asgi"
+    return JSONResponse(info, status_code=200 if info["status"] == "ok" else 503)
+
+async def metrics(request: Request) -> PlainTextResponse:
+    text = await _blocking(lambda: core.render_metrics(core.metrics_gauges()))
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+async def list_packs(request: Request) -> JSONResponse:
+    return JSONResponse(core.packs_info())
+
+async def tutor_session(request: Request) -> JSONResponse:
+    session_id = request.path_params["session_id"]
+    if request.method == "DELETE":
+        return JSONResponse({"deleted": core.sessions.drop(session_id)})
+    try:
+        session = core.sessions.get(session_id, create=False)
+    except core.BadRequest as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status)
+    if session is None:
+        return JSONResponse({"error": "Unknown or expired session"}, status_code=404)
+    return JSONResponse(session.info())
+
+async def reindex(request: Request) -> JSONResponse:
+    if core.ADMIN_TOKEN and request.headers.get("X-Admin-Token") != core.ADMIN_TOKEN:
+        return JSONResponse({"error": "Forbidden"}, status_code=403)
+    if request.query_params.get("wait", "").lower() in ("1", "true", "yes"):
+        return JSONResponse(await _blocking(core.index.reindex))
+    threading.Thread(target=core.index.reindex, name="reindex", daemon=True).start()
+    return JSONResponse({"status": "started", "last": core.index.last_reindex}, status_code=202)
+
+async def _build_job(request: Request, make_job) -> core.ChatJob:
+    return await _blocking(make_job, await _json_body(request))
+
+def _chat_route(make_job):
+    """An endpoint that builds a ChatJob off the loop, awaits the model and returns the route's JSON."""
+    async def endpoint(request: Request) -> JSONResponse:
+        try:
+            job = await _build_job(request, make_job)
+        except core.BadRequest as e:
+            return JSONResponse({"error": str(e)}, status_code=e.status)
+        if not job.needs_model:
+            return JSONResponse(job.response(""))
+        try:
+            answer = await call_ollama_chat(job, _client_id(request))
+        except core.Busy as e:
+            return _busy_response(e)
+        except OllamaError as e:
+            return JSONResponse({"error": str(e)}, status_code=502)
+        return JSONResponse(job.response(answer))
+    return endpoint
+
+async def _open_stream(job: core.ChatJob, client: str) -> _Subscription:
+    """Join the identical stream in flight, or start one; raises app.Busy when no slot is to be had."""
+    key = core.payload_key(core.chat_payload(job.messages, job.temperature, job.max_tokens,
+                                             stream=True, fmt=job.fmt))
+    flight = _streams.get(key) if core.LLM_COALESCE else None
+    leader = flight is None
+    if leader:
+        # The producer holds the slot until the stream ends or its last reader leaves.
+        flight = _StreamFlight(key)
+        flight.task = asyncio.ensure_future(flight.produce(job, client))
+        if core.LLM_COALESCE:
+            _streams[key] = flight
+    sub = flight.subscribe(leader)
+    try:
+        await asyncio.shield(flight.started)
+    except (core.Busy, asyncio.CancelledError):
+        sub.close()
+        raise
+    return sub
+
+async def ask_stream(request: Request):
+    timer = core.StreamTimer()
+    try:
+        job = await _build_job(request, core.ask_job)
+    except core.BadRequest as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status)
+
+    protocol = core.stream_protocol(request.query_params.get("format"), request.headers.get("accept", ""))
+    try:
+        sub = await _open_stream(job, _client_id(request))
+    except core.Busy as e:
+        return _busy_response(e)
+
+    async def follow(error_text: bool = True) -> AsyncIterator[str]:
+        parts = []
+        async for chunk in _follow_timed(sub, error_text=error_text):
+            parts.append(chunk)
+            yield chunk
+        if not sub.flight.error:
+            job.answered("".join(parts))
+
+    async def events():
+        yield core.stream_event("sources", {"sources": job.sources}, protocol)
+        async for chunk in follow(error_text=False):
+            timer.tick(chunk)
+            yield core.stream_event("delta", {"delta": chunk}, protocol)
+        if sub.flight.error:
+            yield core.stream_event("error", {"error": sub.flight.error.strip()}, protocol)
+        yield core.stream_event("done", timer.summary(sub.flight.meta, job.sources, not sub.leader), protocol)
+
+    body = follow() if protocol == "text" else events()
+    # The background task also lets go if the body was never iterated.
+    return StreamingResponse(body, media_type=core.STREAM_MIMETYPES[protocol],
+                             headers=core.stream_headers(protocol), background=BackgroundTask(sub.close))
+
+async def generate_quiz_stream(request: Request):
+    """Async twin of app.generate_quiz_stream."""
+    try:
+        job = await _blocking(lambda data: core.quiz_job(data, streaming=True), await _json_body(request))
+        sub = await _open_stream(job, _client_id(request))
+    except core.BadRequest as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status)
+    except core.Busy as e:
+        return _busy_response(e)
+    client = _client_id(request)
+
+    def line(obj: Dict) -> str:
+        return json.dumps(obj, ensure_ascii=False) + "\n"
+
+    parser = core.QuizStreamParser()
+
+    async def fragments():
+        async for chunk in _follow_timed(sub, error_text=False):
+            for fragment in parser.feed(chunk):
+                yield fragment
+        tail = parser.flush()
+        if tail:
+            yield tail
+
+    async def generate():
+        questions, repaired, failed = [], 0, 0
+        async for fragment in fragments():
+            number = len(questions) + 1
+            q = core.parse_question(fragment, number)
+            if q is None:
+                fix = core.question_repair_job(job, fragment, number)
+                try:
+                    q = fix.response(await call_ollama_chat(fix, client))
+                except (core.Busy, OllamaError) as e:
+                    print(f"[quiz] could not re-request question {number}: {e}")
+                repaired += q is not None
+            if q is None:
+                failed += 1
+                continue
+            questions.append(q)
+            yield line({"question": q})
+        if sub.flight.error:
+            yield line({"error": sub.flight.error.strip()})
+        done = {"done": True, **job.response(questions), "repaired": repaired, "failed": failed}
+        if not questions:
+            done["raw"] = parser.text
+        yield line(done)
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson",
+                             background=BackgroundTask(sub.close))
+
+async def grade_quiz_bulk(request: Request):
+    try:
+        bulk = await _blocking(core.BulkGrading, await _json_body(request))
+    except core.BadRequest as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status)
+    client = _client_id(request)
+    # Stay within this client's share of the scheduler queue.
+    limit = asyncio.Semaphore(max(1, min(core.scheduler.concurrency, core.LLM_CLIENT_QUEUE)))
+
+    async def run(i: int, job: core.ChatJob):
+        async with limit:
+            try:
+                return i, await call_ollama_chat(job, client), ""
+            except (core.Busy, OllamaError) as e:
+                return i, None, str(e)
+
+    async def generate():
+        for result in bulk.ready():
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        tasks = [asyncio.ensure_future(run(i, job)) for i, job in enumerate(bulk.jobs)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                i, raw, error = await next_done
+                results = bulk.apply(i, raw) if raw is not None else bulk.fail(i, error)
+                for result in results:
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+            yield json.dumps(bulk.summary()) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+def _route_label(scope) -> str:
+    """The matched route's path template, spelled as in app.py ("/sessions/<session_id>")."""
+    for route in app.router.routes:
+        if route.matches(scope)[0] == Match.FULL:
+            return route.path.replace("{", "<").replace("}", ">")
+    return "other"
+
+class RequestMetrics:
+    """Times each request like app.py's before/after_request hooks; streams until their last byte."""
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timer = core.start_request_timer(_route_label(scope))
+        if timer is None:
+            return await self.app(scope, receive, send)
+        header = core.SERVER_TIMING or Headers(scope=scope).get("x-server-timing") == "1"
+        status = 500
+
+        async def send_timed(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if header:
+                    message = dict(message, headers=list(message.get("headers", []))
+                                   + [(b"server-timing", timer.server_timing().encode())])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            timer.finish(status)
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    global _client
+    _client = httpx.AsyncClient(
+        timeout=httpx.Timeout(core.READ_TIMEOUT, connect=core.CONNECT_TIMEOUT),
+        # No cap on concurrent streams; only idle keep-alive connections are bounded
+        # (httpx counts them across hosts, so OLLAMA_POOL_SIZE per backend).
+        limits=httpx.Limits(max_connections=None,
+                            max_keepalive_connections=core.OLLAMA_POOL_SIZE * len(core.OLLAMA_HOSTS)),
+    )
+    core.start_index_warmup()
+    core.start_reindex_watcher()
+    core.start_backend_probes()
+    try:
+        yield
+    finally:
+        await _client.aclose()
+        _workers.shutdown(wait=False)
+        _admission.shutdown(wait=False)
+
+app = Starlette(routes=[
+    Route("/health", health, methods=["GET"]),
+    Route("/metrics", metrics, methods=["GET"]),
+    Route("/packs", list_packs, methods=["GET"]),
+    Route("/reindex", reindex, methods=["POST"]),
+    Route("/ask_stream", ask_stream, methods=["POST"]),
+    Route("/ask", _chat_route(core.ask_job), methods=["POST"]),
+    Route("/sessions/{session_id}", tutor_session, methods=["GET", "DELETE"]),
+    Route("/generate_lesson", _chat_route(core.lesson_job), methods=["POST"]),
+    Route("/generate_quiz", _chat_route(core.quiz_job), methods=["POST"]),
+    Route("/generate_quiz_stream", generate_quiz_stream, methods=["POST"]),
+    Route("/grade_quiz", _chat_route(core.grade_job), methods=["POST"]),
+    Route("/grade_quiz_bulk", grade_quiz_bulk, methods=["POST"]),
+], middleware=[Middleware(RequestMetrics)], lifespan=lifespan)
+
+
+if __name__ == "__main__":
+    print(f"Loaded study packs: {core.index.pack_names}")
+    for line in core.index.report_lines():
+        print(line)
+    uvicorn.run(app, host="127.0.0.1", port=5000)
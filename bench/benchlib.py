@@ -0,0 +1,100 @@
+"""Helpers shared by the bench scripts: percentiles, run metadata and baseline comparison."""
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# (metric path into a result row, True when higher is better)
+Metric = Tuple[Tuple[str, ...], bool]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile; None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), math.ceil(q / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def latency_summary(seconds: List[float]) -> Dict:
+    """p50/p95/p99/mean/max of `seconds`, in milliseconds."""
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {"p50": ms(percentile(seconds, 50)), "p95": ms(percentile(seconds, 95)),
+            "p99": ms(percentile(seconds, 99)),
+            "mean": ms(sum(seconds) / len(seconds)) if seconds else None,
+            "max": ms(max(seconds)) if seconds else None}
+
+
+def git_commit(path: str) -> Optional[str]:
+    """Short commit of the checkout holding `path`, with "+dirty" for uncommitted changes."""
+    try:
+        run = lambda *cmd: subprocess.run(["git", *cmd], capture_output=True, text=True, cwd=path,
+                                          timeout=10).stdout.strip()
+        commit = run("rev-parse", "--short", "HEAD")
+        if commit and run("status", "--porcelain", "--untracked-files=no"):
+            commit += "+dirty"
+        return commit or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_meta(**extra) -> Dict:
+    return dict({"started": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+                 "host": platform.node(), "cpus": os.cpu_count()}, **extra)
+
+
+def write_report(path: str, report: Dict):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n[bench] results written to {path}")
+
+
+def _metric(row: Dict, path: Sequence[str]) -> Optional[float]:
+    for key in path:
+        row = row.get(key) if isinstance(row, dict) else None
+    return row
+
+
+def compare(results: List[Dict], baseline_path: str, key: Sequence[str], metrics: List[Metric],
+            threshold: float) -> List[str]:
+    """
+    Print each metric of `results` against the rows of an earlier report with
+    the same `key` fields; returns the regressions beyond `threshold` (a fraction).
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    before = {tuple(r.get(k) for k in key): r for r in baseline}
+    regressions = []
+    print("\nvs baseline:")
+    for row in results:
+        label = " ".join(f"{k}={row.get(k)}" for k in key)
+        old = before.get(tuple(row.get(k) for k in key))
+        if old is None:
+            print(f"  {label}: not in baseline")
+            continue
+        parts = []
+        for path, higher_better in metrics:
+            new_v, old_v = _metric(row, path), _metric(old, path)
+            if new_v is None or old_v is None:
+                continue
+            name = ".".join(path)
+            if old_v == 0:
+                worse = (new_v < old_v) if higher_better else (new_v > old_v)
+                parts.append(f"{name} {old_v}->{new_v}")
+            else:
+                change = (new_v - old_v) / old_v
+                worse = (-change if higher_better else change) > threshold
+                parts.append(f"{name} {change:+.1%}")
+            if worse:
+                regressions.append(f"{label}: {parts[-1]}")
+        print(f"  {label}: " + ", ".join(parts))
+    if regressions:
+        print(f"\n[bench] {len(regressions)} regression(s) beyond {threshold:.0%}:")
+        for line in regressions:
+            print("  " + line)
+    return regressions
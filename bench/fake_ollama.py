@@ -0,0 +1,197 @@
+"""
+Stand-in Ollama server for benchmarking app.py / app_async.py without a model.
+
+Speaks the parts of the Ollama API the backend uses (/api/chat streaming and
+not, /api/ps, /api/tags) and replies in the shapes the routes expect: prose for
+asks and lessons, quiz JSON for quiz prompts, grading JSON for grader prompts.
+Timing follows a simple model of a real server: at most --parallel requests run
+at once, each first "evaluates" its prompt (--prompt-delay plus about
+len(prompt)/4 tokens at --prompt-tps), then emits --tokens tokens at
+--tokens-per-s. --error-rate of requests fail with HTTP 500.
+
+    python bench/fake_ollama.py --port 11500 --tokens-per-s 30 --parallel 2
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List
+
+FILLER = ("Plants use light energy to turn water and carbon dioxide into sugar and oxygen . "
+          "This happens in the chloroplasts , mostly in the leaves .").split()
+
+
+def quiz_json(count: int) -> Dict:
+    questions = []
+    for n in range(1, count + 1):
+        if n % 2:
+            questions.append({"number": n, "question": f"Which gas do plants release? ({n})",
+                              "choices": ["A) Oxygen", "B) Nitrogen", "C) Helium"], "answer": "A",
+                              "explanation": "Photosynthesis releases oxygen."})
+        else:
+            questions.append({"number": n, "question": f"Where does photosynthesis happen? ({n})",
+                              "answer": "In the chloroplasts", "explanation": "Chloroplasts hold chlorophyll."})
+    return {"questions": questions, "explanations": [q["explanation"] for q in questions]}
+
+
+def grading_json(prompt: str) -> Dict:
+    match = re.search(r"ITEMS:\n(.*)", prompt)
+    try:
+        items = json.loads(match.group(1)) if match else []
+    except ValueError:
+        items = []
+    verdicts = [{"correct": random.random() < 0.7, "explanation": "Matches the key idea."} for _ in items]
+    return {"per_question": [dict(v, number=it.get("number")) for v, it in zip(verdicts, items)],
+            "results": [dict(v, id=it.get("id")) for v, it in zip(verdicts, items)],
+            "feedback_summary": "Good effort; review the open questions."}
+
+
+def answer_for(body: Dict) -> str:
+    prompt = body["messages"][-1]["content"] if body.get("messages") else ""
+    if "auto-grader" in prompt:
+        return json.dumps(grading_json(prompt))
+    quiz = re.search(r"Generate a (\d+)-question quiz", prompt)
+    if quiz:
+        return json.dumps(quiz_json(int(quiz.group(1))))
+    if "Update the summary" in prompt:
+        return "The student asked about photosynthesis and understood the basics."
+    return ""  # prose, generated token by token
+
+
+class FakeOllama:
+    def __init__(self, args):
+        self.args = args
+        self.slots = threading.BoundedSemaphore(max(1, args.parallel))
+        self.model = args.model
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+
+    def tokens(self, body: Dict) -> List[str]:
+        """The reply split into tokens: canned JSON in ~4-character pieces, else prose of num_predict tokens."""
+        text = answer_for(body)
+        if text:
+            return [text[i:i + 4] for i in range(0, len(text), 4)]
+        limit = (body.get("options") or {}).get("num_predict") or self.args.tokens
+        count = min(self.args.tokens, int(limit))
+        return [FILLER[i % len(FILLER)] + " " for i in range(count)]
+
+    def generate(self, body: Dict) -> Iterator[Dict]:
+        """Ollama response frames; holds a --parallel slot for the whole generation."""
+        chars = sum(len(m.get("content") or "") for m in body.get("messages") or [])
+        prompt_tokens = max(1, chars // 4)
+        tokens = self.tokens(body)
+        with self.slots:
+            t0 = time.perf_counter()
+            prompt_s = self.args.prompt_delay + prompt_tokens / self.args.prompt_tps
+            time.sleep(prompt_s)
+            t1 = time.perf_counter()
+            for i, tok in enumerate(tokens):
+                # Sleep to where token i is due, so the rate holds however long each write takes.
+                due = t1 + (i + 1) / self.args.tokens_per_s
+                time.sleep(max(0.0, due - time.perf_counter()))
+                yield {"model": self.model, "message": {"role": "assistant", "content": tok}, "done": False}
+            t2 = time.perf_counter()
+        yield {"model": self.model, "message": {"role": "assistant", "content": ""}, "done": True,
+               "done_reason": "stop", "total_duration": int((t2 - t0) * 1e9), "load_duration": 0,
+               "prompt_eval_count": prompt_tokens, "prompt_eval_duration": int((t1 - t0) * 1e9),
+               "eval_count": len(tokens), "eval_duration": int((t2 - t1) * 1e9)}
+
+
+def make_handler(server: FakeOllama):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status: int, obj: Dict):
+            out = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def do_GET(self):
+            if self.path == "/api/ps":
+                self._json(200, {"models": [{"name": server.model, "model": server.model,
+                                             "expires_at": "2099-01-01T00:00:00Z"}]})
+            elif self.path == "/api/tags":
+                self._json(200, {"models": [{"name": server.model, "model": server.model}]})
+            elif self.path == "/stats":
+                with server.lock:
+                    self._json(200, {"requests": server.requests, "failed": server.failed})
+            else:
+                self._json(404, {"error": "not found"})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if self.path != "/api/chat":
+                self._json(404, {"error": "not found"})
+                return
+            fail = random.random() < server.args.error_rate
+            with server.lock:
+                server.requests += 1
+                server.failed += fail
+            if fail:
+                self._json(500, {"error": "simulated failure"})
+                return
+            if not body.get("messages"):  # warm-up load
+                self._json(200, {"model": server.model, "done": True, "done_reason": "load"})
+                return
+            frames = server.generate(body)
+            if body.get("stream", True) is False:
+                text, last = [], {}
+                for frame in frames:
+                    text.append(frame["message"]["content"])
+                    last = frame
+                last["message"]["content"] = "".join(text)
+                self._json(200, last)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for frame in frames:
+                    line = json.dumps(frame).encode() + b"\n"
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                frames.close()  # the client went away: free the slot, like Ollama does
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--model", default="gpt-oss:20b")
+    parser.add_argument("--prompt-delay", type=float, default=0.05, help="fixed seconds before the first token")
+    parser.add_argument("--prompt-tps", type=float, default=1000.0, help="prompt tokens evaluated per second")
+    parser.add_argument("--tokens-per-s", type=float, default=30.0, help="generated tokens per second per request")
+    parser.add_argument("--tokens", type=int, default=120, help="prose answer length in tokens (capped by num_predict)")
+    parser.add_argument("--parallel", type=int, default=2, help="requests generated at once (OLLAMA_NUM_PARALLEL)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of /api/chat calls answered 500")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(FakeOllama(args)))
+    httpd.daemon_threads = True
+    print(f"[fake-ollama] http://{args.host}:{args.port} parallel={args.parallel} "
+          f"tokens/s={args.tokens_per_s} error_rate={args.error_rate}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
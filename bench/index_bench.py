@@ -0,0 +1,354 @@
+"""
+Retrieval and indexing micro-benchmark for StudyPackIndex.
+
+Generates synthetic study packs (text files, plus a share of PDFs) of each
+requested size in chunks, then, in a fresh process per size so peak RSS is that
+size's own: times build_from_folder, records peak RSS, the index's matrix and
+vocabulary sizes, and retrieve() latency percentiles for one thread and for
+--threads concurrent threads. Results go to JSON; --baseline compares against
+an earlier report. --app-dir points at another checkout to benchmark its
+app.py with the same packs and queries.
+
+    python bench/index_bench.py --sizes 300,3000,30000 --out bench_results/index.json
+    python bench/index_bench.py --sizes 1000000 --pdf-share 0 --queries 100   # slow: ~2 GB of text
+
+Packs are cached under --data-dir and reused while their parameters match.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from benchlib import compare, git_commit, latency_summary, run_meta, write_report
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PARAGRAPHS_PER_FILE = 400
+PDF_PAGES_PER_FILE = 50
+
+# ---------------- Synthetic packs ----------------
+
+def make_vocabulary(size: int, seed: int) -> List[str]:
+    """Distinct pronounceable pseudo-words, 2-4 syllables each."""
+    rng = np.random.default_rng(seed)
+    onsets = "b c d f g h j k l m n p r s t v w z br cl dr fl gr pl st tr".split()
+    vowels = "a e i o u ai ea ou".split()
+    words, seen = [], set()
+    while len(words) < size:
+        syllables = rng.integers(2, 5)
+        word = "".join(onsets[rng.integers(len(onsets))] + vowels[rng.integers(len(vowels))]
+                       for _ in range(syllables))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+class TextSource:
+    """
+    Zipf-distributed word stream over a fixed vocabulary, like the term
+    frequencies of real prose. Paragraphs are sized to about 90% of a chunk,
+    so the chunker cuts one chunk per paragraph (or PDF page).
+    """
+
+    def __init__(self, vocab_size: int, seed: int, chunk_chars: int):
+        self.words = np.array(make_vocabulary(vocab_size, seed), dtype=object)
+        ranks = np.arange(1, vocab_size + 1, dtype=np.float64)
+        weights = 1.0 / ranks ** 1.07
+        self.cdf = np.cumsum(weights / weights.sum())
+        self.rng = np.random.default_rng(seed + 1)
+        mean_chars = float(np.dot(weights / weights.sum(), [len(w) + 1 for w in self.words]))
+        self.words_per_paragraph = max(8, int(0.9 * chunk_chars / mean_chars))
+
+    def words_(self, n: int) -> List[str]:
+        idx = np.searchsorted(self.cdf, self.rng.random(n))
+        return list(self.words[np.minimum(idx, len(self.words) - 1)])
+
+    def paragraph(self) -> str:
+        words = self.words_(self.words_per_paragraph)
+        sentences, i = [], 0
+        while i < len(words):
+            n = int(self.rng.integers(8, 18))
+            sentence = " ".join(words[i:i + n])
+            sentences.append(sentence[:1].upper() + sentence[1:] + ".")
+            i += n
+        return " ".join(sentences)
+
+
+def write_pdf(path: str, pages: List[str], line_chars: int = 95):
+    """A minimal PDF with one Helvetica text page per entry of `pages` (ASCII letters, spaces, dots only)."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines, line = [], ""
+        for word in text.split():
+            if line and len(line) + 1 + len(word) > line_chars:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.append(line)
+        ops = ["BT /F1 9 Tf 11 TL 36 806 Td"] + [f"({ln}) Tj T*" for ln in lines] + ["ET"]
+        stream = "\n".join(ops).encode("ascii")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (n, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % off for off in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def ensure_pack(data_dir: str, chunks: int, args) -> str:
+    """Folder holding one pack "bench" of about `chunks` chunks; generated unless a matching one exists."""
+    params = {"chunks": chunks, "vocab": args.vocab, "pdf_share": args.pdf_share, "seed": args.seed,
+              "chunk_chars": args.chunk_chars, "version": 2}
+    base = os.path.join(data_dir, f"c{chunks}-v{args.vocab}-p{args.pdf_share}-s{args.seed}")
+    marker = os.path.join(base, "params.json")
+    if os.path.exists(marker):
+        with open(marker, encoding="utf-8") as f:
+            if json.load(f) == params:
+                return base
+    pack = os.path.join(base, "bench")
+    os.makedirs(pack, exist_ok=True)
+    for name in os.listdir(pack):
+        os.remove(os.path.join(pack, name))
+
+    t0 = time.perf_counter()
+    source = TextSource(args.vocab, args.seed, args.chunk_chars)
+    pdf_pages = int(chunks * args.pdf_share)
+    written, n = 0, 0
+    while written < pdf_pages:
+        count = min(PDF_PAGES_PER_FILE, pdf_pages - written)
+        write_pdf(os.path.join(pack, f"doc{n:05d}.pdf"), [source.paragraph() for _ in range(count)])
+        written += count
+        n += 1
+    while written < chunks:
+        count = min(PARAGRAPHS_PER_FILE, chunks - written)
+        with open(os.path.join(pack, f"notes{n:05d}.txt"), "w", encoding="utf-8") as f:
+            f.write("\n\n".join(source.paragraph() for _ in range(count)))
+        written += count
+        n += 1
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump(params, f)
+    print(f"[bench] generated {base}: {n} files in {time.perf_counter() - t0:.1f}s", flush=True)
+    return base
+
+
+def make_queries(count: int, args) -> List[str]:
+    """Questions drawn from the same word distribution, so they hit the index like real ones."""
+    source = TextSource(args.vocab, args.seed, args.chunk_chars)
+    source.rng = np.random.default_rng(args.seed + 2)
+    return [" ".join(source.words_(int(source.rng.integers(3, 9)))) for _ in range(count)]
+
+# ---------------- Measurement (runs in a fresh process per size) ----------------
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+def new_index(core, cache_dir):
+    """A StudyPackIndex without a retrieval cache, whatever constructor this version of app.py has."""
+    for kwargs in ({"cache_dir": cache_dir, "retrieval_cache_size": 0}, {"cache_dir": cache_dir}, {}):
+        try:
+            return core.StudyPackIndex(**kwargs)
+        except TypeError:
+            continue
+    raise RuntimeError("cannot construct StudyPackIndex")
+
+
+def index_sizes(core, idx) -> Dict:
+    """Matrix and vocabulary sizes, from memory_report() or, in older versions, per-pack tfidf_mats/vectorizers."""
+    if hasattr(idx, "memory_report"):
+        return idx.memory_report()
+    mats = getattr(idx, "tfidf_mats", {})
+    vocabs = [v.vocabulary_ for v in getattr(idx, "vectorizers", {}).values()]
+    vocab_bytes = sum(sys.getsizeof(v) + sum(sys.getsizeof(t) + sys.getsizeof(i) for t, i in v.items())
+                      for v in vocabs)
+    return {"packs": len(mats), "chunks": sum(m.shape[0] for m in mats.values()),
+            "terms": sum(len(v) for v in vocabs), "nnz": int(sum(m.nnz for m in mats.values())),
+            "matrix_bytes": int(sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes for m in mats.values())),
+            "vocab_bytes": vocab_bytes}
+
+
+def time_queries(idx, queries: List[str], top_k: int) -> List[float]:
+    out = []
+    for q in queries:
+        t0 = time.perf_counter()
+        idx.retrieve("bench", q, top_k=top_k)
+        out.append(time.perf_counter() - t0)
+    return out
+
+
+def worker(args):
+    """Build the pack in args.folder with the app.py in args.app_dir and write the measurements as JSON."""
+    sys.path.insert(0, args.app_dir)
+    rss_before_import = rss_mb()
+    import app as core  # noqa: E402 -- after the environment is set up by the parent
+    rss_base = rss_mb()
+
+    cache_dir = tempfile.mkdtemp(prefix="index-bench-cache-") if args.cached_rebuild else None
+    idx = new_index(core, cache_dir)
+    t0 = time.perf_counter()
+    idx.build_from_folder(args.folder)
+    build_s = time.perf_counter() - t0
+    peak_build = peak_rss_mb()
+    sizes = index_sizes(core, idx)
+
+    queries = make_queries(args.queries, args)
+    top_k = getattr(core, "TOP_K_CHUNKS", 6)
+    time_queries(idx, queries[:10], top_k)  # warm up
+    single = time_queries(idx, queries, top_k)
+
+    threaded: List[float] = []
+    lock = threading.Lock()
+
+    def run(offset: int):
+        mine = time_queries(idx, queries[offset:] + queries[:offset], top_k)
+        with lock:
+            threaded.extend(mine)
+
+    threads = [threading.Thread(target=run, args=(i * len(queries) // args.threads,))
+               for i in range(args.threads)]
+    t1 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    threaded_s = time.perf_counter() - t1
+
+    result = {
+        "chunks_requested": args.chunks, "chunks": sizes.get("chunks"),
+        "build_s": round(build_s, 3),
+        "rss_mb": {"before_import": round(rss_before_import, 1), "after_import": round(rss_base, 1),
+                   "peak_build": round(peak_build, 1), "end": round(rss_mb(), 1)},
+        "index": sizes,
+        "retrieve_ms": latency_summary(single),
+        "retrieve_qps": round(len(single) / sum(single), 1) if single else None,
+        "threaded": {"threads": args.threads, "retrieve_ms": latency_summary(threaded),
+                     "qps": round(len(threaded) / threaded_s, 1) if threaded_s else None},
+    }
+    if getattr(idx, "build_report", None):
+        result["build_report"] = idx.build_report.get("bench")
+    if args.cached_rebuild:
+        again = new_index(core, cache_dir)
+        t2 = time.perf_counter()
+        again.build_from_folder(args.folder)
+        result["cached_rebuild_s"] = round(time.perf_counter() - t2, 3)
+    # Extraction pool workers only count towards RUSAGE_CHILDREN once they have exited.
+    pool = getattr(core, "_extraction_pool", None)
+    if pool is not None:
+        pool.shutdown(wait=True)
+    result["rss_mb"]["peak_extraction_worker"] = round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1)
+    with open(args.worker_out, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+# ---------------- Driver ----------------
+
+COMPARED = [(("build_s",), False), (("rss_mb", "peak_build"), False), (("index", "matrix_bytes"), False),
+            (("index", "vocab_bytes"), False), (("retrieve_ms", "p50"), False), (("retrieve_ms", "p95"), False),
+            (("retrieve_ms", "p99"), False), (("threaded", "qps"), True), (("cached_rebuild_s",), False)]
+
+
+def run_size(chunks: int, folder: str, args) -> Dict:
+    with tempfile.TemporaryDirectory(prefix="index-bench-") as tmp:
+        out = os.path.join(tmp, "result.json")
+        cmd = [sys.executable, os.path.abspath(__file__), "--worker", "--folder", folder, "--chunks", str(chunks),
+               "--worker-out", out, "--app-dir", args.app_dir, "--queries", str(args.queries),
+               "--threads", str(args.threads), "--vocab", str(args.vocab), "--seed", str(args.seed)]
+        if args.cached_rebuild:
+            cmd.append("--cached-rebuild")
+        env = dict(os.environ, INDEX_WARMUP="0", REINDEX_INTERVAL="0", MODEL_WARMUP="0", LLM_CACHE="0",
+                   LAZY_INDEX="1", INDEX_CACHE_DIR="", CHUNK_CHARS=str(args.chunk_chars))
+        # Run from an empty folder: importing app.py discovers ./study_packs.
+        proc = subprocess.run(cmd, cwd=tmp, env=env, stdout=None if args.verbose else subprocess.DEVNULL)
+        if proc.returncode != 0 or not os.path.exists(out):
+            return {"chunks_requested": chunks, "error": f"worker exited with {proc.returncode}"}
+        with open(out, encoding="utf-8") as f:
+            return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="300,3000,30000", help="comma-separated pack sizes in chunks")
+    parser.add_argument("--pdf-share", type=float, default=0.1, help="share of the text generated as PDFs")
+    parser.add_argument("--vocab", type=int, default=50000, help="distinct words in the synthetic text")
+    parser.add_argument("--chunk-chars", type=int, default=1800, help="CHUNK_CHARS for the build")
+    parser.add_argument("--queries", type=int, default=300, help="retrieve() calls per measurement")
+    parser.add_argument("--threads", type=int, default=8, help="threads for the concurrent measurement")
+    parser.add_argument("--cached-rebuild", action="store_true", help="also time a rebuild from the index cache")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "studypack-index-bench"))
+    parser.add_argument("--app-dir", default=os.path.dirname(HERE), help="checkout whose app.py is measured")
+    parser.add_argument("--out", default="", help="write results as JSON here")
+    parser.add_argument("--baseline", default="", help="earlier --out file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="regression threshold (fraction)")
+    parser.add_argument("--verbose", action="store_true", help="show the app's build output")
+    # Internal: one measurement in a fresh process.
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-out", help=argparse.SUPPRESS)
+    parser.add_argument("--folder", help=argparse.SUPPRESS)
+    parser.add_argument("--chunks", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.app_dir = os.path.abspath(args.app_dir)
+    if args.worker:
+        worker(args)
+        return
+
+    results = []
+    print(f"{'chunks':>9} {'built':>9} {'build s':>8} {'peak MB':>8} {'matrix MB':>9} {'vocab MB':>8} "
+          f"{'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'qps x' + str(args.threads):>9}")
+    for chunks in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        folder = ensure_pack(args.data_dir, chunks, args)
+        row = run_size(chunks, folder, args)
+        results.append(row)
+        if "error" in row:
+            print(f"{chunks:>9} {row['error']}", flush=True)
+            continue
+        lat, ix = row["retrieve_ms"], row["index"]
+        print(f"{chunks:>9} {row['chunks'] or 0:>9} {row['build_s']:>8.2f} {row['rss_mb']['peak_build']:>8.0f} "
+              f"{ix['matrix_bytes'] / 1e6:>9.1f} {ix['vocab_bytes'] / 1e6:>8.1f} {lat['p50']:>7.2f} "
+              f"{lat['p95']:>7.2f} {lat['p99']:>7.2f} {row['threaded']['qps'] or 0:>9.0f}", flush=True)
+
+    meta = run_meta(commit=git_commit(args.app_dir), app_dir=args.app_dir, numpy=np.__version__,
+                    args={k: v for k, v in vars(args).items() if k not in ("worker", "worker_out", "folder", "chunks")})
+    if args.out:
+        write_report(args.out, {"meta": meta, "results": results})
+    if args.baseline and compare(results, args.baseline, ("chunks_requested",), COMPARED, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Load generator for the backend (app.py or app_async.py).
+
+Drives /ask, /ask_stream, /generate_quiz and /grade_quiz at each concurrency
+level in turn and reports, per endpoint and level: p50/p95/p99 latency, time to
+first token (streams), throughput, and error and 429 rates. Results are written
+as JSON; pass an earlier result file as --baseline to print the change in each
+metric and exit non-zero when one regressed by more than --threshold.
+
+    python bench/loadgen.py --concurrency 1,4,16 --requests 40 --out bench_results/run.json
+    python bench/loadgen.py --out bench_results/new.json --baseline bench_results/run.json
+
+Questions are numbered so each request is distinct (nothing is served from the
+LLM cache or coalesced); --same-question sends identical requests instead.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List
+
+import requests
+
+from benchlib import compare, git_commit, latency_summary, run_meta, write_report
+
+ENDPOINTS = ("ask", "ask_stream", "generate_quiz", "grade_quiz")
+
+QUIZ = {
+    "questions": [
+        {"number": 1, "question": "Which gas do plants release?", "choices": ["A) Oxygen", "B) Nitrogen"],
+         "answer": "A"},
+        {"number": 2, "question": "How many chambers does the human heart have?", "answer": "4"},
+        {"number": 3, "question": "Why do plants need sunlight?",
+         "answer": "To make food by photosynthesis"},
+    ]
+}
+
+
+def body_for(endpoint: str, n: int, args) -> Dict:
+    tag = "" if args.same_question else f" (#{n})"
+    common = {"pack": args.pack or None, "max_tokens": args.max_tokens}
+    if endpoint in ("ask", "ask_stream"):
+        return dict(common, question=f"How do plants make their food?{tag}")
+    if endpoint == "generate_quiz":
+        return dict(common, topic=f"Photosynthesis{tag}", count=3)
+    # One local (choice), one numeric and one open answer, so every request still needs the model.
+    return dict(common, quiz_json=QUIZ,
+                student_answers={"1": "A", "2": "four" if n % 2 else "4",
+                                 "3": f"They use light to make sugar{tag}"})
+
+
+def one_request(session: requests.Session, base: str, endpoint: str, body: Dict, timeout: float) -> Dict:
+    """Send one request; returns its status, latency and (streams) time to first token, in seconds."""
+    t0 = time.perf_counter()
+    out = {"status": None, "latency": None, "ttft": None, "error": None}
+    try:
+        if endpoint == "ask_stream":
+            with session.post(f"{base}/ask_stream?format=ndjson", json=body, stream=True, timeout=timeout) as r:
+                out["status"] = r.status_code
+                if r.status_code == 200:
+                    for line in r.iter_lines():
+                        if not line:
+                            continue
+                        event = json.loads(line)
+                        if event.get("type") == "delta" and out["ttft"] is None:
+                            out["ttft"] = time.perf_counter() - t0
+                        elif event.get("type") == "error":
+                            out["error"] = event.get("error") or "stream error"
+                else:
+                    r.content  # drain, so the connection can be reused
+        else:
+            r = session.post(f"{base}/{endpoint}", json=body, timeout=timeout)
+            out["status"] = r.status_code
+            if r.status_code == 200 and "error" in r.json():
+                out["error"] = r.json()["error"]
+    except (requests.RequestException, ValueError) as e:
+        out["error"] = str(e) or type(e).__name__
+    out["latency"] = time.perf_counter() - t0
+    if out["status"] not in (200, 429) and out["error"] is None:
+        out["error"] = f"HTTP {out['status']}"
+    return out
+
+
+def run_level(base: str, endpoint: str, concurrency: int, total: int, args) -> Dict:
+    """`total` requests to `endpoint` from `concurrency` workers, each on its own keep-alive session."""
+    results: List[Dict] = []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker(client: int):
+        session = requests.Session()
+        session.headers["X-Client-Id"] = f"bench-{client}"
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            res = one_request(session, base, endpoint, body_for(endpoint, n, args), args.timeout)
+            with lock:
+                results.append(res)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+
+    ok = [r for r in results if r["status"] == 200 and r["error"] is None]
+    busy = sum(1 for r in results if r["status"] == 429)
+    errors = len(results) - len(ok) - busy
+    summary = {
+        "endpoint": endpoint, "concurrency": concurrency, "requests": len(results), "ok": len(ok),
+        "errors": errors, "busy_429": busy,
+        "error_rate": round(errors / len(results), 4) if results else None,
+        "busy_rate": round(busy / len(results), 4) if results else None,
+        "wall_s": round(wall, 3), "throughput_rps": round(len(ok) / wall, 3) if wall else None,
+        "latency_ms": latency_summary([r["latency"] for r in ok]),
+    }
+    if endpoint == "ask_stream":
+        summary["ttft_ms"] = latency_summary([r["ttft"] for r in ok if r["ttft"] is not None])
+    sample = next((r["error"] for r in results if r["error"]), None)
+    if sample:
+        summary["sample_error"] = sample[:200]
+    return summary
+
+
+# (metric path, True when higher is better)
+COMPARED = [(("latency_ms", "p50"), False), (("latency_ms", "p95"), False), (("latency_ms", "p99"), False),
+            (("ttft_ms", "p50"), False), (("ttft_ms", "p95"), False), (("throughput_rps",), True),
+            (("error_rate",), False)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--base", default="http://127.0.0.1:5000", help="backend URL")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"comma-separated subset of {ENDPOINTS}")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=40, help="requests per endpoint and level")
+    parser.add_argument("--pack", default="", help="study pack to ground requests in (default: none)")
+    parser.add_argument("--max-tokens", type=int, default=200)
+    parser.add_argument("--same-question", action="store_true", help="identical requests (cache/coalescing)")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--out", default="", help="write results as JSON here")
+    parser.add_argument("--baseline", default="", help="earlier --out file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="regression threshold (fraction)")
+    args = parser.parse_args()
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    try:
+        health = requests.get(f"{args.base}/health", timeout=10).json()
+    except (requests.RequestException, ValueError) as e:
+        sys.exit(f"[bench] backend not reachable at {args.base}: {e}")
+
+    results = []
+    print(f"{'endpoint':<14} {'conc':>4} {'ok':>5} {'err':>4} {'429':>4} {'rps':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ttft p50':>9}")
+    for endpoint in endpoints:
+        for level in levels:
+            row = run_level(args.base, endpoint, level, args.requests, args)
+            results.append(row)
+            lat, ttft = row["latency_ms"], (row.get("ttft_ms") or {}).get("p50")
+            print(f"{endpoint:<14} {level:>4} {row['ok']:>5} {row['errors']:>4} {row['busy_429']:>4} "
+                  f"{row['throughput_rps'] or 0:>7.2f} {lat['p50'] or 0:>8.0f} {lat['p95'] or 0:>8.0f} "
+                  f"{lat['p99'] or 0:>8.0f} {ttft if ttft is not None else '-':>9}", flush=True)
+
+    meta = run_meta(base=args.base, commit=git_commit(os.path.dirname(os.path.abspath(__file__))),
+                    server=health.get("server", "flask"), model=health.get("model"), args=vars(args))
+    if args.out:
+        write_report(args.out, {"meta": meta, "results": results})
+    if args.baseline and compare(results, args.baseline, ("endpoint", "concurrency"), COMPARED, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
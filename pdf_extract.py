@@ -0,0 +1,29 @@
+# pdf_extract.py
+"""
+PDF text extraction tasks for StudyPackIndex's process pool.
+
+Kept separate from app.py and limited to PyPDF2 so pool tasks don't depend
+on Flask or scikit-learn state.
+"""
+import time
+from typing import List, Optional, Tuple
+
+import PyPDF2
+
+
+def extract_pages(path: str, start: int = 0, end: Optional[int] = None) -> Tuple[List[str], int, float]:
+    """
+    Text of pages [start, end) of one PDF.
+    Returns (page texts, total page count, CPU seconds spent).
+    """
+    t0 = time.process_time()
+    text = []
+    with open(path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        n_pages = len(reader.pages)
+        for i in range(start, n_pages if end is None else min(end, n_pages)):
+            try:
+                text.append(reader.pages[i].extract_text() or "")
+            except Exception:
+                text.append("")
+    return text, n_pages, time.process_time() - t0
@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def test_file_rules_that_only_break_once_combined(tmp_path, capsys):
+    rules_file = tmp_path / "rules.txt"
+    rules_file.write_text("\n".join([
+        "# inline flags, valid on their own but not mid-alternation",
+        r"re:(?i)\bfoo\b",
+        r"re:(?x) zap \s+ zip",
+        "# the second use of a group name clashes",
+        r"re:(?P<word>bar)",
+        r"re:(?P<word>baz)",
+        "# group numbers shift once rules are joined",
+        r"re:(\w)\1{3}",
+        r"re:(?P<ch>q)(?P=ch)",
+        "re:(unclosed",
+        "secret handshake",
+    ]), encoding="utf-8")
+
+    rules = app.load_guardrails(str(rules_file))
+
+    warnings = capsys.readouterr().out
+    assert "rules.txt:6" in warnings    # baz: group name clash
+    assert "rules.txt:8" in warnings    # numbered backreference
+    assert "rules.txt:10" in warnings   # invalid pattern
+    assert rules.check("FOO fighters") == "Inappropriate language"
+    assert rules.check("zap   zip") == "Inappropriate language"
+    assert rules.check("a bar") == "Inappropriate language"
+    assert rules.check("a baz") is None
+    assert rules.check("aaaa") is None
+    assert rules.check("qq") == "Inappropriate language"
+    assert rules.check("The Secret Handshake") == "Disallowed topic: secret handshake"
+    # The built-in rules still apply.
+    assert rules.check("illegal drugs") == "Disallowed topic: illegal drugs"
+    assert rules.check("photosynthesis") is None
+
+
+def test_scanner_finds_a_match_split_across_chunks():
+    scanner = app.guardrails.scanner()
+    sent = []
+    for chunk in ["Plants ", "need ", "ill", "egal dr", "ugs ", "never"]:
+        safe, reason = scanner.feed(chunk)
+        sent.append(safe)
+        if reason:
+            break
+    assert reason == "Disallowed topic: illegal drugs"
+    assert "drugs" not in "".join(sent)
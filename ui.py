@@ -4,20 +4,48 @@ import requests
 import json
 from textwrap import dedent
 import re
+import time
+import uuid
 
 API_BASE = "http://127.0.0.1:5000"
 
 st.set_page_config(page_title="AI-Powered Educational Assistant", layout="wide")
 st.title("AI-Powered Educational Assistant (Offline-Ready)")
 
+# All students reach the backend through this one Streamlit server, so tag each
+# browser session for the backend's per-client fair queueing.
+if "client_id" not in st.session_state:
+    st.session_state.client_id = uuid.uuid4().hex
+HEADERS = {"X-Client-Id": st.session_state.client_id}
+# The backend remembers the Ask tab's conversation under this id, so follow-ups have context.
+if "tutor_session" not in st.session_state:
+    st.session_state.tutor_session = uuid.uuid4().hex
+
 # ---------------- Sidebar: global controls ----------------
 st.sidebar.header("Controls")
 
-# Fetch packs
+# Fetch packs (+ per-pack index state: pending/building/ready)
 try:
-    packs = requests.get(f"{API_BASE}/packs", timeout=10).json().get("packs", [])
+    packs_resp = requests.get(f"{API_BASE}/packs", timeout=10).json()
+    packs = packs_resp.get("packs", [])
+    pack_states = packs_resp.get("states", {})
 except Exception:
-    packs = []
+    packs, pack_states = [], {}
+
+# The backend loads the model at startup; say so until it is ready.
+try:
+    health = requests.get(f"{API_BASE}/health", timeout=5).json()
+except Exception:
+    health = {}
+model_status = health.get("model_status") or {}
+if model_status.get("state") == "failed":
+    st.sidebar.error(f"Cannot load the model in Ollama: {model_status.get('error')}")
+elif health.get("status") == "warming":
+    st.sidebar.warning("The model is still loading; the first answers may be slow.")
+
+def _pack_label(name: str) -> str:
+    state = pack_states.get(name, "ready")
+    return name if state == "ready" else f"{name} ({state})"
 
 # Default to "Samples" if that pack exists (index +1 because "(None)" is first)
 default_idx = 0
@@ -27,9 +55,18 @@ if "Samples" in packs:
 pack_choice = st.sidebar.selectbox(
     "Study Pack (RAG)",
     ["(None)"] + packs,
-    index=default_idx
+    index=default_idx,
+    format_func=lambda n: n if n == "(None)" else _pack_label(n),
 )
 pack_send = None if pack_choice == "(None)" else pack_choice
+if pack_send and pack_states.get(pack_send, "ready") in ("pending", "building"):
+    st.sidebar.caption("This pack is still being indexed; the first answer from it may take a little longer.")
+elif pack_send and pack_states.get(pack_send) == "failed":
+    st.sidebar.caption("This pack failed to index; check the backend log.")
+# Subject packs can also pull excerpts from the root-level "General" pack.
+with_general = bool(pack_send and pack_send != "General" and "General" in packs
+                    and st.sidebar.checkbox("Also search General", value=False))
+pack_query = [pack_send, "General"] if with_general else pack_send
 
 reading_level = st.sidebar.selectbox("Reading level (grades)", ["", "3","4","5","6","7","8","9","10","11","12"])
 
@@ -93,6 +130,57 @@ def _pretty_md(text: str) -> str:
 
     return t.strip()
 
+def _show_sources(sources):
+    """One caption line listing the study pack excerpts an answer was grounded in."""
+    if not sources:
+        return
+    parts = []
+    several = len({src.get("pack") for src in sources}) > 1
+    for i, src in enumerate(sources, 1):
+        first, last = (src.get("pages") or [None, None])[:2]
+        pages = f"p. {first}" if first == last else f"pp. {first}-{last}"
+        where = f"{src.get('pack')}/{src.get('file', '?')}" if several else src.get("file", "?")
+        parts.append(f"[{i}] {where} {pages}")
+    st.caption("Sources: " + " · ".join(parts))
+
+def _render_stream(res, placeholder) -> str:
+    """
+    Show an NDJSON /ask_stream answer as it arrives and return the full text.
+    Finished paragraphs are written once; only the paragraph still being
+    written is redrawn, at most a few times a second, so long answers stay fast.
+    """
+    area = placeholder.container()
+    tail = area.empty()
+    parts, pending, last_draw = [], "", 0.0
+    done = {}
+    for raw_line in res.iter_lines(decode_unicode=True):
+        if not raw_line:
+            continue
+        event = json.loads(raw_line)
+        if event.get("type") == "delta":
+            parts.append(event["delta"])
+            pending += event["delta"]
+            cut = pending.rfind("\n\n")
+            if cut != -1:
+                tail.markdown(pending[:cut])   # freeze the finished paragraphs
+                tail = area.empty()
+                pending = pending[cut + 2:]
+                last_draw = 0.0
+            if time.monotonic() - last_draw > 0.15:
+                tail.markdown(pending)
+                last_draw = time.monotonic()
+        elif event.get("type") == "error":
+            st.error(event["error"])
+        elif event.get("type") == "done":
+            done = event
+    text = "".join(parts)
+    placeholder.markdown(_pretty_md(text))  # pretty final render
+    _show_sources(done.get("sources"))
+    if done.get("ttft_ms") is not None:
+        speed = f" · {done['tokens_per_s']} tokens/s" if done.get("tokens_per_s") else ""
+        st.caption(f"First words after {done['ttft_ms'] / 1000:.1f}s{speed}")
+    return text
+
 # ---------------- Tabs ----------------
 tabs = st.tabs(["Tutor Chat", "Lesson Generator", "Quiz + Auto-Grader", "Help"])
 
@@ -170,37 +258,44 @@ with tabs[0]:
     preset = st.selectbox("Prompt preset", PRESETS[preset_group],
                           key="preset_select", label_visibility="collapsed")
     ask_preset_clicked = st.button("Ask preset", key="ask_preset_btn")
+    if st.button("New conversation", key="new_conv_btn", help="Forget the earlier questions in this chat"):
+        try:
+            requests.delete(f"{API_BASE}/sessions/{st.session_state.tutor_session}", headers=HEADERS, timeout=5)
+        except Exception:
+            pass  # it expires on its own
+        st.session_state.tutor_session = uuid.uuid4().hex
 
     # ---------- Helper to send either free-text or preset ----------
     def send_question(text: str):
         payload = {
             "question": text.strip(),
-            "pack": pack_send,
+            "pack": pack_query,
             "reading_level": reading_level or None,
             "bilingual_lang": bilingual_lang_to_send,
             "max_tokens": int(resp_tokens),
+            "session_id": st.session_state.tutor_session,
         }
         placeholder = st.empty()
         if stream_on:
             try:
                 with st.spinner("Thinking (streaming)…"):
-                    res = requests.post(f"{API_BASE}/ask_stream", json=payload, stream=True, timeout=300)
-                    res.raise_for_status()
-                    buf = ""
-                    for line in res.iter_lines(decode_unicode=True):
-                        if line:
-                            buf += line
-                            placeholder.markdown(buf)      # live while streaming
-                    placeholder.markdown(_pretty_md(buf))  # pretty final render
+                    res = requests.post(f"{API_BASE}/ask_stream?format=ndjson", json=payload, headers=HEADERS,
+                                        stream=True, timeout=300)
+                    if res.status_code in (400, 429):  # blocked, or the server queue is full
+                        st.error(res.json().get("error", f"HTTP {res.status_code}"))
+                    else:
+                        res.raise_for_status()
+                        _render_stream(res, placeholder)
             except Exception as e:
                 st.error(f"Streaming failed: {e}")
         else:
             with st.spinner("Thinking…"):
                 try:
-                    r = requests.post(f"{API_BASE}/ask", json=payload, timeout=180)
+                    r = requests.post(f"{API_BASE}/ask", json=payload, headers=HEADERS, timeout=180)
                     data = r.json()
                     if r.status_code == 200:
                         placeholder.markdown(_pretty_md(data.get("response", "(no content)")))
+                        _show_sources(data.get("sources"))
                     else:
                         st.error(data.get("error", f"HTTP {r.status_code}"))
                 except Exception as e:
@@ -241,14 +336,14 @@ with tabs[1]:
             payload = {
                 "topic": topic.strip(),
                 "minutes": minutes,
-                "pack": pack_send,
+                "pack": pack_query,
                 "reading_level": reading_level or None,
                 "bilingual_lang": bilingual_lang_to_send,
                 "max_tokens": max(resp_tokens, 400)  # lesson needs a bit more room
             }
             with st.spinner("Generating lesson…"):
                 try:
-                    r = requests.post(f"{API_BASE}/generate_lesson", json=payload, timeout=360)
+                    r = requests.post(f"{API_BASE}/generate_lesson", json=payload, headers=HEADERS, timeout=360)
                     data = r.json()
                     if r.status_code == 200:
                         st.success("Lesson Plan")
@@ -287,22 +382,51 @@ with tabs[2]:
             payload = {
                 "topic": quiz_topic.strip(),
                 "count": int(q_count),
-                "pack": pack_send,
+                "pack": pack_query,
                 "reading_level": reading_level or None,
                 "bilingual_lang": bilingual_lang_to_send,
                 "max_tokens": max(resp_tokens, 450)
             }
-            with st.spinner("Creating quiz…"):
+            if stream_on:
+                # Questions appear one by one as the model finishes each of them.
+                preview = st.empty()
+                shown = []
                 try:
-                    r = requests.post(f"{API_BASE}/generate_quiz", json=payload, timeout=360)
-                    quiz = r.json()
-                    if r.status_code == 200:
-                        st.session_state["last_quiz"] = quiz
-                        st.success("Quiz generated below")
-                    else:
-                        st.error(quiz.get("error", f"HTTP {r.status_code}"))
+                    with requests.post(f"{API_BASE}/generate_quiz_stream", json=payload, headers=HEADERS,
+                                       stream=True, timeout=360) as r:
+                        if r.status_code != 200:
+                            st.error(r.json().get("error", f"HTTP {r.status_code}"))
+                        else:
+                            for raw_line in r.iter_lines(decode_unicode=True):
+                                if not raw_line:
+                                    continue
+                                msg = json.loads(raw_line)
+                                if "question" in msg:
+                                    shown.append(f"**{msg['question']['number']}.** {msg['question']['question']}")
+                                    preview.markdown("\n\n".join(shown) + "\n\n_Writing the next question…_")
+                                elif "error" in msg:
+                                    st.error(msg["error"])
+                                elif msg.get("done"):
+                                    preview.empty()
+                                    if msg["quiz"]["questions"]:
+                                        st.session_state["last_quiz"] = msg["quiz"]
+                                        st.success("Quiz generated below")
+                                    else:
+                                        st.error("The model did not return any usable questions.")
                 except Exception as e:
                     st.error(f"Request failed: {e}")
+            else:
+                with st.spinner("Creating quiz…"):
+                    try:
+                        r = requests.post(f"{API_BASE}/generate_quiz", json=payload, headers=HEADERS, timeout=360)
+                        quiz = r.json()
+                        if r.status_code == 200:
+                            st.session_state["last_quiz"] = quiz
+                            st.success("Quiz generated below")
+                        else:
+                            st.error(quiz.get("error", f"HTTP {r.status_code}"))
+                    except Exception as e:
+                        st.error(f"Request failed: {e}")
 
     quiz = st.session_state.get("last_quiz")
     if quiz:
@@ -324,14 +448,14 @@ with tabs[2]:
             payload = {
                 "quiz_json": quiz,
                 "student_answers": answers,
-                "pack": pack_send,
+                "pack": pack_query,
                 "reading_level": reading_level or None,
                 "bilingual_lang": bilingual_lang_to_send,
                 "max_tokens": max(resp_tokens, 500)
             }
             with st.spinner("Grading…"):
                 try:
-                    r = requests.post(f"{API_BASE}/grade_quiz", json=payload, timeout=360)
+                    r = requests.post(f"{API_BASE}/grade_quiz", json=payload, headers=HEADERS, timeout=360)
                     graded = r.json()
                     if r.status_code == 200:
                         st.success(f"Score: {graded.get('score','?')}/{graded.get('total','?')}")
@@ -358,7 +482,7 @@ with tabs[3]:
     **Launch order every time**
     1. Terminal #1: `python app.py`
     2. Terminal #2: `streamlit run ui.py`
-    If you add PDFs, restart **app.py**.
+    New or changed files in `study_packs/` are picked up automatically every `REINDEX_INTERVAL` seconds if the watcher is on, or right away via `POST /reindex` (no restart needed).
 
     **Study Pack (RAG)**
     - Put files in `study_packs/YourPack/` (**.pdf, .txt, .md**). Each subfolder becomes a pack.
@@ -370,14 +494,14 @@ with tabs[3]:
     - Turn on bilingual to get English + your selected language.
 
     **Tabs**
-    - *Tutor Chat*: Ask quick questions. Works best with a selected pack for accuracy.
+    - *Tutor Chat*: Ask quick questions. Works best with a selected pack for accuracy. Follow-ups ("why?", "another example") remember the conversation; click **New conversation** to start over.
     - *Lesson Generator*: One-click lesson plan (objectives, activities, exit ticket).
     - *Quiz + Auto-Grader*: Generate a quiz, collect answers, and auto-grade with a rubric.
 
     **Performance tips**
     - Use the sidebar **Max answer tokens**: smaller = faster.
     - Turn off bilingual for speed; turn on for your final copy.
-    - First request after starting Ollama can be slower (model warm-up).
+    - The backend loads the model when it starts; while the sidebar says it is loading, the first answers are slower.
 
     **Troubleshooting**
     - If you see an Ollama timeout, try a shorter request, reduce tokens, or ask again (the app auto-retries).